@@ -1,115 +1,75 @@
 import torch
+import torch.nn.functional as F
 from torchvision import datasets, transforms
 from torch.utils.data import Dataset, DataLoader
 import numpy as np
 from sklearn.model_selection import train_test_split
 from PIL import Image
 import pandas as pd
-
-import numpy as np
-import pandas as pd
-
-def setting2_dirch_val(train_full_dataset, test_full_dataset, num_users):
-    np.random.seed(42)  # Set the seed for reproducibility
-    dict_users, dict_users_test, dict_users_val = {}, {}, {}
-    for i in range(num_users):
-        dict_users[i] = []
-        dict_users_test[i] = []
-        dict_users_val[i] = []
-
-    # Create DataFrames
-    df = pd.DataFrame(list(zip(train_full_dataset.data, train_full_dataset.targets)), columns=['images', 'labels'])
-    df_test = pd.DataFrame(list(zip(test_full_dataset.data, test_full_dataset.targets)), columns=['images', 'labels'])
-    num_of_classes = df['labels'].nunique()
-
-    # Initialize class-wise indices
-    dict_classwise = {i: df[df['labels'] == i].index.values.astype(int) for i in range(num_of_classes)}
-    dict_classwise_test = {i: df_test[df_test['labels'] == i].index.values.astype(int) for i in range(num_of_classes)}
-
-    # Sample sizes per client
-    total_train_samples_per_client = 500
-    total_test_samples_per_client = 1000
-    total_val_samples_per_client = 250
-
-    for i in range(num_users):
-        dirichlet_dist = np.random.dirichlet(np.ones(num_of_classes)*0.9)
-        num_samples_train = np.round(dirichlet_dist * total_train_samples_per_client).astype(int)
-        num_samples_test = np.round(dirichlet_dist * total_test_samples_per_client).astype(int)
-        num_samples_val = np.round(dirichlet_dist * total_val_samples_per_client).astype(int)
-
-        for j in range(num_of_classes):
-            # Sampling training data
-            train_indices = sample_data(dict_classwise, j, num_samples_train[j])
-            dict_users[i].extend(train_indices)
-            dict_classwise[j] = list(set(dict_classwise[j]) - set(train_indices))
-
-            # Sampling test data
-            test_indices = sample_data(dict_classwise_test, j, num_samples_test[j], replace=True)
-            dict_users_test[i].extend(test_indices)
-
-            # Sampling validation data
-            val_indices = sample_data(dict_classwise, j, num_samples_val[j])
-            dict_users_val[i].extend(val_indices)
-            dict_classwise[j] = list(set(dict_classwise[j]) - set(val_indices))
-
-    return dict_users, dict_users_test, dict_users_val
-
-
-
-def setting2_dirch_val2(train_full_dataset, test_full_dataset, num_users):
-    np.random.seed(42)  # Set the seed for reproducibility
-    dict_users, dict_users_test, dict_users_val = {}, {}, {}
-    for i in range(num_users):
-        dict_users[i] = []
-        dict_users_test[i] = []
-        dict_users_val[i] = []
-
-    # Create DataFrames
-    df = pd.DataFrame(list(zip(train_full_dataset.data, train_full_dataset.targets)), columns=['images', 'labels'])
-    df_test = pd.DataFrame(list(zip(test_full_dataset.data, test_full_dataset.targets)), columns=['images', 'labels'])
-    num_of_classes = df['labels'].nunique()
-
-    # Initialize class-wise indices
-    dict_classwise = {i: df[df['labels'] == i].index.values.astype(int) for i in range(num_of_classes)}
-    dict_classwise_test = {i: df_test[df_test['labels'] == i].index.values.astype(int) for i in range(num_of_classes)}
-
-    # Sample sizes per client
-    total_train_samples_per_client = 500
-    total_test_samples_per_client = 1000
-    total_val_samples_per_client = 250
-
-    for i in range(num_users):
-        dirichlet_dist = np.random.dirichlet(np.ones(num_of_classes))
-        num_samples_train = np.round(dirichlet_dist * total_train_samples_per_client).astype(int)
-        num_samples_test = np.round(dirichlet_dist * total_test_samples_per_client).astype(int)
-        num_samples_val = np.round(dirichlet_dist * total_val_samples_per_client).astype(int)
-
-        for j in range(num_of_classes):
-            # Sampling training data
-            train_indices = sample_data(dict_classwise, j, num_samples_train[j])
-            dict_users[i].extend(train_indices)
-            dict_classwise[j] = list(set(dict_classwise[j]) - set(train_indices))
-
-            # Sampling test data
-            test_indices = sample_data(dict_classwise_test, j, num_samples_test[j], replace=True)
-            dict_users_test[i].extend(test_indices)
-
-            # Sampling validation data
-            val_indices = sample_data(dict_classwise, j, num_samples_val[j])
-            dict_users_val[i].extend(val_indices)
-            dict_classwise[j] = list(set(dict_classwise[j]) - set(val_indices))
-
-    return dict_users, dict_users_test, dict_users_val
-
-
-
-
-
-def sample_data(data_dict, class_index, num_samples, replace=False):
-    population_size = len(data_dict[class_index])
-    if num_samples > population_size:
-        num_samples = population_size
-    return list(np.random.choice(data_dict[class_index], num_samples, replace=replace))
+from pathlib import Path
+
+from utils.partition import Partition, take_by_class
+
+
+def plan_dirichlet_partition(train_labels, test_labels, num_users, alpha=1.0, seed=42,
+                             num_train=500, num_test=1000, num_val=250):
+    """
+    the per-client dirichlet partition of the original setting2_dirch_val (alpha=1 / 0.9),
+    for all clients at once, on the label arrays only:
+        - one dirichlet draw per client gives its per class train/test/val counts
+        - train/val are drawn without replacement (utils.partition.take_by_class),
+          served in order client 0 train, client 0 val, client 1 train, ...
+          and capped at what is left of the class
+        - test is drawn with replacement from the test set, one draw per class
+    the class permutations / test draws come from streams that do not depend on
+    num_users and every client's counts are a prefix of the dirichlet draws, so
+    clients 0..N-1 get the same samples whatever num_users >= N is
+    returns {split: Partition}
+    """
+    rng = np.random.RandomState(seed)
+    sample_rng = np.random.RandomState(seed + 1)
+    train_labels = np.asarray(train_labels)
+    test_labels = np.asarray(test_labels)
+    num_classes = int(train_labels.max()) + 1
+
+    dist = rng.dirichlet(np.ones(num_classes) * alpha, size=num_users)
+    train_counts = np.round(dist * num_train).astype(np.int64)
+    test_counts = np.round(dist * num_test).astype(np.int64)
+    val_counts = np.round(dist * num_val).astype(np.int64)
+
+    # row 2i: client i train, row 2i+1: client i val
+    requests = np.stack([train_counts, val_counts], axis=1).reshape(2 * num_users, num_classes)
+    train_val = take_by_class(train_labels, requests, sample_rng, num_classes)
+    is_val = np.repeat(np.arange(2 * num_users) % 2 == 1, train_val.sizes)
+    plan = {
+        'train': Partition(train_val.indices[~is_val], np.concatenate([[0], np.cumsum(train_val.sizes[0::2])])),
+        'val': Partition(train_val.indices[is_val], np.concatenate([[0], np.cumsum(train_val.sizes[1::2])])),
+    }
+
+    samples, owners = [], []
+    for j in range(num_classes):
+        class_test = np.flatnonzero(test_labels == j)
+        counts = np.minimum(test_counts[:, j], len(class_test))
+        class_rng = np.random.RandomState([seed, 2, j])
+        samples.append(class_rng.choice(class_test, counts.sum(), replace=True))
+        owners.append(np.repeat(np.arange(num_users), counts))
+    plan['test'] = Partition.from_owners(np.concatenate(samples), np.concatenate(owners), num_users)
+    return plan
+
+
+def load_or_plan_partition(train_labels, test_labels, num_users, alpha=1.0, seed=42,
+                           num_train=500, num_test=1000, num_val=250, cache_dir='./data/partitions'):
+    """plan_dirichlet_partition cached on disk, keyed by seed/alpha/num_users (and the client sizes)"""
+    key = f'cifar10_dirichlet_v2_seed{seed}_alpha{alpha}_clients{num_users}_{num_train}-{num_test}-{num_val}'
+    paths = {split: Path(cache_dir) / f'{key}_{split}.npz' for split in ('train', 'test', 'val')}
+    if all(path.exists() for path in paths.values()):
+        return {split: Partition.load(path) for split, path in paths.items()}
+
+    plan = plan_dirichlet_partition(train_labels, test_labels, num_users, alpha=alpha, seed=seed,
+                                    num_train=num_train, num_test=num_test, num_val=num_val)
+    for split, path in paths.items():
+        plan[split].save(path)
+    return plan
 
 '''
 def setting2_dirch_val(train_full_dataset, test_full_dataset, num_users):
@@ -184,10 +144,12 @@ class CIFAR10Dataset(Dataset):
         label = self.labels[idx]
         unique_id = f"{self.client_id}-{self.dataset_type}-{idx}"  # Append dataset_type to the unique ID
 
-        # Convert NumPy array to PIL Image
-        image = Image.fromarray(image)
         if self.tfms:
-            image = self.tfms(image)
+            # per-sample PIL transforms
+            image = self.tfms(Image.fromarray(image))
+        else:
+            # raw uint8 (H, W, C), preprocessed per batch by BatchTransform
+            image = torch.from_numpy(image)
         label = torch.tensor(label).long()
         return {
             'image': image,
@@ -198,11 +160,77 @@ class CIFAR10Dataset(Dataset):
     def __len__(self):
         return len(self.images)  # Return the length of the images (number of samples)
 
+    def get_labels(self):
+        """labels of all samples, without loading or transforming any image"""
+        return np.asarray(self.labels)
+
+
+class BatchTransform:
+    """
+    batch level replacement of Resize -> ToTensor -> Normalize (+ optional random
+    horizontal flip), vectorized on the device the batch lives on:
+    uint8 (B, H, W, C) -> float (B, C, img_size, img_size)
+    """
+
+    def __init__(self, img_size=224, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), hflip=False):
+        self.img_size = img_size
+        self.mean = mean
+        self.std = std
+        self.hflip = hflip
+        self.stats = {}  # device -> (mean, std) tensors
+
+    def _stats(self, device):
+        if device not in self.stats:
+            self.stats[device] = (
+                torch.tensor(self.mean, device=device).view(1, -1, 1, 1),
+                torch.tensor(self.std, device=device).view(1, -1, 1, 1),
+            )
+        return self.stats[device]
+
+    @torch.no_grad()
+    def __call__(self, images):
+        x = images.permute(0, 3, 1, 2).float().div_(255)
+        if tuple(x.shape[-2:]) != (self.img_size, self.img_size):
+            x = F.interpolate(x, size=(self.img_size, self.img_size), mode='bilinear', align_corners=False)
+        if self.hflip:
+            flip = torch.rand(x.shape[0], device=x.device) < 0.5
+            x = torch.where(flip.view(-1, 1, 1, 1), x.flip(-1), x)
+        mean, std = self._stats(x.device)
+        return x.sub_(mean).div_(std)
+
+
+class DeviceLoader:
+    """
+    wraps a DataLoader of raw uint8 batches: every batch is moved to the device
+    and run through the batch transform before it is handed out
+    """
+
+    def __init__(self, loader, transform, device):
+        self.loader = loader
+        self.transform = transform
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for batch in self.loader:
+            batch['image'] = self.transform(batch['image'].to(self.device, non_blocking=True))
+            yield batch
+
 
 class CIFAR10DataBuilder:
-    def __init__(self, img_size=32, num_clients=10):
+    def __init__(self, img_size=32, num_clients=10, alpha=1.0, seed=42, samples_per_client=(500, 1000, 250)):
         self.img_size = img_size
         self.num_clients = num_clients
+        self.alpha = alpha
+        self.seed = seed
+        # (train, test, val) samples per client
+        self.samples_per_client = samples_per_client
+        # downloaded once and partitioned once for all clients
+        self.train_dataset = None
+        self.test_dataset = None
+        self.partition = None
 
     def download_data(self):
         transform = transforms.Compose([transforms.ToTensor()])
@@ -226,26 +254,40 @@ class CIFAR10DataBuilder:
         
         return transform_train, transform_test
 
-    def get_datasets(self, client_id, transform_train=None, transform_test=None, pool=False):
-        train_dataset, test_dataset = self.download_data()
+    def get_batch_transforms(self):
+        """same preprocessing as get_default_transforms, applied per batch on the device"""
+        return BatchTransform(img_size=224), BatchTransform(img_size=224)
 
-        if transform_train is None:
-            transform_train, transform_test = self.get_default_transforms()
+    def setup(self):
+        if self.partition is not None:
+            return
+        self.train_dataset, self.test_dataset = self.download_data()
+        self.train_labels = np.asarray(self.train_dataset.targets)
+        self.test_labels = np.asarray(self.test_dataset.targets)
+        num_train, num_test, num_val = self.samples_per_client
+        self.partition = load_or_plan_partition(self.train_labels, self.test_labels, self.num_clients,
+                                                alpha=self.alpha, seed=self.seed,
+                                                num_train=num_train, num_test=num_test, num_val=num_val)
 
-        dict_users, dict_users_test, dict_users_val = setting2_dirch_val2(train_dataset, test_dataset, self.num_clients)
+    def client_indices(self, client_id, split):
+        return self.partition[split][client_id]
+
+    def get_datasets(self, client_id, transform_train=None, transform_test=None, pool=False):
+        self.setup()
 
-        train_indices = dict_users[client_id]
-        val_indices = dict_users_val[client_id]
-        test_indices = dict_users_test[client_id]
+        # without per-sample transforms the datasets yield raw uint8 images, see get_batch_transforms
+        train_indices = self.client_indices(client_id, 'train')
+        val_indices = self.client_indices(client_id, 'val')
+        test_indices = self.client_indices(client_id, 'test')
 
-        train_images = train_dataset.data[train_indices]
-        train_labels = np.array(train_dataset.targets)[train_indices]
+        train_images = self.train_dataset.data[train_indices]
+        train_labels = self.train_labels[train_indices]
 
-        val_images = train_dataset.data[val_indices]
-        val_labels = np.array(train_dataset.targets)[val_indices]
+        val_images = self.train_dataset.data[val_indices]
+        val_labels = self.train_labels[val_indices]
 
-        test_images = test_dataset.data[test_indices]
-        test_labels = np.array(test_dataset.targets)[test_indices]
+        test_images = self.test_dataset.data[test_indices]
+        test_labels = self.test_labels[test_indices]
         print("Training")
         train_ds = CIFAR10Dataset(train_images, train_labels, client_id, 0, transform_train)
         print("Validation")
@@ -14,9 +14,9 @@ import numpy as np
 from tqdm.auto import tqdm
 
 # loss and metrics
-from sklearn.metrics import balanced_accuracy_score
-from torchmetrics.functional.classification import f1_score
+from utils.metrics import ConfusionAccumulator
 from ImageClassification_Task.focal_loss_fn import FocalLoss
+from ImageClassification_Task.cifarbuilder import DeviceLoader
 
 
 class Client(Thread):
@@ -78,10 +78,9 @@ class Client(Thread):
         self.train_f1 = []
         self.test_f1 = []
 
-        self.train_preds = []
-        self.train_targets = []
-        self.test_preds = []
-        self.test_targets = []
+        # on-device streaming metrics, reduced once per epoch in get_main_metric
+        self.train_metric = ConfusionAccumulator(num_classes=10)
+        self.test_metric = ConfusionAccumulator(num_classes=10)
 
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -91,78 +90,17 @@ class Client(Thread):
        
 
 
-    @torch.no_grad()
-    def balanced_accuracy(self,preds,targets):
-        targets = targets.reshape(-1).numpy()
-        preds = np.argmax(preds.numpy(), axis=1)
-        return balanced_accuracy_score(targets, preds)
-     
-    @torch.no_grad()    
-    def normal_accuracy(self, preds, targets):
-        targets = targets.reshape(-1).numpy()
-        preds = np.argmax(preds.numpy(), axis=1)
-        correct = np.sum(preds == targets)
-        total = len(targets)
-        accuracy = correct / total
-        
-        return accuracy
-	    
-    @torch.no_grad()
-    def run_metric(self,preds,targets):
-        #print("Run metric")
-        #print("Shapes - preds:", preds.shape, "targets:", targets.shape)
-        #print(preds.shape[1])
-        #print(torch.argmax(preds,dim=1).float())
-        #print(targets.squeeze())
-        return f1_score(
-            #preds=torch.argmax(preds,dim=1).float(),
-            preds=preds.argmax(dim=1),
-            target=targets,
-            task='multiclass',
-            num_classes=10
-        )
-    
     @torch.no_grad()
     def get_main_metric(self,mode='train'):
         """
         calculates main metric to use and then resets over epoch
         """
-        if mode=='train':
-            preds= torch.cat(self.train_preds,dim=0)
-            targets = torch.cat(self.train_targets, dim=0)
-            #preds = torch.vstack(self.train_preds)
-            #targets = torch.vstack(self.train_targets)
-            #print("Shapes - preds:", preds.shape, "targets:", targets.shape)
-            bal_acc = self.normal_accuracy(preds, targets)
-            #print(bal_acc)
-            f1_macro = f1_score(
-                preds=torch.argmax(preds,dim=1).float(),
-                target=targets.squeeze(),
-                task='multiclass',
-                num_classes=10,
-                average='macro'
-            ).item()
-            self.train_targets = []
-            self.train_preds = []
-        elif mode=='test':
-            preds= torch.cat(self.test_preds,dim=0)
-            targets = torch.cat(self.test_targets, dim=0)
-            #preds = torch.vstack(self.test_preds)
-            #targets = torch.vstack(self.test_targets)
-            #print("Shapes - preds:", preds.shape, "targets:", targets.shape)
-            bal_acc = self.normal_accuracy(preds, targets)
-            #print(bal_acc)
-            f1_macro = f1_score(
-                preds=torch.argmax(preds,dim=1).float(),
-                target=targets.squeeze(),
-                task='multiclass',
-                num_classes=10,
-                average='macro'
-            ).item()
-            self.test_preds = []
-            self.test_targets = []
-
-        return bal_acc, f1_macro
+        metric = self.train_metric if mode=='train' else self.test_metric
+        acc = metric.accuracy()
+        f1_macro = metric.f1_macro()
+        metric.reset()
+
+        return acc, f1_macro
 
 
     def backward_back(self):
@@ -182,29 +120,18 @@ class Client(Thread):
         self.loss = self.loss_fn(self.outputs, self.targets.long())
 
         if mode=='train':
-            self.train_loss += self.loss.item()
+            self.train_loss += self.loss.detach()
         elif mode=='test':
-            self.test_loss += self.loss.item()
+            self.test_loss += self.loss.detach()
 
     @torch.no_grad()
     def calculate_train_metric(self):
-        preds = self.outputs
-        targets = self.targets
-        #print("Calculate train metric")
-        #print("Shapes - preds:", preds.shape, "targets:", targets.shape)
-        self.train_preds.append(preds.cpu())
-        self.train_targets.append(targets.cpu())
-        f1 = self.run_metric(preds.cpu(),targets.cpu())
-        return f1
+        # batch f1 stays on device, epoch metrics are read from the accumulator
+        return self.train_metric.update(self.outputs, self.targets)
     
     @torch.no_grad()
     def calculate_test_metric(self):
-        preds = self.outputs
-        targets = self.targets
-        self.test_preds.append(preds.cpu())
-        self.test_targets.append(targets.cpu())
-        f1 = self.run_metric(preds.cpu(),targets.cpu())
-        return f1
+        return self.test_metric.update(self.outputs, self.targets)
     
     
     
@@ -214,7 +141,11 @@ class Client(Thread):
         print(f"[*] Client {self.id} connecting to {host}")
 
 
-    def create_DataLoader(self, train_batch_size, test_batch_size):
+    def create_DataLoader(self, train_batch_size, test_batch_size, batch_transforms=None):
+        """
+        batch_transforms: (train, test) BatchTransform for datasets yielding raw
+        uint8 images, the loaders then hand out preprocessed batches on the device
+        """
         self.train_batch_size = train_batch_size
         self.test_batch_size = test_batch_size
         
@@ -240,6 +171,11 @@ class Client(Thread):
             num_workers=2,
             pin_memory=True
         )
+        if batch_transforms is not None:
+            train_transform, test_transform = batch_transforms
+            self.train_DataLoader = DeviceLoader(self.train_DataLoader, train_transform, self.device)
+            self.test_DataLoader = DeviceLoader(self.test_DataLoader, test_transform, self.device)
+            self.main_test_DataLoader = DeviceLoader(self.main_test_DataLoader, test_transform, self.device)
 
     def disconnect_server(self) -> bool:
         if not is_socket_closed(self.socket):
@@ -0,0 +1,154 @@
+import copy
+
+import numpy as np
+import torch
+from torch.func import functional_call, stack_module_state, vmap
+from torch.optim import Adam
+
+
+"""
+batched discriminator (autoencoder) training for all clients at once
+
+the discriminators only ever see the frozen center_front activations, which are
+already in the server-side key-value store, so no image is loaded again:
+    - every client's train / validation activations are stacked once into a
+      contiguous tensor (pinned host memory on cuda)
+    - the K client discriminators are stacked parameter-wise and run as one
+      vmap'ed model on a (K, B, C, H, W) batch, each client's loss only reaches
+      its own parameters; one Adam over the stacked parameters gives the same
+      updates as K separate (elementwise) Adams
+    - clients with fewer samples cycle through theirs, every round is as long
+      as the largest client
+    - early stopping on the per-client validation reconstruction loss: each
+      client keeps its best weights, training stops once no client improved
+      for patience rounds (or after max_rounds)
+
+ood thresholds are calibrated on the stored per-sample reconstruction errors:
+    - mean: mean validation error (the original threshold)
+    - percentile: the given percentile of the client's validation errors
+    - roc: the threshold maximising tpr - fpr (Youden's J), the client's own
+      validation samples are in-distribution, the other clients' are ood; all
+      candidate thresholds are evaluated at once with searchsorted
+"""
+
+
+def stack_kv(mappings):
+    """{data_key: np.Array} -> contiguous (N, ...) float tensor"""
+    stacked = torch.from_numpy(np.stack(list(mappings.values()))).float()
+    return stacked.pin_memory() if torch.cuda.is_available() else stacked
+
+
+class BatchedDiscriminatorTrainer:
+    def __init__(self, discriminators, train_kv, valid_kv, device, batch_size=32, lr=0.001, betas=(0.9, 0.999)):
+        """
+        discriminators / train_kv / valid_kv: one entry per client, same order
+        """
+        self.discriminators = discriminators
+        self.train_kv = train_kv
+        self.valid_kv = valid_kv
+        self.device = device
+        self.batch_size = batch_size
+
+        params, buffers = stack_module_state(discriminators)
+        self.params = {k: v.detach().clone().requires_grad_(True) for k, v in params.items()}
+        self.buffers = buffers
+        self.optimizer = Adam(self.params.values(), lr=lr, betas=betas)
+
+        base = copy.deepcopy(discriminators[0]).to('meta')
+
+        def reconstruct(params, buffers, x):
+            return functional_call(base, (params, buffers), (x,))
+
+        self.model = vmap(reconstruct)
+
+    def _batch(self, kvs, orders, step):
+        """(K, B, ...) batch, client k takes rows step*B.. of its order (cycling)"""
+        rows = []
+        for kv, order in zip(kvs, orders):
+            idx = np.take(order, np.arange(step * self.batch_size, (step + 1) * self.batch_size), mode='wrap')
+            rows.append(kv[idx])
+        return torch.stack(rows).to(self.device, non_blocking=True)
+
+    def _errors(self, params, x):
+        """per client, per sample mean squared reconstruction error: (K, B)"""
+        reconstruction = self.model(params, self.buffers, x)
+        return (reconstruction - x).pow(2).flatten(2).mean(dim=2)
+
+    def train_round(self):
+        sizes = [len(kv) for kv in self.train_kv]
+        orders = [np.random.permutation(n) for n in sizes]
+        num_steps = (max(sizes) + self.batch_size - 1) // self.batch_size
+
+        total = torch.zeros(len(sizes), device=self.device)
+        for step in range(num_steps):
+            x = self._batch(self.train_kv, orders, step)
+            losses = self._errors(self.params, x).mean(dim=1)
+            self.optimizer.zero_grad()
+            losses.sum().backward()
+            self.optimizer.step()
+            total += losses.detach()
+        return total / num_steps
+
+    @torch.no_grad()
+    def validate(self):
+        """mean per-sample validation reconstruction error of every client: (K,)"""
+        sizes = [len(kv) for kv in self.valid_kv]
+        orders = [np.arange(n) for n in sizes]
+        num_steps = (max(sizes) + self.batch_size - 1) // self.batch_size
+
+        sums = torch.zeros(len(sizes), device=self.device)
+        for step in range(num_steps):
+            errors = self._errors(self.params, self._batch(self.valid_kv, orders, step))
+            # cycled rows past a client's end are not counted
+            positions = torch.arange(step * self.batch_size, (step + 1) * self.batch_size, device=self.device)
+            valid = positions.unsqueeze(0) < torch.tensor(sizes, device=self.device).unsqueeze(1)
+            sums += (errors * valid).sum(dim=1)
+        return sums / torch.tensor(sizes, device=self.device, dtype=sums.dtype)
+
+    def fit(self, max_rounds=60, patience=5, log_fn=None):
+        """
+        returns the best validation loss per client, the discriminators hold their best weights
+        """
+        num_clients = len(self.discriminators)
+        best_loss = torch.full((num_clients,), float('inf'), device=self.device)
+        best_params = {k: v.detach().clone() for k, v in self.params.items()}
+        stale = 0
+
+        for run in range(max_rounds):
+            train_loss = self.train_round()
+            valid_loss = self.validate()
+
+            improved = valid_loss < best_loss
+            best_loss = torch.where(improved, valid_loss, best_loss)
+            for k, v in self.params.items():
+                mask = improved.view(-1, *[1] * (v.dim() - 1))
+                best_params[k] = torch.where(mask, v.detach(), best_params[k])
+
+            if log_fn is not None:
+                log_fn(run, train_loss, valid_loss)
+
+            stale = 0 if bool(improved.any()) else stale + 1
+            if stale >= patience:
+                print(f'discriminator early stopping after {run + 1} rounds')
+                break
+
+        for i, discriminator in enumerate(self.discriminators):
+            discriminator.load_state_dict({k: v[i] for k, v in best_params.items()}, strict=False)
+        return best_loss
+
+
+def roc_threshold(id_errors, ood_errors):
+    """threshold t (ood when error > t) with the best tpr - fpr"""
+    thresholds = np.unique(np.concatenate([id_errors, ood_errors]))
+    fpr = 1 - np.searchsorted(np.sort(id_errors), thresholds, side='right') / len(id_errors)
+    tpr = 1 - np.searchsorted(np.sort(ood_errors), thresholds, side='right') / len(ood_errors)
+    return float(thresholds[np.argmax(tpr - fpr)])
+
+
+def calibrate_threshold(id_errors, ood_errors=None, method='mean', percentile=95):
+    id_errors = np.asarray(id_errors)
+    if method == 'roc' and ood_errors is not None and len(ood_errors):
+        return roc_threshold(id_errors, np.asarray(ood_errors))
+    if method == 'percentile':
+        return float(np.percentile(id_errors, percentile))
+    return float(id_errors.mean())
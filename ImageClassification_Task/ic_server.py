@@ -45,12 +45,6 @@ class ConnectedClient(object):
         self.center_model = None
         self.center_front_model=None
         self.discriminator=None # added by acs
-        self.discriminator_loss_fn = None # added by acs
-        self.discriminator_train_loss = 0 # added by acs
-        self.discriminator_test_loss = 0 # added by acs
-        self.discriminator_main_test_loss = 0 # added by acs
-        self.disc_loss = None #added by acs
-        self.discriminator_optimizer = None # added by acs
         self.center_back_model=None
         self.train_fun = None
         self.test_fun = None
@@ -70,6 +64,10 @@ class ConnectedClient(object):
         self.center_scheduler = None
         self.activation_mappings={}
         self.test_activation_mappings={}
+        # reconstruction error of every stored activation, per split {data_key: float}
+        self.error_mappings={'train': {}, 'test': {}, 'main_test': {}}
+        self.error_versions={'train': 0, 'test': 0, 'main_test': 0}
+        self.discriminator_version=0
         
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -103,6 +101,7 @@ class ConnectedClient(object):
             for i in range(0, len(self.batchkeys)):
                 #print(self.batchkeys[i])
                 self.activation_mappings[self.batchkeys[i]]=local_middle_activations[i]
+                self.error_mappings['train'].pop(self.batchkeys[i], None)
             
         else:
             # Ensure all keys in batchkeys exist in activation_mappings
@@ -124,29 +123,50 @@ class ConnectedClient(object):
             self.middle_activations = torch.tensor(activations_array, device=self.device)
             #print("Middle activations created from train activation_mappings based on batchkeys.")
     
-    def forward_discriminator(self):
-        self.reconstructions = self.discriminator(self.middle_activations)
-        
-    def forward_discriminator_test(self):
-        self.reconstructions = self.discriminator(self.middle_activations)
-        
-    
-    def calculate_discriminator_loss(self, mode):
-        
-        self.disc_loss  = self.discriminator_loss_fn(self.reconstructions, self.middle_activations)
-        if mode=="train":
-            self.discriminator_train_loss+=self.disc_loss.item()
-        elif mode=="test":
-            self.discriminator_test_loss+=self.disc_loss.item()
-        else:
-            self.discriminator_main_test_loss+=self.disc_loss.item()
-        
-    def discriminator_step(self):
-        self.discriminator_optimizer.step()
-    
-    def zero_grad_back(self):
-        self.discriminator_optimizer.zero_grad()
-            
+    def discriminator_updated(self):
+        # stored reconstruction errors belong to the old weights, they are dropped on next use
+        self.discriminator_version+=1
+
+    def _error_store(self, split):
+        if self.error_versions[split]!=self.discriminator_version:
+            self.error_mappings[split]={}
+            self.error_versions[split]=self.discriminator_version
+        return self.error_mappings[split]
+
+    @torch.no_grad()
+    def reconstruction_errors(self, activations):
+        # per-sample mean squared reconstruction error of a (B, C, H, W) batch
+        x=activations.to(self.device)
+        return (self.discriminator(x)-x).pow(2).flatten(1).mean(dim=1)
+
+    def score_kv(self, split='train', batch_size=256):
+        """
+        fills the error column of the train / test kv store, only activations
+        without a current error (new keys, refreshed keys or a changed
+        discriminator) go through the discriminator
+        """
+        activations=self.activation_mappings if split=='train' else self.test_activation_mappings
+        errors=self._error_store(split)
+        missing=[key for key in activations if key not in errors]
+        self.discriminator.eval()
+        for i in range(0, len(missing), batch_size):
+            keys=missing[i:i+batch_size]
+            batch=torch.from_numpy(np.stack([activations[key] for key in keys]))
+            errors.update(zip(keys, self.reconstruction_errors(batch).cpu().tolist()))
+        return errors
+
+    def lookup_errors(self, keys, activations, split='main_test'):
+        """
+        reconstruction errors of a batch of (keys, activations), stored errors
+        are looked up, only unseen keys are scored
+        """
+        errors=self._error_store(split)
+        missing=[i for i, key in enumerate(keys) if key not in errors]
+        if missing:
+            scored=self.reconstruction_errors(activations[missing]).cpu().tolist()
+            errors.update((keys[i], e) for i, e in zip(missing, scored))
+        return torch.tensor([errors[key] for key in keys], device=activations.device)
+
     def forward_center_front_test(self):
         if self.kv_test_flag==1:
             #print("Size of remote_activations1:", self.remote_activations1.size())
@@ -157,6 +177,7 @@ class ConnectedClient(object):
             for i in range(0, len(self.test_batchkeys)):
                 #print(self.test_batchkeys[i])
                 self.test_activation_mappings[self.test_batchkeys[i]]=local_middle_activations[i]
+                self.error_mappings['test'].pop(self.test_batchkeys[i], None)
             
         else:
             # Ensure all keys in batchkeys exist in activation_mappings
@@ -39,10 +39,12 @@ from torch.optim.lr_scheduler import CosineAnnealingWarmRestarts
 
 # discriminator model
 from .models.discriminator import Discriminator
+from .ic_discriminator import BatchedDiscriminatorTrainer, calibrate_threshold, stack_kv
 
 
 #plot
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import seaborn as sns
 import pandas as pd
 from collections import Counter
@@ -52,6 +54,8 @@ from utils.random_clients_generator import generate_random_clients
 from utils.connections import send_object
 from utils.argparser import parse_arguments
 from utils.merge import merge_weights
+from utils.logger import MetricsSink
+from utils.checkpoint import CheckpointWriter, ModelSnapshots
 from ImageClassification_Task.cifarbuilder import CIFAR10DataBuilder
 from ImageClassification_Task.ic_client import Client
 from ImageClassification_Task.ic_server import ConnectedClient
@@ -79,7 +83,6 @@ class ICTrainer:
         initialize PFSL clients: (id, class: Client)
         along with their individual data based on Flamby splits
         """
-        assert self.args.number_of_clients <= 10, 'max clients for isic is 6'
         self.num_clients = self.args.number_of_clients if not self.pooling_mode else 1
         self.clients = generate_random_clients(self.num_clients,Client)
         if self.pooling_mode:
@@ -100,15 +103,13 @@ class ICTrainer:
             print(f"client {c_id} -> #train {len(train_ds)} #valid: {len(test_ds)} #test: {len(main_test_ds)}")
             client.create_DataLoader(
                 self.train_batch_size,
-                self.test_batch_size
+                self.test_batch_size,
+                batch_transforms=self.cifar_builder.get_batch_transforms()
             )
-            try:
-                train_class_counts = Counter(item['label'].item() for item in train_ds)
-                test_class_counts = Counter(item['label'].item() for item in test_ds)
-                main_test_class_counts = Counter(item['label'].item() for item in main_test_ds)
-            except KeyError as e:
-                print(f"KeyError: {e} not found in dataset items. Inspecting item structure for alternative keys or attributes...")
-                raise
+            # label arrays only, no __getitem__ (PIL, resize, normalize) per image
+            train_class_counts = self.class_counts(train_ds)
+            test_class_counts = self.class_counts(test_ds)
+            main_test_class_counts = self.class_counts(main_test_ds)
             
             # Calculate class proportions
             def calculate_proportions(class_counts):
@@ -138,19 +139,40 @@ class ICTrainer:
             #print(f"  Main Test: {main_test_class_counts}")
         print(f'generated {self.num_clients} clients with data')
         
-        # Convert data to DataFrame
-        df = pd.DataFrame(data)
-        # Plotting
-        plt.figure(figsize=(14, 8))
-        sns.scatterplot(data=df, x='client', y='class', size='frequency', hue='dataset', sizes=(20, 200), alpha=0.6, palette='muted')
-        #sns.scatterplot(data=df, x='client', y='class')
-        plt.title('Class Distribution per Client')
-        plt.xlabel('Client')
-        plt.ylabel('Class')
-        plt.legend(title='Dataset')
-        plt.grid(True)
-        plt.savefig('class_distribution_plot.png')
-        plt.show()
+        # rendered in the background, training does not wait for the plot
+        self.plot_thread = threading.Thread(
+            target=self.plot_class_distribution,
+            args=(pd.DataFrame(data),),
+            name='class-distribution-plot'
+        )
+        self.plot_thread.start()
+
+
+    def class_counts(self, dataset):
+        """
+        - class -> #samples from the dataset's label accessor
+        - falls back to iterating the dataset for datasets without one
+        """
+        if hasattr(dataset, 'get_labels'):
+            labels, counts = np.unique(dataset.get_labels(), return_counts=True)
+            return Counter(dict(zip(labels.tolist(), counts.tolist())))
+        return Counter(item['label'].item() for item in dataset)
+
+
+    def plot_class_distribution(self, df, path='class_distribution_plot.png'):
+        """
+        - scatter of the per client train class frequencies, saved to path
+        - uses a standalone Figure (not pyplot), safe off the main thread
+        """
+        fig = Figure(figsize=(14, 8))
+        ax = fig.subplots()
+        sns.scatterplot(data=df, x='client', y='class', size='frequency', hue='dataset', sizes=(20, 200), alpha=0.6, palette='muted', ax=ax)
+        ax.set_title('Class Distribution per Client')
+        ax.set_xlabel('Client')
+        ax.set_ylabel('Class')
+        ax.legend(title='Dataset')
+        ax.grid(True)
+        fig.savefig(path)
 
 
     def init_client_models_optims(self, input_channels=1):
@@ -227,8 +249,6 @@ class ICTrainer:
             try:
                 discriminator = Discriminator().to(self.device)
                 sc_client.discriminator = discriminator
-                sc_client.discriminator_loss_fn = nn.MSELoss()
-                sc_client.discriminator_optimizer = Adam(sc_client.discriminator.parameters(), lr=0.001, betas=(0.9, 0.999))
             except AttributeError as e:
                 print(f"Error initializing discriminator model for server copy of client {c_id}: {e}")
             
@@ -471,7 +491,7 @@ class ICTrainer:
                     client.forward_back()
                     client.calculate_loss(mode='train')
                     
-                    wandb.log({'train step loss': client.loss.item()})
+                    self.sink.log_step({'train step loss': client.loss})
                     
                     client.loss.backward()
                     
@@ -489,7 +509,7 @@ class ICTrainer:
                     client.train_f1[-1] += f1 
                     
                     #print("train f1 per iteration: ",iteration,f1)
-                    wandb.log({f'train f1 / iter: client {client_id}':f1.item()})
+                    self.sink.log_step({f'train f1 / iter: client {client_id}':f1})
 
         # calculate per epoch metrics
         bal_accs, f1_macros = [], []
@@ -502,10 +522,10 @@ class ICTrainer:
             bal_acc_client, f1_macro_client = client.get_main_metric(mode='train') 
             bal_accs.append(bal_acc_client)
             f1_macros.append(f1_macro_client)
-            wandb.log({f'train f1 {c_id}': client.train_f1[-1].item()})
-            wandb.log({f'train accuracy {c_id}':bal_acc_client})
-            wandb.log({f'tarin f1 macro {c_id}':f1_macro_client})
-            wandb.log({f'train loss {c_id}': client.train_loss})
+            self.sink.log({f'train f1 {c_id}': client.train_f1[-1]})
+            self.sink.log({f'train accuracy {c_id}':bal_acc_client})
+            self.sink.log({f'tarin f1 macro {c_id}':f1_macro_client})
+            self.sink.log({f'train loss {c_id}': client.train_loss})
             client.train_loss = 0 # reset for next epoch
 
 
@@ -516,55 +536,75 @@ class ICTrainer:
         self.overall_f1['train'][-1] /= self.num_clients
         print("avg train f1 all clients: ", self.overall_f1['train'][-1].item())
         print("avg train accuracy all clients: ", self.overall_acc['train'][-1])
-        wandb.log({'avg train f1 all clients': self.overall_f1['train'][-1].item()})
-        wandb.log({'avg train bal acc all clients': bal_acc})
-        wandb.log({'avg train f1 macro all clients': f1_macro})
-        wandb.log({'avg train loss all clients': avg_loss / self.num_clients})
+        self.sink.log({'avg train f1 all clients': self.overall_f1['train'][-1]})
+        self.sink.log({'avg train bal acc all clients': bal_acc})
+        self.sink.log({'avg train f1 macro all clients': f1_macro})
+        self.sink.log({'avg train loss all clients': avg_loss / self.num_clients})
         self.merge_model_weights(epoch)
         #if not self.pooling_mode:
             # merge model weights (center and back)
             #print()
             #self.merge_model_weights(epoch)
     
-    def train_one_epoch_discriminator(self, epoch):
-        '''
-        In this epoch:
-            -for every batch of data available:
-                - forward the self.middle_activations to the auto encoder for training
-                - back propagate the loss gradient
-                - step the optimizer
-                - calculate the loss metric
-        '''
-        print(f"\n\n Discriminator Phase Training {epoch}..........................................................................................")
-        
-        for client_id, client in tqdm(self.clients.items()):
-            client.iterator = iter(client.train_DataLoader)
-            client.num_iterations = len(client.train_DataLoader)
-            
-            for iteration in tqdm(range(client.num_iterations), desc="Discriminator Phase Training"):
-                client.forward_front_key_value()
-                
-                self.sc_clients[client_id].batchkeys=client.key
-                
-                self.sc_clients[client_id].forward_center_front()
-                self.sc_clients[client_id].forward_discriminator()
-                self.sc_clients[client_id].calculate_discriminator_loss(mode="train")
-                wandb.log({'discriminator step loss': self.sc_clients[client_id].disc_loss.item()})
-                self.sc_clients[client_id].disc_loss.backward()
-                self.sc_clients[client_id].discriminator_step()
-                self.sc_clients[client_id].zero_grad_back()
-            
-        avg_loss = 0
-            
-        for c_id, client in self.clients.items():
-            self.sc_clients[c_id].discriminator_train_loss /= client.num_iterations
-            avg_loss+=self.sc_clients[c_id].discriminator_train_loss
-            # wandb.log({f'train f1 {c_id}': client.train_f1[-1].item()})
-            wandb.log({f'discriminator train loss of discriminator for {c_id}': self.sc_clients[c_id].discriminator_train_loss})
-            self.sc_clients[c_id].discriminator_train_loss = 0
-        
-        wandb.log({f'avg discriminator train loss of clients': avg_loss / self.num_clients})       
-    
+    def train_discriminators(self,):
+        """
+        trains the discriminators of all clients together on the activations already in the kv store
+        - train / validation activations are stacked once per client, no image is loaded again
+        - early stopping on the validation reconstruction loss, at most disc_rounds rounds
+        - every client keeps its best discriminator, its threshold is the best validation loss
+        """
+        print(f"\n\n Discriminator Phase Training..........................................................................................")
+        discriminators = [self.sc_clients[c_id].discriminator for c_id in self.client_ids]
+        trainer = BatchedDiscriminatorTrainer(
+            discriminators,
+            train_kv=[stack_kv(self.sc_clients[c_id].activation_mappings) for c_id in self.client_ids],
+            valid_kv=[stack_kv(self.sc_clients[c_id].test_activation_mappings) for c_id in self.client_ids],
+            device=self.device,
+            batch_size=self.train_batch_size,
+        )
+
+        def log_round(run, train_loss, valid_loss):
+            for i, c_id in enumerate(self.client_ids):
+                self.sink.log({f'discriminator train loss of discriminator for {c_id}': train_loss[i]})
+                self.sink.log({f'Validation loss of {c_id} discriminator': valid_loss[i]})
+            self.sink.log({f'avg discriminator train loss of clients': train_loss.mean()})
+            self.sink.log({'Discriminator validation avg loss of all clients': valid_loss.mean()})
+
+        trainer.fit(max_rounds=self.args.disc_rounds, patience=self.args.disc_patience, log_fn=log_round)
+        for c_id in self.client_ids:
+            self.sc_clients[c_id].discriminator.eval()
+            self.sc_clients[c_id].discriminator_updated()
+
+    @torch.no_grad()
+    def calibrate_thresholds(self,):
+        """
+        sets clients_threshold from the reconstruction errors stored in the kv store
+        - scores only what changed since the last call (new keys / new discriminator weights)
+        - ood_threshold: mean / percentile of the client's validation errors, or the
+          roc threshold against the other clients' validation activations
+        """
+        valid_errors = {}
+        for c_id in self.client_ids:
+            valid_errors[c_id] = np.fromiter(self.sc_clients[c_id].score_kv('test').values(), dtype=np.float64)
+            self.sc_clients[c_id].score_kv('train')
+
+        for c_id in self.client_ids:
+            ood_errors = None
+            if self.args.ood_threshold == 'roc':
+                others = [
+                    torch.from_numpy(np.stack(list(self.sc_clients[o_id].test_activation_mappings.values())))
+                    for o_id in self.client_ids if o_id != c_id
+                ]
+                ood_errors = np.concatenate([
+                    self.sc_clients[c_id].reconstruction_errors(batch).cpu().numpy()
+                    for activations in others for batch in activations.split(256)
+                ]) if others else None
+            self.clients_threshold[c_id] = calibrate_threshold(
+                valid_errors[c_id], ood_errors, method=self.args.ood_threshold, percentile=self.args.ood_percentile
+            )
+            self.sink.log({f'ood threshold {c_id}': self.clients_threshold[c_id]})
+        print(f'>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Thresholds : {self.clients_threshold}')
+
     def train_one_epoch_personalise(self,epoch):
         """
         in this epoch:
@@ -589,14 +629,14 @@ class ICTrainer:
                     client.forward_back_personalise()
                     client.calculate_loss(mode='train')
                     client.loss.backward()
-                    wandb.log({'train step loss': client.loss.item()})
+                    self.sink.log_step({'train step loss': client.loss})
                     client.step_back()
                     client.zero_grad_back()
                     #client.loss.backward()
                     f1=client.calculate_train_metric()
                     client.train_f1[-1] += f1
                     #print("train f1 per iteration: ",iteration,f1)
-                    wandb.log({f'train f1 / iter: client {client_id}':f1.item()})
+                    self.sink.log_step({f'train f1 / iter: client {client_id}':f1})
 
         # calculate per epoch metrics
         bal_accs, f1_macros = [], []
@@ -609,10 +649,10 @@ class ICTrainer:
             bal_acc_client, f1_macro_client = client.get_main_metric(mode='train') 
             bal_accs.append(bal_acc_client)
             f1_macros.append(f1_macro_client)
-            wandb.log({f'train f1 {c_id}': client.train_f1[-1].item()})
-            wandb.log({f'train accuracy {c_id}':bal_acc_client})
-            wandb.log({f'tarin f1 macro {c_id}':f1_macro_client})
-            wandb.log({f'train loss {c_id}': client.train_loss})
+            self.sink.log({f'train f1 {c_id}': client.train_f1[-1]})
+            self.sink.log({f'train accuracy {c_id}':bal_acc_client})
+            self.sink.log({f'tarin f1 macro {c_id}':f1_macro_client})
+            self.sink.log({f'train loss {c_id}': client.train_loss})
             client.train_loss = 0 # reset for next epoch
 
 
@@ -623,10 +663,10 @@ class ICTrainer:
         self.overall_f1['train'][-1] /= self.num_clients
         print("avg train f1 all clients: ", self.overall_f1['train'][-1].item())
         print("avg train accuracy all clients: ", self.overall_acc['train'][-1])
-        wandb.log({'avg train f1 all clients': self.overall_f1['train'][-1].item()})
-        wandb.log({'avg train bal acc all clients': bal_acc})
-        wandb.log({'avg train f1 macro all clients': f1_macro})
-        wandb.log({'avg train loss all clients': avg_loss / self.num_clients})
+        self.sink.log({'avg train f1 all clients': self.overall_f1['train'][-1]})
+        self.sink.log({'avg train bal acc all clients': bal_acc})
+        self.sink.log({'avg train f1 macro all clients': f1_macro})
+        self.sink.log({'avg train loss all clients': avg_loss / self.num_clients})
         
     
     @torch.no_grad()
@@ -653,11 +693,11 @@ class ICTrainer:
                     client.forward_back_personalise_test()
                     #client.forward_front_key_value_test()
                     client.calculate_loss(mode='test')
-                    wandb.log({'Validation step loss': client.loss.item()})
+                    self.sink.log_step({'Validation step loss': client.loss})
                     f1=client.calculate_test_metric()
                     client.test_f1[-1] += f1 
                     #print("validation f1 per iteration: ",iteration,f1)
-                    wandb.log({f'Validation f1 / iter: client {client_id}':f1.item()})
+                    self.sink.log_step({f'Validation f1 / iter: client {client_id}':f1})
                     
         # calculate per epoch metrics
         avg_loss = 0
@@ -671,10 +711,10 @@ class ICTrainer:
             bal_accs.append(bal_acc_client)
             f1_macros.append(f1_macro_client)
             self.overall_f1['test'][-1] += client.test_f1[-1]
-            wandb.log({f'Validation f1 {c_id}': client.test_f1[-1].item()})
-            wandb.log({f'Validation accuracy {c_id}':bal_acc_client})
-            wandb.log({f'Validation macro f1 {c_id}':f1_macro_client})
-            wandb.log({f'Validation loss {c_id}': client.test_loss})
+            self.sink.log({f'Validation f1 {c_id}': client.test_f1[-1]})
+            self.sink.log({f'Validation accuracy {c_id}':bal_acc_client})
+            self.sink.log({f'Validation macro f1 {c_id}':f1_macro_client})
+            self.sink.log({f'Validation loss {c_id}': client.test_loss})
             client.test_loss = 0 # reset for next epoch
 
         # calculate epoch metrics across clients
@@ -684,106 +724,11 @@ class ICTrainer:
         self.overall_f1['test'][-1] /= self.num_clients
         print("validation f1: ", self.overall_f1['test'][-1])
         print("validation acc: ", self.overall_acc['test'][-1])
-        wandb.log({'Validation avg f1 all clients': self.overall_f1['test'][-1].item()})
-        wandb.log({'validation avg accuracy all clients': bal_acc})
-        wandb.log({'Validation avg f1 macro all clients': bal_acc})
-        wandb.log({'Validation avg loss all clients': avg_loss / self.num_clients}) 
+        self.sink.log({'Validation avg f1 all clients': self.overall_f1['test'][-1]})
+        self.sink.log({'validation avg accuracy all clients': bal_acc})
+        self.sink.log({'Validation avg f1 macro all clients': bal_acc})
+        self.sink.log({'Validation avg loss all clients': avg_loss / self.num_clients}) 
 
-    @torch.no_grad()
-    def test_one_epoch_disc(self, epoch):
-        """
-        in this epoch:
-            - for every batch of data available:
-                - forward center_back model of server
-                - forward back model of client
-                - calculate batch metric
-
-            - calculate epoch metric per client
-            - calculate epoch metric avg. for all clients
-        """
-
-        num_iters = self.create_iters(dl='test')
-        #self.overall_f1['test'].append(0)
-        #self.overall_acc['test'].append(0)
-
-        #for c_id, client in self.clients.items():
-        #    client.pred = []
-        #    client.y = []
-
-        for client_id, client in tqdm(self.clients.items()):
-                client.num_test_iterations = len(client.test_DataLoader)
-                client.test_iterator = iter(client.test_DataLoader)
-                for iteration in tqdm(range(client.num_test_iterations),desc="Validation"):
-                    client.forward_front_key_value_test()
-                    self.sc_clients[client_id].test_batchkeys = client.test_key
-                    self.sc_clients[client_id].forward_center_front_test()
-                    # added by acs
-                    self.sc_clients[client_id].forward_discriminator_test()
-                    self.sc_clients[client_id].calculate_discriminator_loss(mode="test")
-                    
-                    wandb.log({'discriminator Validation step loss': self.sc_clients[client_id].disc_loss.item()})
-                    
-                    #self.sc_clients[client_id].forward_center_back()
-                    #client.remote_activations2 = self.sc_clients[client_id].remote_activations2
-                    #client.forward_back()
-                    #client.calculate_loss(mode='test')
-                    #wandb.log({'Validation step loss': client.loss.item()})
-                    #f1=client.calculate_test_metric()
-                    #client.test_f1[-1] += f1 
-                    #print("validation f1 per iteration: ",iteration,f1)
-                    #wandb.log({f'Validation f1 / iter: client {client_id}':f1.item()})
-                    
-        # calculate per epoch metrics
-        avg_disc_test_loss = 0
-        #bal_accs,f1_macros = [], []
-        for c_id, client in self.clients.items():
-            #client.test_f1[-1] /= len(client.test_DataLoader)
-            #client.test_loss /= len(client.test_DataLoader)
-            # added by acs
-            self.sc_clients[c_id].discriminator_test_loss /= len(client.test_DataLoader)
-            # calculate remaining metrics
-            avg_disc_test_loss += self.sc_clients[c_id].discriminator_test_loss
-            #bal_acc_client, f1_macro_client = client.get_main_metric(mode='test')
-            #bal_accs.append(bal_acc_client)
-            #f1_macros.append(f1_macro_client)
-            #self.overall_f1['test'][-1] += client.test_f1[-1]
-            #wandb.log({f'Validation f1 {c_id}': client.test_f1[-1].item()})
-            #wandb.log({f'Validation accuracy {c_id}':bal_acc_client})
-            #wandb.log({f'Validation macro f1 {c_id}':f1_macro_client})
-            #wandb.log({f'Validation loss {c_id}': client.test_loss})
-            #added by acs
-            wandb.log({f'Validation loss of {c_id} discriminator': self.sc_clients[c_id].discriminator_test_loss})
-            self.clients_threshold[c_id]=self.sc_clients[c_id].discriminator_test_loss
-            self.sc_clients[c_id].discriminator_test_loss=0
-            
-            #client.test_loss = 0 # reset for next epoch
-        print(f'>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Thresholds : {self.clients_threshold}')  
-        # calculate epoch metrics across clients
-        # bal_acc = np.array(bal_accs).mean()
-        # self.overall_acc['test'][-1]=bal_acc
-        # f1_macro = np.array(f1_macros).mean()
-        # self.overall_f1['test'][-1] /= self.num_clients
-        # print("validation f1: ", self.overall_f1['test'][-1])
-        # print("validation acc: ", self.overall_acc['test'][-1])
-        # wandb.log({'Validation avg f1 all clients': self.overall_f1['test'][-1].item()})
-        # wandb.log({'validation avg accuracy all clients': bal_acc})
-        # wandb.log({'Validation avg f1 macro all clients': bal_acc})
-        wandb.log({'Discriminator validation avg loss of all clients': avg_disc_test_loss / self.num_clients}) 
-        # if self.overall_acc['test'][-1] > self.best_acc:
-        #     print(self.best_acc)
-        #     self.best_acc = self.overall_acc['test'][-1]
-        #     self.best_epoch = epoch
-        #     self.early_stop_counter = 0
-        #     print(f"MAX Validation Accuracy Score: {self.best_acc} @ epoch {self.best_epoch}")
-        #     wandb.log({
-        #         'max validation accuracy score':self.best_acc,
-        #         'max_validation_accuarcy_epoch':self.best_epoch
-        #     })
-        #     return True
-        # else:
-        #     self.early_stop_counter += 1
-        #     return False
-    
     @torch.no_grad()
     def test_one_epoch(self,epoch):
         """
@@ -816,11 +761,11 @@ class ICTrainer:
                     client.remote_activations2 = self.sc_clients[client_id].remote_activations2
                     client.forward_back()
                     client.calculate_loss(mode='test')
-                    wandb.log({'Validation step loss': client.loss.item()})
+                    self.sink.log_step({'Validation step loss': client.loss})
                     f1=client.calculate_test_metric()
                     client.test_f1[-1] += f1 
                     #print("validation f1 per iteration: ",iteration,f1)
-                    wandb.log({f'Validation f1 / iter: client {client_id}':f1.item()})
+                    self.sink.log_step({f'Validation f1 / iter: client {client_id}':f1})
                     
         # calculate per epoch metrics
         avg_loss = 0
@@ -834,10 +779,10 @@ class ICTrainer:
             bal_accs.append(bal_acc_client)
             f1_macros.append(f1_macro_client)
             self.overall_f1['test'][-1] += client.test_f1[-1]
-            wandb.log({f'Validation f1 {c_id}': client.test_f1[-1].item()})
-            wandb.log({f'Validation accuracy {c_id}':bal_acc_client})
-            wandb.log({f'Validation macro f1 {c_id}':f1_macro_client})
-            wandb.log({f'Validation loss {c_id}': client.test_loss})
+            self.sink.log({f'Validation f1 {c_id}': client.test_f1[-1]})
+            self.sink.log({f'Validation accuracy {c_id}':bal_acc_client})
+            self.sink.log({f'Validation macro f1 {c_id}':f1_macro_client})
+            self.sink.log({f'Validation loss {c_id}': client.test_loss})
             client.test_loss = 0 # reset for next epoch
 
         # calculate epoch metrics across clients
@@ -847,17 +792,17 @@ class ICTrainer:
         self.overall_f1['test'][-1] /= self.num_clients
         print("validation f1: ", self.overall_f1['test'][-1])
         print("validation acc: ", self.overall_acc['test'][-1])
-        wandb.log({'Validation avg f1 all clients': self.overall_f1['test'][-1].item()})
-        wandb.log({'validation avg accuracy all clients': bal_acc})
-        wandb.log({'Validation avg f1 macro all clients': bal_acc})
-        wandb.log({'Validation avg loss all clients': avg_loss / self.num_clients}) 
+        self.sink.log({'Validation avg f1 all clients': self.overall_f1['test'][-1]})
+        self.sink.log({'validation avg accuracy all clients': bal_acc})
+        self.sink.log({'Validation avg f1 macro all clients': bal_acc})
+        self.sink.log({'Validation avg loss all clients': avg_loss / self.num_clients}) 
         if self.overall_acc['test'][-1] > self.best_acc:
             print(self.best_acc)
             self.best_acc = self.overall_acc['test'][-1]
             self.best_epoch = epoch
             self.early_stop_counter = 0
             print(f"MAX Validation Accuracy Score: {self.best_acc} @ epoch {self.best_epoch}")
-            wandb.log({
+            self.sink.log({
                 'max validation accuracy score':self.best_acc,
                 'max_validation_accuarcy_epoch':self.best_epoch
             })
@@ -868,73 +813,50 @@ class ICTrainer:
                     
     def save_models(self,epoch):
         """
-        save client-side back and server-side center_back models to disk
+        save client-side back and server-side center_back models (and their optimizers) to disk
+            - host snapshots are written by a background thread (utils/checkpoint.py)
+            - frozen front & center_front are stored once, content-addressed
+            - center_back & back are also kept in memory for load_best_models / inference_new
         """
         print("Save Model at epoch", epoch)
         if self.personalization_mode ==False:
             print("Save Best Model for Generalisation Phase")
             for c_id in self.client_ids:
                 # client-side front model
-                front_state_dict = self.clients[c_id].front_model.state_dict()
-                torch.save(front_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_front.pth')
-                torch.save(self.clients[c_id].front_model, self.save_dir / f'client_{c_id}_{self.args.model}_front_model.pth')
+                self.checkpoints.save(self.clients[c_id].front_model, self.save_dir / f'client_{c_id}_{self.args.model}_front.pth', frozen=True)
                 # server-side center_front model
-                center_front_state_dict = self.sc_clients[c_id].center_front_model.state_dict()
-                torch.save(center_front_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_center_front.pth')
-                torch.save(self.sc_clients[c_id].center_front_model, self.save_dir / f'client_{c_id}_{self.args.model}_center_front_model.pth')
+                self.checkpoints.save(self.sc_clients[c_id].center_front_model, self.save_dir / f'client_{c_id}_{self.args.model}_center_front.pth', frozen=True)
                 # server-side center_back model
-                center_back_state_dict = self.sc_clients[c_id].center_back_model.state_dict()
-                torch.save(center_back_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_center_back.pth')
-                torch.save(self.sc_clients[c_id].center_back_model, self.save_dir / f'client_{c_id}_{self.args.model}_center_back_model.pth')
+                center_back_state_dict = self.best_models.update(f'client_{c_id}_center_back', self.sc_clients[c_id].center_back_model)
+                self.checkpoints.save(center_back_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_center_back.pth', copy=False)
+                self.checkpoints.save(self.sc_clients[c_id].center_optimizer, self.save_dir / f'client_{c_id}_{self.args.model}_center_back_optim.pth')
                 # client-side back model
-                back_state_dict = self.clients[c_id].back_model.state_dict()
-                torch.save(back_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_back.pth')
-                torch.save(self.clients[c_id].back_model, self.save_dir / f'client_{c_id}_{self.args.model}_back_model.pth')
+                back_state_dict = self.best_models.update(f'client_{c_id}_back', self.clients[c_id].back_model)
+                self.checkpoints.save(back_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_back.pth', copy=False)
+                self.checkpoints.save(self.clients[c_id].back_optimizer, self.save_dir / f'client_{c_id}_{self.args.model}_back_optim.pth')
         else:
             for c_id in self.client_ids:
                 print("Save Best Model for Personlalisation Phase")
                 # client-side back model
-                back_state_dict = self.clients[c_id].back_model.state_dict()
-                torch.save(back_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_back_per.pth')
-                torch.save(self.clients[c_id].back_model, self.save_dir / f'client_{c_id}_{self.args.model}_back_per_model.pth')
+                back_state_dict = self.best_models.update(f'client_{c_id}_back_per', self.clients[c_id].back_model)
+                self.checkpoints.save(back_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_back_per.pth', copy=False)
+                self.checkpoints.save(self.clients[c_id].back_optimizer, self.save_dir / f'client_{c_id}_{self.args.model}_back_per_optim.pth')
             
     def load_best_models(self,):
         """
         replaces the latest models with the best models on server and client-side
+            - best center_back/back weights are host snapshots taken in save_models,
+              loaded in place (no split reconstruction, no disk reads)
+            - front & center_front are frozen, the live ones are the best ones
         """
         print("Loaded Best Model")
-
-        model = importlib.import_module(self.import_module)
-
+        back = 'back' if self.personalization_mode == False else 'back_per'
         for c_id in self.client_ids:
-            front = model.front().to(self.device)
-            front_sd = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_front.pth')
-            front.load_state_dict(front_sd)
-            # front = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_front_model.pth').to(self.device)
-            center_front = model.center_front().to(self.device)
-            center_front_sd = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_center_front.pth')
-            center_front.load_state_dict(center_front_sd)
-            # center_front = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_center_front_model.pth').to(self.device)
-            center_back = model.center_back().to(self.device)
-            center_back_sd = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_center_back.pth')
-            center_back.load_state_dict(center_back_sd)
-            # center_back = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_center_back_model.pth').to(self.device)
-            back = model.back().to(self.device)
-            if self.personalization_mode == False:
-                print("Load Best Model for Generalisation Phase")
-                back_sd = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_back.pth')
-                # back = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_back_model.pth').to(self.device)
-            else:
-                print("Load Best Model for Personalisation Phase")
-                back_sd = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_back_per.pth')
-                # back = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_back_per_model.pth').to(self.device)
-            back.load_state_dict(back_sd)
-            
-            self.clients[c_id].front_model = front
-            self.clients[c_id].back_model = back
-            self.sc_clients[c_id].center_front_model = center_front
-            self.sc_clients[c_id].center_back_model = center_back
-            
+            if f'client_{c_id}_center_back' in self.best_models:
+                self.best_models.restore(f'client_{c_id}_center_back', self.sc_clients[c_id].center_back_model)
+            if f'client_{c_id}_{back}' in self.best_models:
+                self.best_models.restore(f'client_{c_id}_{back}', self.clients[c_id].back_model)
+
             self.clients[c_id].front_model.eval()
             self.clients[c_id].back_model.eval()
             self.sc_clients[c_id].center_front_model.eval()
@@ -991,7 +913,7 @@ class ICTrainer:
             total = len(targets)
             accuracy = correct / total
             #bacc = balanced_accuracy_score(targets, preds)
-            wandb.log({
+            self.sink.log({
                 'inference cfm': wandb.plot.confusion_matrix(
                     preds=preds,
                     y_true=targets,
@@ -1001,82 +923,77 @@ class ICTrainer:
 
             print(f'inference score {c_id}: {accuracy}')
             avg_acc+=accuracy
-            wandb.log({f'inference score {c_id}': accuracy})
+            self.sink.log({f'inference score {c_id}': accuracy})
         print(f'Average inference score: {avg_acc/len(self.clients)}')
 
+    def load_back_heads(self, c_id):
+        """
+        - generalised & personalised back of a client, both built once from the
+          in-memory best snapshots (falls back to the live back model)
+        """
+        heads = []
+        for name in (f'client_{c_id}_back', f'client_{c_id}_back_per'):
+            head = copy.deepcopy(self.clients[c_id].back_model)
+            if name in self.best_models:
+                self.best_models.restore(name, head)
+            heads.append(head.eval())
+        return heads
+
+    @torch.no_grad()
     def inference_new(self,):
         '''
-        run inference individually on every data point from main_test_dataset
+        OOD-routed inference on main_test_dataset, batched:
+        - center_front activations once per batch, reconstruction errors are looked up in
+          the error store (only samples never scored by the current discriminator are scored)
+        - samples above the client's threshold go to the generalised back,
+          the rest to the personalised back, results are scattered back in order
         '''
         print('running inference_new on main_test_dataset')
         avg_acc=0
-        # for c_id in tqdm(self.client_ids,desc="Testing_New"):
         
-        # self.load_best_models()
         for idx, (c_id, client) in enumerate(self.clients.items()):
+            sc_client = self.sc_clients[c_id]
+            for m in (client.front_model, sc_client.center_front_model, sc_client.center_back_model, sc_client.discriminator):
+                m.eval()
+            back_generalized, back_personalized = self.load_back_heads(c_id)
+
             trues=[]
             preds=[]
-            generalized=[]
-            personalized=[]
-            c=0
-            c1=0
-            c2=0
-            for data in client.main_test_dataset:
-                c+=1
-                self.sc_clients[c_id].discriminator.eval()
-                image = data['image'].to(self.device)
-                image = torch.unsqueeze(image, 0)
-                label = data['label'].to(self.device)
-                x1 = self.clients[c_id].front_model(image)
-                x2 = self.sc_clients[c_id].center_front_model(x1)
-                
-                reconstruction = self.sc_clients[c_id].discriminator(x2)
-                loss = self.sc_clients[c_id].discriminator_loss_fn(reconstruction, x2)
-                
-                if loss > self.clients_threshold[c_id]:
-                    c1+=1
-                    # print(f"{loss}>{self.clients_threshold[c_id]}")
-                    generalized.append([image, label])
-                else:
-                    c2+=1
-                    # print(f"less")
-                    personalized.append([image, label])
-            print(f'test images in  {c_id} : {c} ; {c1},{c2}')
-            
-            print(f"------------no of data points predicted ood in {c_id}: {len(generalized)}")
-            self.clients[c_id].back_model = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_back_model.pth')
-            for image, label in generalized:
-                x1 = self.clients[c_id].front_model(image)
-                x2 = self.sc_clients[c_id].center_front_model(x1)
-                x3 = self.sc_clients[c_id].center_back_model(x2)
-                x4 = self.clients[c_id].back_model(x3)
-                
-                trues.append(label.cpu())
-                preds.append(x4.cpu())
-            
-            
-            print(f"------------no of data points predicted id in {c_id}: {len(personalized)}")
-            self.clients[c_id].back_model = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_back_per_model.pth')
-            for image, label in personalized:
-                x1 = self.clients[c_id].front_model(image)
-                x2 = self.sc_clients[c_id].center_front_model(x1)
-                x3 = self.sc_clients[c_id].center_back_model(x2)
-                x4 = self.clients[c_id].back_model(x3)
+            n_ood=0
+            n_id=0
+            for batch in client.main_test_DataLoader:
+                image, label = batch['image'].to(self.device), batch['label'].to(self.device)
+                x2 = sc_client.center_front_model(client.front_model(image))
                 
-                trues.append(label.cpu())
-                preds.append(x4.cpu())
-            
-            trues= [torch.unsqueeze(t, 0) for t in trues]
-            preds = torch.cat(preds)
-            targets = torch.cat(trues)
-            #print("Shapes - preds:", preds.shape, "targets:", targets.shape)
-            targets = targets.reshape(-1).numpy()
-            preds = np.argmax(preds.detach().numpy(), axis=1)
+                errors = sc_client.lookup_errors(batch['id'], x2)
+                ood = errors > self.clients_threshold[c_id]
+
+                x3 = sc_client.center_back_model(x2)
+                outputs = None
+                for mask, head in ((ood, back_generalized), (~ood, back_personalized)):
+                    if mask.any():
+                        out = head(x3[mask])
+                        if outputs is None:
+                            outputs = out.new_empty((len(mask), out.shape[1]))
+                        outputs[mask] = out
+
+                n_ood += ood.sum()
+                n_id += (~ood).sum()
+                trues.append(label.reshape(-1))
+                preds.append(outputs.argmax(dim=1))
+
+            n_ood, n_id = int(n_ood), int(n_id)
+            print(f'test images in  {c_id} : {n_ood+n_id} ; {n_ood},{n_id}')
+            print(f"------------no of data points predicted ood in {c_id}: {n_ood}")
+            print(f"------------no of data points predicted id in {c_id}: {n_id}")
+
+            targets = torch.cat(trues).cpu().numpy()
+            preds = torch.cat(preds).cpu().numpy()
             correct = np.sum(preds == targets)
             total = len(targets)
             accuracy = correct / total
             
-            wandb.log({
+            self.sink.log({
                 'inference cfm': wandb.plot.confusion_matrix(
                     preds=preds,
                     y_true=targets,
@@ -1085,7 +1002,7 @@ class ICTrainer:
             })
             
             avg_acc+=accuracy
-            wandb.log({f'inference score {c_id}': accuracy})
+            self.sink.log({f'inference score {c_id}': accuracy})
         print(f'Average inference score: {avg_acc/len(self.clients)}')
     
     def clear_cache(self,):
@@ -1158,7 +1075,7 @@ class ICTrainer:
                 print(f"Early stopping at epoch {epoch}")
                 break
 
-            wandb.log({'epoch':epoch})
+            self.sink.log({'epoch':epoch})
 
             for c_id in self.client_ids:
                 self.clients[c_id].back_model.train()
@@ -1184,14 +1101,10 @@ class ICTrainer:
                     self.early_stop = True
     
             self.clear_cache()
+            self.sink.end_epoch()
         
-        for run in range(60):
-            for c_id in self.client_ids:
-                self.sc_clients[c_id].discriminator.train()
-            self.train_one_epoch_discriminator(run)  # added by acs
-            for c_id in self.client_ids:
-                self.sc_clients[c_id].discriminator.eval()
-            self.test_one_epoch_disc(run)
+        self.train_discriminators()
+        self.calibrate_thresholds()
                     
         #self.load_best_models
         #self.inference()
@@ -1217,8 +1130,11 @@ class ICTrainer:
                 self.clear_cache()
                 self.save_models(epoch)
                 self.inference()
+                self.sink.end_epoch()
         print("**HYBRID INFERENCE**")
         self.inference_new()
+        self.sink.flush()
+        self.checkpoints.wait()
         
     def __init__(self,args):
         """
@@ -1255,10 +1171,21 @@ class ICTrainer:
             mode='online' if self.log_wandb else 'disabled'
         )
 
+        # buffered wandb logging, flushed from a background thread
+        self.sink = MetricsSink(
+            enabled=self.log_wandb,
+            flush_every=self.args.log_every,
+            granularity=self.args.log_granularity
+        )
+
+        # background checkpoint writer & in-memory best models used by save_models
+        self.checkpoints = CheckpointWriter()
+        self.best_models = ModelSnapshots()
+
         self.seed()
 
         #self.isic = ISICDataBuilder()
-        self.cifar_builder = CIFAR10DataBuilder()
+        self.cifar_builder = CIFAR10DataBuilder(num_clients=self.args.number_of_clients)
 
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         #self.device = torch.device("cuda:1" if torch.cuda.is_available() else "cpu")
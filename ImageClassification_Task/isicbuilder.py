@@ -15,6 +15,9 @@ class ISICDataset:
         self.tfms = tfms
     def __len__(self,):
         return len(self.cases)
+    def get_labels(self,):
+        """labels of all cases from the split csv, without loading any image"""
+        return np.array([case['label'] for case in self.cases])
     def __getitem__(self,idx):
         case = self.cases[idx]
         im, label = case['image'], case['label']
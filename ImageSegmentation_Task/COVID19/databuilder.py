@@ -6,6 +6,8 @@ import torch
 from PIL import Image
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
+from utils.partition import repartition_clients
+from utils.image_cache import ImageShardCache
 
 def normalize(img, maxval=255, reshape=False):
     """
@@ -33,16 +35,24 @@ def normalize(img, maxval=255, reshape=False):
 
 
 class COVID19Dataset:
-    def __init__(self,cases,tfms):
+    def __init__(self,cases,tfms,image_cache=None):
         self.cases = cases
         self.tfms = tfms
+        # decoded RGB uint8 shards (utils.image_cache), None decodes the jpeg every time
+        self.image_cache = image_cache
         self.to_torch = A.Compose([ToTensorV2()])
     def __len__(self,):
         return len(self.cases)
+    def get_labels(self,):
+        """labels of all cases from the split csv, without loading any image"""
+        return np.array([case['label'] for case in self.cases])
     def __getitem__(self,idx):
         case = self.cases[idx]
         im, label = case['image'], case['label']
-        im = np.array(Image.open(im).convert('RGB'))
+        if self.image_cache is not None:
+            im = self.image_cache[im]
+        else:
+            im = np.array(Image.open(im).convert('RGB'))
         aug = self.tfms(image=im)
         im = aug['image']
         im = normalize(im)
@@ -54,12 +64,19 @@ class COVID19Dataset:
         }
 
 class Covid19DataBuilder:
-    def __init__(self,):
+    def __init__(self,partition=None,num_clients=None,seed=42,**partition_kwargs):
         self.thresholded_sites_path = Path('./Datasets/COVID19/splits_main.csv').resolve()
         self.thresholded_sites = pd.read_csv(self.thresholded_sites_path)
+        if partition is not None:
+            # synthetic non-IID clients instead of the original sites
+            self.thresholded_sites = repartition_clients(
+                self.thresholded_sites, 'client', 'covid_19', partition, num_clients,
+                group_column='split', seed=seed, **partition_kwargs
+            )
         self.full_data_size = len(self.thresholded_sites)
         self.data_dir = covid19_path
         self.img_size = 224
+        self.image_cache = None
         
 
     def get_client_cases(self,client_id, pool=False):
@@ -102,12 +119,20 @@ class Covid19DataBuilder:
 
         return train_transforms, val_transforms
     
+    def get_image_cache(self,):
+        """decodes every image of the split csv once into RGB uint8 shards at the training resolution"""
+        if self.image_cache is None:
+            paths = [self.data_dir / f"{filename}" for filename in self.thresholded_sites['filename']]
+            self.image_cache = ImageShardCache(Path('./data/shards/covid19'), img_size=self.img_size).build(paths)
+        return self.image_cache
+
     def get_datasets(self,client_id,cache=False,cache_rate=1.0,pool=False):
         train_files, valid_files = self.get_data_dict(client_id,pool)
         train_tfms, val_tfms = self.get_data_transforms()
+        image_cache = self.get_image_cache() if cache else None
     
-        train_ds = COVID19Dataset(cases=train_files,tfms=train_tfms)
-        val_ds = COVID19Dataset(cases=valid_files,tfms=val_tfms)
+        train_ds = COVID19Dataset(cases=train_files,tfms=train_tfms,image_cache=image_cache)
+        val_ds = COVID19Dataset(cases=valid_files,tfms=val_tfms,image_cache=image_cache)
 
         return train_ds, val_ds
 
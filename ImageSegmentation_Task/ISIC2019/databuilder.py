@@ -8,17 +8,27 @@ import albumentations as A
 from albumentations.pytorch import ToTensorV2
 import random
 from sklearn.model_selection import train_test_split
+from utils.partition import repartition_clients
+from utils.image_cache import ImageShardCache
 
 class ISICDataset:
-    def __init__(self,cases,tfms):
+    def __init__(self,cases,tfms,image_cache=None):
         self.cases = cases
         self.tfms = tfms
+        # decoded uint8 shards (utils.image_cache), None decodes the jpeg every time
+        self.image_cache = image_cache
     def __len__(self,):
         return len(self.cases)
+    def get_labels(self,):
+        """labels of all cases from the split csv, without loading any image"""
+        return np.array([case['label'] for case in self.cases])
     def __getitem__(self,idx):
         case = self.cases[idx]
         im, label = case['image'], case['label']
-        im = np.array(Image.open(im))
+        if self.image_cache is not None:
+            im = self.image_cache[im]
+        else:
+            im = np.array(Image.open(im))
         aug = self.tfms(image=im)
         im = aug['image']
         label = torch.tensor([label]).long()
@@ -29,12 +39,19 @@ class ISICDataset:
 
         
 class ISICDataBuilder:
-    def __init__(self,):
+    def __init__(self,partition=None,num_clients=None,seed=42,**partition_kwargs):
         self.thresholded_sites_path = Path('./Datasets/ISIC2019/splits.csv').resolve()
         self.thresholded_sites = pd.read_csv(self.thresholded_sites_path)
+        if partition is not None:
+            # synthetic non-IID clients instead of the Flamby centers
+            self.thresholded_sites = repartition_clients(
+                self.thresholded_sites, 'center', 'target', partition, num_clients,
+                group_column='fold', seed=seed, **partition_kwargs
+            )
         self.full_data_size = len(self.thresholded_sites)
         self.data_dir = isic19_path
         self.img_size = 224
+        self.image_cache = None
         
 
     def get_client_cases(self,client_id, pool=False):
@@ -91,13 +108,21 @@ class ISICDataBuilder:
 
         return train_transforms, val_transforms
     
+    def get_image_cache(self,):
+        """decodes every image of the split csv once into uint8 shards at the training resolution"""
+        if self.image_cache is None:
+            paths = [self.data_dir / (image+'.jpg') for image in self.thresholded_sites['image']]
+            self.image_cache = ImageShardCache(Path('./data/shards/isic2019'), img_size=self.img_size).build(paths)
+        return self.image_cache
+
     def get_datasets(self,client_id,cache=False,cache_rate=1.0,pool=False):
         train_files, valid_files, test_files = self.get_data_dict(client_id,pool)
         train_tfms, val_tfms = self.get_data_transforms()
+        image_cache = self.get_image_cache() if cache else None
         
-        train_ds = ISICDataset(cases=train_files,tfms=train_tfms)
-        val_ds = ISICDataset(cases=valid_files,tfms=val_tfms)
-        test_ds = ISICDataset(cases=test_files,tfms=val_tfms)
+        train_ds = ISICDataset(cases=train_files,tfms=train_tfms,image_cache=image_cache)
+        val_ds = ISICDataset(cases=valid_files,tfms=val_tfms,image_cache=image_cache)
+        test_ds = ISICDataset(cases=test_files,tfms=val_tfms,image_cache=image_cache)
 
         return train_ds, val_ds, test_ds
 
@@ -14,8 +14,7 @@ import numpy as np
 from tqdm.auto import tqdm
 
 # loss and metrics
-from sklearn.metrics import balanced_accuracy_score
-from torchmetrics.functional.classification import f1_score
+from utils.metrics import ConfusionAccumulator
 from ImageSegmentation_Task.ISIC2019.loss_fn import FocalLoss
 
 
@@ -72,10 +71,9 @@ class Client(Thread):
         self.train_f1 = []
         self.test_f1 = []
 
-        self.train_preds = []
-        self.train_targets = []
-        self.test_preds = []
-        self.test_targets = []
+        # on-device streaming metrics, reduced once per epoch in get_main_metric
+        self.train_metric = ConfusionAccumulator(num_classes=8)
+        self.test_metric = ConfusionAccumulator(num_classes=8)
 
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -84,52 +82,15 @@ class Client(Thread):
        
 
 
-    @torch.no_grad()
-    def balanced_accuracy(self,preds,targets):
-        targets = targets.reshape(-1).numpy()
-        preds = np.argmax(preds.numpy(), axis=1)
-        return balanced_accuracy_score(targets, preds)
-    
-    @torch.no_grad()
-    def run_metric(self,preds,targets):
-        return f1_score(
-            preds=torch.argmax(preds,dim=1).float(),
-            target=targets.squeeze(),
-            task='multiclass',
-            num_classes=8
-        )
-    
     @torch.no_grad()
     def get_main_metric(self,mode='train'):
         """
         calculates main metric to use and then resets over epoch
         """
-        if mode=='train':
-            preds = torch.vstack(self.train_preds)
-            targets = torch.vstack(self.train_targets)
-            bal_acc = self.balanced_accuracy(preds, targets)
-            f1_macro = f1_score(
-                preds=torch.argmax(preds,dim=1).float(),
-                target=targets.squeeze(),
-                task='multiclass',
-                num_classes=8,
-                average='macro'
-            ).item()
-            self.train_targets = []
-            self.train_preds = []
-        elif mode=='test':
-            preds = torch.vstack(self.test_preds)
-            targets = torch.vstack(self.test_targets)
-            bal_acc = self.balanced_accuracy(preds, targets)
-            f1_macro = f1_score(
-                preds=torch.argmax(preds,dim=1).float(),
-                target=targets.squeeze(),
-                task='multiclass',
-                num_classes=8,
-                average='macro'
-            ).item()
-            self.test_preds = []
-            self.test_targets = []
+        metric = self.train_metric if mode=='train' else self.test_metric
+        bal_acc = metric.balanced_accuracy()
+        f1_macro = metric.f1_macro()
+        metric.reset()
 
         return bal_acc, f1_macro
 
@@ -155,27 +116,18 @@ class Client(Thread):
         self.loss = self.loss_fn(self.outputs, self.targets.long())
 
         if mode=='train':
-            self.train_loss += self.loss.item()
+            self.train_loss += self.loss.detach()
         elif mode=='test':
-            self.test_loss += self.loss.item()
+            self.test_loss += self.loss.detach()
 
     @torch.no_grad()
     def calculate_train_metric(self):
-        preds = self.outputs
-        targets = self.targets
-        self.train_preds.append(preds.cpu())
-        self.train_targets.append(targets.cpu())
-        f1 = self.run_metric(preds.cpu(),targets.cpu())
-        return f1
+        # batch f1 stays on device, epoch metrics are read from the accumulator
+        return self.train_metric.update(self.outputs, self.targets)
     
     @torch.no_grad()
     def calculate_test_metric(self):
-        preds = self.outputs
-        targets = self.targets
-        self.test_preds.append(preds.cpu())
-        self.test_targets.append(targets.cpu())
-        f1 = self.run_metric(preds.cpu(),targets.cpu())
-        return f1
+        return self.test_metric.update(self.outputs, self.targets)
     
     
     
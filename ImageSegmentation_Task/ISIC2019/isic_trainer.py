@@ -42,6 +42,8 @@ from utils.random_clients_generator import generate_random_clients
 from utils.connections import send_object
 from utils.argparser import parse_arguments
 from utils.merge import merge_weights
+from utils.logger import MetricsSink
+from utils.checkpoint import CheckpointWriter, ModelSnapshots
 from ImageSegmentation_Task.ISIC2019.databuilder import ISICDataBuilder
 from ImageSegmentation_Task.ISIC2019.isic_client import Client
 from ImageSegmentation_Task.ISIC2019.isic_server import ConnectedClient
@@ -74,7 +76,7 @@ class ISICTrainer:
         initialize PFSL clients: (id, class: Client)
         along with their individual data based on Flamby splits
         """
-        assert self.args.number_of_clients <= 6, 'max clients for isic is 6'
+        assert self.args.partition is not None or self.args.number_of_clients <= 6, 'max clients for isic is 6'
         self.num_clients = self.args.number_of_clients if not self.pooling_mode else 1
 
         self.clients = generate_random_clients(self.num_clients,Client)
@@ -88,7 +90,7 @@ class ISICTrainer:
 
         for idx, (c_id, client) in enumerate(self.clients.items()):
 
-            train_ds, test_ds, main_test_ds = self.isic.get_datasets(client_id=idx, pool=self.pooling_mode)
+            train_ds, test_ds, main_test_ds = self.isic.get_datasets(client_id=idx, cache=self.args.cache_images, pool=self.pooling_mode)
 
             client.train_dataset = train_ds
             client.test_dataset = test_ds
@@ -399,7 +401,7 @@ class ISICTrainer:
             for c_id, client in self.clients.items():
                 if num_iters[c_id] != 0:
                     client.calculate_loss(mode='train')
-                    wandb.log({'train step loss': client.loss.item()})
+                    self.sink.log_step({'train step loss': client.loss})
 
             # backprop (back model) in client equivalent for client.backward_back()
             for c_id, client in self.clients.items():
@@ -431,8 +433,7 @@ class ISICTrainer:
                 if num_iters[c_id] != 0:
                     f1=client.calculate_train_metric()
                     client.train_f1[-1] += f1 
-                    print("train f1 per iteration: ", f1)
-                    wandb.log({f'train f1 / iter: client {c_id}':f1.item()})
+                    self.sink.log_step({f'train f1 / iter: client {c_id}':f1})
 
             # reduce num_iters per client by 1
             # training loop will only execute for a client if iters are left 
@@ -452,10 +453,10 @@ class ISICTrainer:
             bal_acc_client, f1_macro_client = client.get_main_metric(mode='train') 
             bal_accs.append(bal_acc_client)
             f1_macros.append(f1_macro_client)
-            wandb.log({f'avg train f1 {c_id}': client.train_f1[-1].item()})
-            wandb.log({f'balanced acc train {c_id}':bal_acc_client})
-            wandb.log({f'f1 macro train {c_id}':f1_macro_client})
-            wandb.log({f'avg train loss {c_id}': client.train_loss})
+            self.sink.log({f'avg train f1 {c_id}': client.train_f1[-1]})
+            self.sink.log({f'balanced acc train {c_id}':bal_acc_client})
+            self.sink.log({f'f1 macro train {c_id}':f1_macro_client})
+            self.sink.log({f'avg train loss {c_id}': client.train_loss})
             client.train_loss = 0 # reset for next epoch
 
 
@@ -464,10 +465,10 @@ class ISICTrainer:
         f1_macro = np.array(f1_macros).mean()
         self.overall_f1['train'][-1] /= self.num_clients
         print("train f1: ", self.overall_f1['train'][-1])
-        wandb.log({'avg train f1 all clients': self.overall_f1['train'][-1].item()})
-        wandb.log({'avg train bal acc all clients': bal_acc})
-        wandb.log({'avg train f1 macro all clients': f1_macro})
-        wandb.log({'avg train loss all clients': avg_loss / self.num_clients})
+        self.sink.log({'avg train f1 all clients': self.overall_f1['train'][-1]})
+        self.sink.log({'avg train bal acc all clients': bal_acc})
+        self.sink.log({'avg train f1 macro all clients': f1_macro})
+        self.sink.log({'avg train loss all clients': avg_loss / self.num_clients})
 
         if not self.pooling_mode:
             # merge model weights (center and back)
@@ -524,15 +525,14 @@ class ISICTrainer:
             for c_id, client in self.clients.items():
                 if num_iters[c_id] != 0:
                     client.calculate_loss(mode='test')
-                    wandb.log({'test step loss': client.loss.item()})
+                    self.sink.log_step({'test step loss': client.loss})
 
             # test f1 of every client in the current epoch in the current batch
             for c_id, client in self.clients.items():
                 if num_iters[c_id] != 0:
                     f1=client.calculate_test_metric()
                     client.test_f1[-1] += f1 
-                    print("test f1 per iteration: ", f1)
-                    wandb.log({f'test f1 / iter: client {c_id}':f1.item()})
+                    self.sink.log_step({f'test f1 / iter: client {c_id}':f1})
 
             # reduce num_iters per client by 1
             # testing loop will only execute for a client if iters are left 
@@ -554,10 +554,10 @@ class ISICTrainer:
             bal_accs.append(bal_acc_client)
             f1_macros.append(f1_macro_client)
             self.overall_f1['test'][-1] += client.test_f1[-1]
-            wandb.log({f'avg test f1 {c_id}': client.test_f1[-1].item()})
-            wandb.log({f'balanced acc test {c_id}':bal_acc_client})
-            wandb.log({f'f1 macro test {c_id}':f1_macro_client})
-            wandb.log({f'avg test loss {c_id}': client.test_loss})
+            self.sink.log({f'avg test f1 {c_id}': client.test_f1[-1]})
+            self.sink.log({f'balanced acc test {c_id}':bal_acc_client})
+            self.sink.log({f'f1 macro test {c_id}':f1_macro_client})
+            self.sink.log({f'avg test loss {c_id}': client.test_loss})
             client.test_loss = 0 # reset for next epoch
 
         # calculate epoch metrics across clients
@@ -565,17 +565,17 @@ class ISICTrainer:
         f1_macro = np.array(f1_macros).mean()
         self.overall_f1['test'][-1] /= self.num_clients
         print("test f1: ", self.overall_f1['test'][-1])
-        wandb.log({'avg test f1 all clients': self.overall_f1['test'][-1].item()})
-        wandb.log({'avg test bal acc all clients': bal_acc})
-        wandb.log({'avg test f1 macro all clients': bal_acc})
-        wandb.log({'avg test loss all clients': avg_loss / self.num_clients})
+        self.sink.log({'avg test f1 all clients': self.overall_f1['test'][-1]})
+        self.sink.log({'avg test bal acc all clients': bal_acc})
+        self.sink.log({'avg test f1 macro all clients': bal_acc})
+        self.sink.log({'avg test loss all clients': avg_loss / self.num_clients})
 
         # max f1 score achieved on test dataset
         if(self.overall_f1['test'][-1]> self.max_f1['f1']):
             self.max_f1['f1']=self.overall_f1['test'][-1]
             self.max_f1['epoch']=epoch
             print(f"MAX test f1 score: {self.max_f1['f1']} @ epoch {self.max_f1['epoch']}")
-            wandb.log({
+            self.sink.log({
                 'max test f1 score':self.max_f1['f1'].item(),
                 'max_test_f1_epoch':self.max_f1['epoch']
             })
@@ -587,48 +587,42 @@ class ISICTrainer:
 
     def save_models(self,):
         """
-        save client-side back and server-side center_back models to disk
+        save client-side back and server-side center_back models (and their optimizers) to disk
+            - host snapshots are written by a background thread (utils/checkpoint.py)
+            - frozen front & center_front are stored once, content-addressed
+            - center_back & back are also kept in memory for load_best_models
         """
         for c_id in self.client_ids:
             # client-side front model
-            front_state_dict = self.clients[c_id].front_model.state_dict()
-            torch.save(front_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_front.pth')
+            self.checkpoints.save(self.clients[c_id].front_model, self.save_dir / f'client_{c_id}_{self.args.model}_front.pth', frozen=True)
             # server-side center_front model
-            center_front_state_dict = self.sc_clients[c_id].center_front_model.state_dict()
-            torch.save(center_front_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_center_front.pth')
+            self.checkpoints.save(self.sc_clients[c_id].center_front_model, self.save_dir / f'client_{c_id}_{self.args.model}_center_front.pth', frozen=True)
             # server-side center_back model
-            center_back_state_dict = self.sc_clients[c_id].center_back_model.state_dict()
-            torch.save(center_back_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_center_back.pth')
+            center_back_state_dict = self.best_models.update(f'client_{c_id}_center_back', self.sc_clients[c_id].center_back_model)
+            self.checkpoints.save(center_back_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_center_back.pth', copy=False)
+            self.checkpoints.save(self.sc_clients[c_id].center_optimizer, self.save_dir / f'client_{c_id}_{self.args.model}_center_back_optim.pth')
             # client-side back model
-            back_state_dict = self.clients[c_id].back_model.state_dict()
-            torch.save(back_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_back.pth')
+            back_state_dict = self.best_models.update(f'client_{c_id}_back', self.clients[c_id].back_model)
+            self.checkpoints.save(back_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_back.pth', copy=False)
+            self.checkpoints.save(self.clients[c_id].back_optimizer, self.save_dir / f'client_{c_id}_{self.args.model}_back_optim.pth')
 
     def load_best_models(self,):
         """
         replaces the latest models with the best models on server and client-side
+            - best center_back/back weights are host snapshots taken in save_models,
+              loaded in place (no split reconstruction, no disk reads)
+            - front & center_front are frozen, the live ones are the best ones
         """
-
-        model = importlib.import_module(self.import_module)
-
         for c_id in self.client_ids:
+            if f'client_{c_id}_center_back' in self.best_models:
+                self.best_models.restore(f'client_{c_id}_center_back', self.sc_clients[c_id].center_back_model)
+            if f'client_{c_id}_back' in self.best_models:
+                self.best_models.restore(f'client_{c_id}_back', self.clients[c_id].back_model)
 
-            front = model.front().to(self.device)
-            front_sd = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_front.pth')
-            front.load_state_dict(front_sd)
-            center_front = model.center_front().to(self.device)
-            center_front_sd = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_center_front.pth')
-            center_front.load_state_dict(center_front_sd)
-            center_back = model.center_back().to(self.device)
-            center_back_sd = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_center_back.pth')
-            center_back.load_state_dict(center_back_sd)
-            back = model.back().to(self.device)
-            back_sd = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_back.pth')
-            back.load_state_dict(back_sd)
-
-            self.clients[c_id].front_model = front
-            self.clients[c_id].back_model = back
-            self.sc_clients[c_id].center_front_model = center_front
-            self.sc_clients[c_id].center_back_model = center_back
+            self.clients[c_id].front_model.eval()
+            self.clients[c_id].back_model.eval()
+            self.sc_clients[c_id].center_front_model.eval()
+            self.sc_clients[c_id].center_back_model.eval()
 
 
     @torch.no_grad()
@@ -662,7 +656,7 @@ class ISICTrainer:
             targets = targets.reshape(-1).numpy()
             preds = np.argmax(preds.numpy(), axis=1)
             bacc = balanced_accuracy_score(targets, preds)
-            wandb.log({
+            self.sink.log({
                 'inference cfm': wandb.plot.confusion_matrix(
                     preds=preds,
                     y_true=targets,
@@ -671,8 +665,9 @@ class ISICTrainer:
             })
 
             print(f'inference score {c_id}: {bacc}')
-            wandb.log({f'inference score {c_id}': bacc})
+            self.sink.log({f'inference score {c_id}': bacc})
 
+        self.sink.flush()
 
     def clear_cache(self,):
         gc.collect()
@@ -716,7 +711,7 @@ class ISICTrainer:
                     self.load_best_models()
                     self.personalize(epoch)
 
-            wandb.log({'epoch':epoch})
+            self.sink.log({'epoch':epoch})
 
             for c_id in self.client_ids:
                 self.clients[c_id].back_model.train()
@@ -735,12 +730,15 @@ class ISICTrainer:
                 self.save_models()
 
             self.clear_cache()
+            self.sink.end_epoch()
 
         # final metrics
         print(f'\n\n\n{"::"*10}BEST METRICS{"::"*10}')
         print("Training Mean f1 Score: ", self.overall_f1['train'][self.max_f1['epoch']])
         print("Maximum Test Mean f1 Score: ", self.max_f1['f1'])
 
+        self.sink.flush()
+        self.checkpoints.wait()
 
 
     def __init__(self,args):
@@ -778,9 +776,26 @@ class ISICTrainer:
             mode='online' if self.log_wandb else 'disabled'
         )
 
+        # buffered wandb logging, flushed from a background thread
+        self.sink = MetricsSink(
+            enabled=self.log_wandb,
+            flush_every=self.args.log_every,
+            granularity=self.args.log_granularity
+        )
+
+        # background checkpoint writer & in-memory best models used by save_models
+        self.checkpoints = CheckpointWriter()
+        self.best_models = ModelSnapshots()
+
         self.seed()
 
-        self.isic = ISICDataBuilder()
+        self.isic = ISICDataBuilder(
+            partition=self.args.partition,
+            num_clients=self.args.number_of_clients,
+            seed=self.args.seed,
+            alpha=self.args.partition_alpha,
+            shards_per_client=self.args.shards_per_client
+        )
 
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
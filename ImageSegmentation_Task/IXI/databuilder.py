@@ -18,6 +18,8 @@ import numpy as np
 from config import ixitiny_path
 import torch
 from sklearn.model_selection import train_test_split
+from utils.volume_cache import PersistentVolumeDataset, split_prefix
+from ImageSegmentation_Task.resample_volumes import ResampledVolumeDataset
 
 class IXIDataBuilder:
     def __init__(self,):
@@ -25,6 +27,11 @@ class IXIDataBuilder:
         self.thresholded_sites = pd.read_csv(self.thresholded_sites_path)
         self.full_data_size = len(self.thresholded_sites)
         self.data_dir = ixitiny_path
+        self.voxel_spacing = (1.5,1.5,2.0)
+        # deterministic prefix (load -> spacing) of every case, see utils.volume_cache
+        self.cache_dir = Path('./data/volumes/IXI')
+        # chunked hdf5 written by ImageSegmentation_Task.resample_volumes
+        self.resampled_dir = Path('./data/resampled/IXI')
         
 
     def get_client_cases(self,client_id, pool=False):
@@ -44,6 +51,11 @@ class IXIDataBuilder:
             } for c in cases
         ]
     
+    def _resampled_paths(self,files):
+        cases = self.thresholded_sites['filename'].to_list()
+        path_of = {str(item['image']): self.resampled_dir/f'{c}.h5' for c, item in zip(cases, self._make_dict(cases))}
+        return [path_of[str(item['image'])] for item in files]
+
     def get_data_dict(self,client_id,pool):
         main_cases, test_cases = self.get_client_cases(client_id,pool)
 
@@ -56,9 +68,10 @@ class IXIDataBuilder:
 
     def get_data_transforms(
             self,
-            voxel_spacing=(1.5,1.5,2.0),
+            voxel_spacing=None,
             spatial_size=(96,96,96)
     ):
+        voxel_spacing = voxel_spacing or self.voxel_spacing
 
         train_transforms = Compose([
             LoadImaged(keys=["image", "label"]),
@@ -110,9 +123,27 @@ class IXIDataBuilder:
 
         return train_transforms, val_transforms
     
-    def get_datasets(self,client_id,cache=False,cache_rate=1.0,pool=False):
+    def get_datasets(self,client_id,cache=False,cache_rate=1.0,pool=False,resampled=False):
         train_files, valid_files, test_files = self.get_data_dict(client_id,pool)
         train_tfms, val_tfms = self.get_data_transforms()
+
+        if resampled:
+            # pre-resampled hdf5, the leading crop only reads the chunks it overlaps
+            prefix, train_tail = split_prefix(train_tfms, Spacingd)
+            _, val_tail = split_prefix(val_tfms, Spacingd)
+            train_ds = ResampledVolumeDataset(self._resampled_paths(train_files), prefix, train_tail)
+            val_ds = ResampledVolumeDataset(self._resampled_paths(valid_files), prefix, val_tail)
+            test_ds = ResampledVolumeDataset(self._resampled_paths(test_files), prefix, val_tail)
+            return train_ds, val_ds, test_ds
+
+        if cache:
+            # load -> spacing cached on disk once per case, crops run online
+            prefix, train_tail = split_prefix(train_tfms, Spacingd)
+            _, val_tail = split_prefix(val_tfms, Spacingd)
+            train_ds = PersistentVolumeDataset(train_files, prefix, train_tail, self.cache_dir)
+            val_ds = PersistentVolumeDataset(valid_files, prefix, val_tail, self.cache_dir)
+            test_ds = PersistentVolumeDataset(test_files, prefix, val_tail, self.cache_dir)
+            return train_ds, val_ds, test_ds
         
         train_ds = Dataset(data=train_files, transform=train_tfms)
         val_ds = Dataset(data=valid_files, transform=val_tfms)
@@ -120,6 +151,21 @@ class IXIDataBuilder:
 
         return train_ds, val_ds, test_ds
 
+    def get_full_test_dataset(self,client_id,cache=False,pool=False,resampled=False):
+        """
+        test cases at full resolution (load -> spacing, no crop) for sliding-window inference
+        """
+        _, test_cases = self.get_client_cases(client_id,pool)
+        test_files = self._make_dict(test_cases)
+        _, val_tfms = self.get_data_transforms()
+        prefix, _ = split_prefix(val_tfms, Spacingd)
+
+        if resampled:
+            return ResampledVolumeDataset(self._resampled_paths(test_files), prefix, None)
+        if cache:
+            return PersistentVolumeDataset(test_files, prefix, None, self.cache_dir)
+        return Dataset(data=test_files, transform=prefix)
+
 
 if __name__ == '__main__':
     ixi = IXIDataBuilder()
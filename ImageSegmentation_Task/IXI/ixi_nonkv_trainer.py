@@ -38,7 +38,12 @@ from torch.optim import AdamW, Adam, SGD
 from utils.random_clients_generator import generate_random_clients
 from utils.connections import send_object
 from utils.argparser import parse_arguments
+from utils.loaders import loader_kwargs
 from utils.merge import merge_weights
+from utils.logger import MetricsSink
+from utils.checkpoint import CheckpointWriter
+from utils.predictions import PredictionSink
+from utils.losses import SegmentationLoss
 from ImageSegmentation_Task.IXI.databuilder import IXIDataBuilder
 from ImageSegmentation_Task.IXI.ixi_client import Client
 from ImageSegmentation_Task.IXI.ixi_server import ConnectedClient
@@ -85,7 +90,7 @@ class IXITrainer:
 
         for idx, (c_id, client) in enumerate(self.clients.items()):
 
-            train_ds, test_ds = self.ixi.get_datasets(client_id=idx, pool=self.pooling_mode)
+            train_ds, test_ds, _ = self.ixi.get_datasets(client_id=idx, cache=self.args.cache_volumes, pool=self.pooling_mode, resampled=self.args.resampled_volumes)
 
             client.train_dataset = train_ds
             client.test_dataset = test_ds
@@ -94,7 +99,8 @@ class IXITrainer:
 
             client.create_DataLoader(
                 self.train_batch_size,
-                self.test_batch_size
+                self.test_batch_size,
+                loader_kwargs=loader_kwargs(self.args)
             )
 
         print(f'generated {self.num_clients} clients with data')
@@ -119,6 +125,8 @@ class IXITrainer:
             
             client.back_model = model.back(pretrained=pretrained).to(self.device)
             client.back_optimizer = AdamW(client.back_model.parameters(), lr=lr)  
+            # persistent loss module, the one-hot target buffer is reused across steps
+            client.criterion = SegmentationLoss(num_classes=2, loss=self.args.seg_loss)
 
         print(f'initialized client-side model splits front&back and their optimizers')
 
@@ -275,7 +283,7 @@ class IXITrainer:
             for c_id, client in self.clients.items():
                 if num_train_iters[c_id] != 0:
                     client.calculate_loss(mode='train')
-                    if self.log_wandb:  wandb.log({'train step loss': client.loss.item()})
+                    self.sink.log_step({'train step loss': client.loss})
 
             # backprop (back model) in client equivalent for client.backward_back()
             for c_id, client in self.clients.items():
@@ -305,9 +313,7 @@ class IXITrainer:
             for c_id, client in self.clients.items():
                 if num_train_iters[c_id] != 0:
                     dice=client.calculate_train_dice_kits()
-                    client.train_dice[-1] += dice 
-                    print("train dice per iteration: ", dice)
-                    if self.log_wandb:  wandb.log({f'train dice / iter: client {c_id}':dice.item()})
+                    self.sink.log_step({f'train dice / iter: client {c_id}':dice})
 
             # reduce num_train_iters per client by 1
             # training loop will only execute for a client if iters are left 
@@ -319,19 +325,19 @@ class IXITrainer:
         avg_loss = 0
         # calculate epoch metrics
         for c_id, client in self.clients.items():
-            client.train_dice[-1] /= len(client.train_DataLoader)
+            client.train_dice[-1] = client.get_epoch_dice(mode='train')
             client.train_loss /= len(client.train_DataLoader)
             avg_loss += client.train_loss
             self.overall_dice['train'][-1] += client.train_dice[-1]
-            if self.log_wandb:  wandb.log({f'avg train dice {c_id}': client.train_dice[-1].item()})
-            if self.log_wandb:  wandb.log({f'avg train loss {c_id}': client.train_loss})
+            self.sink.log({f'avg train dice {c_id}': client.train_dice[-1]})
+            self.sink.log({f'avg train loss {c_id}': client.train_loss})
             client.train_loss = 0 # reset for next epoch
 
         # calculate epoch metrics across clients
         self.overall_dice['train'][-1] /= self.num_clients
         print("train dice: ", self.overall_dice['train'][-1])
-        if self.log_wandb:  wandb.log({'avg train dice all clients': self.overall_dice['train'][-1].item()})
-        if self.log_wandb:  wandb.log({'avg train loss all clients': avg_loss / self.num_clients})
+        self.sink.log({'avg train dice all clients': self.overall_dice['train'][-1]})
+        self.sink.log({'avg train loss all clients': avg_loss / self.num_clients})
 
         if not self.pooling_mode:
             # merge model weights (center and back)
@@ -358,9 +364,10 @@ class IXITrainer:
 
         self.overall_dice['test'].append(0)
 
-        for c_id, client in self.clients.items():
-            client.pred = []
-            client.y = []
+        # optionally keep this epoch's argmax predictions on disk (uint8)
+        if self.args.save_preds:
+            for c_id, client in self.clients.items():
+                client.pred_sink = PredictionSink(self.save_dir / 'predictions' / f'client_{c_id}_epoch{epoch}')
 
         for it in tqdm(range(max_iters)):
 
@@ -398,15 +405,13 @@ class IXITrainer:
             for c_id, client in self.clients.items():
                 if num_test_iters[c_id] != 0:
                     client.calculate_loss(mode='test')
-                    if self.log_wandb:  wandb.log({'test step loss': client.loss.item()})
+                    self.sink.log_step({'test step loss': client.loss})
 
             # test dice of every client in the current epoch in the current batch
             for c_id, client in self.clients.items():
                 if num_test_iters[c_id] != 0:
                     dice=client.calculate_test_dice_kits()
-                    client.test_dice[-1] += dice 
-                    print("test dice per iteration: ", dice)
-                    if self.log_wandb:  wandb.log({f'test dice / iter: client {c_id}':dice.item()})
+                    self.sink.log_step({f'test dice / iter: client {c_id}':dice})
 
             # reduce num_test_iters per client by 1
             # testing loop will only execute for a client if iters are left 
@@ -418,26 +423,29 @@ class IXITrainer:
         avg_loss = 0
         # calculate epoch metrics
         for c_id, client in self.clients.items():
-            client.test_dice[-1] /= len(client.test_DataLoader)
+            client.test_dice[-1] = client.get_epoch_dice(mode='test')
+            if client.pred_sink is not None:
+                client.pred_sink.close()
+                client.pred_sink = None
             client.test_loss /= len(client.test_DataLoader)
             avg_loss += client.test_loss
             self.overall_dice['test'][-1] += client.test_dice[-1]
-            if self.log_wandb:  wandb.log({f'avg test dice {c_id}': client.test_dice[-1].item()})
-            if self.log_wandb:  wandb.log({f'avg test loss {c_id}': client.test_loss})
+            self.sink.log({f'avg test dice {c_id}': client.test_dice[-1]})
+            self.sink.log({f'avg test loss {c_id}': client.test_loss})
             client.test_loss = 0 # reset for next epoch
 
         # calculate epoch metrics across clients
         self.overall_dice['test'][-1] /= self.num_clients
         print("test dice: ", self.overall_dice['test'][-1])
-        if self.log_wandb:  wandb.log({'avg test dice all clients': self.overall_dice['test'][-1].item()})
-        if self.log_wandb:  wandb.log({'avg test loss all clients': avg_loss / self.num_clients})
+        self.sink.log({'avg test dice all clients': self.overall_dice['test'][-1]})
+        self.sink.log({'avg test loss all clients': avg_loss / self.num_clients})
 
         # max dice score achieved on test dataset
         if(self.overall_dice['test'][-1]> self.max_dice['dice']):
             self.max_dice['dice']=self.overall_dice['test'][-1]
             self.max_dice['epoch']=epoch
             print(f"MAX test dice score: {self.max_dice['dice']} @ epoch {self.max_dice['epoch']}")
-            if self.log_wandb:  wandb.log({
+            self.sink.log({
                 'max test dice score':self.max_dice['dice'].item(),
                 'max_test_dice_epoch':self.max_dice['epoch']
             })
@@ -453,22 +461,21 @@ class IXITrainer:
 
     def save_models(self,):
         """
-        save client-side back and server-side center_back models to disk
+        save client-side back and server-side center_back models (and their optimizers) to disk
+            - host snapshots are written by a background thread (utils/checkpoint.py)
+            - frozen front & center_front are stored once, content-addressed
         """
         for c_id in self.client_ids:
             # client-side front model
-            front_state_dict = self.clients[c_id].front_model.state_dict()
-            torch.save(front_state_dict, self.save_dir / f'client_{c_id}_front.pth')
+            self.checkpoints.save(self.clients[c_id].front_model, self.save_dir / f'client_{c_id}_front.pth', frozen=True)
             # server-side center_front model
-            center_front_state_dict = self.sc_clients[c_id].center_front_model.state_dict()
-            torch.save(center_front_state_dict, self.save_dir / f'client_{c_id}_center_front.pth')
+            self.checkpoints.save(self.sc_clients[c_id].center_front_model, self.save_dir / f'client_{c_id}_center_front.pth', frozen=True)
             # server-side center_back model
-            center_back_state_dict = self.sc_clients[c_id].center_front_model.state_dict()
-            torch.save(center_back_state_dict, self.save_dir / f'client_{c_id}_center_back.pth')
+            self.checkpoints.save(self.sc_clients[c_id].center_back_model, self.save_dir / f'client_{c_id}_center_back.pth')
+            self.checkpoints.save(self.sc_clients[c_id].center_optimizer, self.save_dir / f'client_{c_id}_center_back_optim.pth')
             # client-side back model
-            back_state_dict = self.clients[c_id].front_model.state_dict()
-            torch.save(back_state_dict, self.save_dir / f'client_{c_id}_back.pth')
-
+            self.checkpoints.save(self.clients[c_id].back_model, self.save_dir / f'client_{c_id}_back.pth')
+            self.checkpoints.save(self.clients[c_id].back_optimizer, self.save_dir / f'client_{c_id}_back_optim.pth')
 
     def fit(self,):
         """
@@ -487,7 +494,7 @@ class IXITrainer:
                     self.personalization_mode = True
                     self.personalize(epoch)
 
-            if self.log_wandb:  wandb.log({'epoch':epoch})
+            self.sink.log({'epoch':epoch})
 
             for c_id in self.client_ids:
                 self.clients[c_id].back_model.train()
@@ -502,12 +509,16 @@ class IXITrainer:
 
             self.test_one_epoch(epoch)
             self.clear_cache()
+            self.sink.end_epoch()
 
         # final metrics
         print(f'\n\n\n{"::"*40}')
         print("Training Mean Dice Score: ", self.overall_dice['train'][self.max_dice['epoch']])
         print("Maximum Test Mean Dice Score: ", self.max_dice['dice'])
 
+        self.sink.flush()
+        self.checkpoints.wait()
+
         if self.log_wandb:
             self.run.finish()
 
@@ -543,6 +554,16 @@ class IXITrainer:
                 job_type='train'
             )
 
+        # buffered wandb logging, flushed from a background thread
+        self.sink = MetricsSink(
+            enabled=self.log_wandb,
+            flush_every=self.args.log_every,
+            granularity=self.args.log_granularity
+        )
+
+        # background checkpoint writer used by save_models
+        self.checkpoints = CheckpointWriter()
+
         self.seed()
 
         self.ixi = IXIDataBuilder()
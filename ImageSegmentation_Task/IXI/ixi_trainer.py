@@ -40,7 +40,14 @@ import torchmetrics
 from utils.random_clients_generator import generate_random_clients
 from utils.connections import send_object
 from utils.argparser import parse_arguments
+from utils.loaders import loader_kwargs
 from utils.merge import merge_weights, merge_weights_unweighted
+from utils.logger import MetricsSink
+from utils.checkpoint import CheckpointWriter, ModelSnapshots
+from utils.predictions import PredictionSink
+from utils.losses import SegmentationLoss
+from utils.metrics import DiceAccumulator
+from utils.sliding_window import SlidingWindowInferer, split_forward
 from ImageSegmentation_Task.IXI.databuilder import IXIDataBuilder
 from ImageSegmentation_Task.IXI.ixi_client import Client
 from ImageSegmentation_Task.IXI.ixi_server import ConnectedClient
@@ -87,17 +94,20 @@ class IXITrainer:
 
         for idx, (c_id, client) in enumerate(self.clients.items()):
 
-            train_ds, val_ds, test_ds = self.ixi.get_datasets(client_id=idx, pool=self.pooling_mode)
+            train_ds, val_ds, test_ds = self.ixi.get_datasets(client_id=idx, cache=self.args.cache_volumes, pool=self.pooling_mode, resampled=self.args.resampled_volumes)
 
             client.train_dataset = train_ds
             client.test_dataset = val_ds
             client.main_test_dataset = test_ds
+            if self.args.sliding_window:
+                client.full_test_dataset = self.ixi.get_full_test_dataset(client_id=idx, cache=self.args.cache_volumes, pool=self.pooling_mode, resampled=self.args.resampled_volumes)
 
             print(f"client {c_id} -> #train {len(train_ds)} #valid {len(val_ds)} #test: {len(test_ds)}")
 
             client.create_DataLoader(
                 self.train_batch_size,
-                self.test_batch_size
+                self.test_batch_size,
+                loader_kwargs=loader_kwargs(self.args)
             )
 
         print(f'generated {self.num_clients} clients with data')
@@ -115,14 +125,23 @@ class IXITrainer:
         pretrained = self.args.pretrained
         lr = self.args.client_lr
 
+        # frozen & identical for every client: one eval-mode instance referenced by all
+        if self.args.share_frozen:
+            shared_front = model.front(input_channels, pretrained=pretrained).to(self.device)
+
         for c_id, client in self.clients.items():
             client.device = self.device
             
-            client.front_model = model.front(input_channels, pretrained=pretrained).to(self.device)
+            if self.args.share_frozen:
+                client.front_model = shared_front
+            else:
+                client.front_model = model.front(input_channels, pretrained=pretrained).to(self.device)
             client.front_model.eval()
             
             client.back_model = model.back(pretrained=pretrained).to(self.device)
             client.back_optimizer = AdamW(client.back_model.parameters(), lr=lr)
+            # persistent loss module, the one-hot target buffer is reused across steps
+            client.criterion = SegmentationLoss(num_classes=2, loss=self.args.seg_loss)
             client.back_scheduler = ReduceLROnPlateau(client.back_optimizer,mode='min',patience=5,min_lr=1e-8)
             
             
@@ -146,10 +165,17 @@ class IXITrainer:
         for c_id in self.client_ids:
             self.sc_clients[c_id] = ConnectedClient(id=c_id,conn=None)
 
+        # frozen & identical for every client: one eval-mode instance referenced by all
+        if self.args.share_frozen:
+            shared_center_front = model.center_front(pretrained=pretrained).to(self.device)
+
         for c_id, sc_client in self.sc_clients.items():
             sc_client.device = self.device
             
-            sc_client.center_front_model = model.center_front(pretrained=pretrained).to(self.device)
+            if self.args.share_frozen:
+                sc_client.center_front_model = shared_center_front
+            else:
+                sc_client.center_front_model = model.center_front(pretrained=pretrained).to(self.device)
             sc_client.center_front_model.eval()
 
             sc_client.center_back_model = model.center_back(pretrained=pretrained).to(self.device)
@@ -170,15 +196,14 @@ class IXITrainer:
         - the client-side forward model and the server-side center_front model are unused after
         the key-value store mappings are generated.
         - the models are rather saved to disk and moved to CPU during runtime to save GPU
+        - saved through the background checkpoint writer, the state is copied to the host first
         """
         for c_id in self.client_ids:
             # client-side front model
-            front_state_dict = self.clients[c_id].front_model.state_dict()
-            torch.save(front_state_dict, self.save_dir / f'client_{c_id}_front.pth')
+            self.checkpoints.save(self.clients[c_id].front_model, self.save_dir / f'client_{c_id}_front.pth', frozen=True)
             self.clients[c_id].front_model.cpu()
             # server-side center_front model
-            center_front_state_dict = self.sc_clients[c_id].center_front_model.state_dict()
-            torch.save(center_front_state_dict, self.save_dir / f'client_{c_id}_center_front.pth')
+            self.checkpoints.save(self.sc_clients[c_id].center_front_model, self.save_dir / f'client_{c_id}_center_front.pth', frozen=True)
             self.sc_clients[c_id].center_front_model.cpu()
 
 
@@ -283,23 +308,26 @@ class IXITrainer:
 
             # select random activation, skip mappings of length=batch_size
             # forward server-side center_front model
-            for c_id, sc_client in self.sc_clients.items():    
-                num_iters = int(ceil(len(sc_client.all_keys) / self.clients[c_id].train_batch_size))
-                for it in range(num_iters):
-                    # key selection
-                    sc_client.current_keys=list(np.random.choice(sc_client.all_keys, min(self.clients[c_id].train_batch_size, len(sc_client.all_keys)), replace=False))
-                    sc_client.update_all_keys()
-                    # choosing activations from client-side and moving them to server-side
-                    self.clients[c_id].activations1=torch.Tensor(np.array([sc_client.activation_mappings[x] for x in sc_client.current_keys])).to(self.device)
-                    self.clients[c_id].remote_activations1=self.clients[c_id].activations1.detach().requires_grad_(True)
-                    sc_client.remote_activations1=self.clients[c_id].remote_activations1
-                    # choosing skips and giving it to the model internally
-                    skips = [sc_client.skip_mappings[i] for i in sc_client.current_keys]
-                    skips = list(zip(*skips))
-                    skips = [torch.Tensor(np.array(skips)).to(self.device) for skips in skips]
-                    sc_client.center_front_model.skips = skips
-                    # forward center_front
-                    sc_client.forward_center_front()
+            if self.args.share_frozen:
+                self.forward_center_front_combined(mode='train')
+            else:
+                for c_id, sc_client in self.sc_clients.items():    
+                    num_iters = int(ceil(len(sc_client.all_keys) / self.clients[c_id].train_batch_size))
+                    for it in range(num_iters):
+                        # key selection
+                        sc_client.current_keys=list(np.random.choice(sc_client.all_keys, min(self.clients[c_id].train_batch_size, len(sc_client.all_keys)), replace=False))
+                        sc_client.update_all_keys()
+                        # choosing activations from client-side and moving them to server-side
+                        self.clients[c_id].activations1=torch.Tensor(np.array([sc_client.activation_mappings[x] for x in sc_client.current_keys])).to(self.device)
+                        self.clients[c_id].remote_activations1=self.clients[c_id].activations1.detach().requires_grad_(True)
+                        sc_client.remote_activations1=self.clients[c_id].remote_activations1
+                        # choosing skips and giving it to the model internally
+                        skips = [sc_client.skip_mappings[i] for i in sc_client.current_keys]
+                        skips = list(zip(*skips))
+                        skips = [torch.Tensor(np.array(skips)).to(self.device) for skips in skips]
+                        sc_client.center_front_model.skips = skips
+                        # forward center_front
+                        sc_client.forward_center_front()
 
         else:
 
@@ -321,22 +349,25 @@ class IXITrainer:
 
             # [TEST] select random activation, skip mappings of length=test_batch_size
             # [TEST] forward server-side center_front model
-            for c_id, sc_client in self.sc_clients.items():
-                for it in range(self.clients[c_id].num_test_iterations):
-                    # key selection
-                    sc_client.current_keys=list(np.random.choice(sc_client.all_keys, min(self.clients[c_id].test_batch_size, len(sc_client.all_keys)), replace=False))
-                    sc_client.update_all_keys()
-                    # choosing activations from client-side and moving them to server-side
-                    self.clients[c_id].activations1=torch.Tensor(np.array([sc_client.test_activation_mappings[x] for x in sc_client.current_keys])).to(self.device)
-                    self.clients[c_id].remote_activations1=self.clients[c_id].activations1.detach().requires_grad_(True)
-                    sc_client.remote_activations1=self.clients[c_id].remote_activations1
-                    # choosing skips and giving it to the model internally
-                    skips = [sc_client.test_skip_mappings[i] for i in sc_client.current_keys]
-                    skips = list(zip(*skips))
-                    skips = [torch.Tensor(np.array(skips)).to(self.device) for skips in skips]
-                    sc_client.center_front_model.skips = skips
-                    # forward center_front
-                    sc_client.forward_center_front_test()
+            if self.args.share_frozen:
+                self.forward_center_front_combined(mode='test')
+            else:
+                for c_id, sc_client in self.sc_clients.items():
+                    for it in range(self.clients[c_id].num_test_iterations):
+                        # key selection
+                        sc_client.current_keys=list(np.random.choice(sc_client.all_keys, min(self.clients[c_id].test_batch_size, len(sc_client.all_keys)), replace=False))
+                        sc_client.update_all_keys()
+                        # choosing activations from client-side and moving them to server-side
+                        self.clients[c_id].activations1=torch.Tensor(np.array([sc_client.test_activation_mappings[x] for x in sc_client.current_keys])).to(self.device)
+                        self.clients[c_id].remote_activations1=self.clients[c_id].activations1.detach().requires_grad_(True)
+                        sc_client.remote_activations1=self.clients[c_id].remote_activations1
+                        # choosing skips and giving it to the model internally
+                        skips = [sc_client.test_skip_mappings[i] for i in sc_client.current_keys]
+                        skips = list(zip(*skips))
+                        skips = [torch.Tensor(np.array(skips)).to(self.device) for skips in skips]
+                        sc_client.center_front_model.skips = skips
+                        # forward center_front
+                        sc_client.forward_center_front_test()
 
         # return skip mappings to client side for back model use
         for c_id in self.client_ids:
@@ -346,6 +377,42 @@ class IXITrainer:
                 self.clients[c_id].test_skip_mappings = self.sc_clients[c_id].test_skip_mappings
 
 
+    def forward_center_front_combined(self, mode='train'):
+        """
+        shared-frozen mode: one center_front serves every client, so the key-value
+        store of all clients is run through it in combined batches of
+        batch_size * num_clients (center_front is frozen & in eval mode, per-sample
+        outputs do not depend on the batch composition)
+        """
+        if mode=='train':
+            activation_attr, skip_attr = 'activation_mappings', 'skip_mappings'
+            batch_size = self.args.batch_size * self.num_clients
+        else:
+            activation_attr, skip_attr = 'test_activation_mappings', 'test_skip_mappings'
+            batch_size = self.args.test_batch_size * self.num_clients
+
+        center_front = self.sc_clients[self.client_ids[0]].center_front_model
+        keys = [(c_id, key) for c_id, sc_client in self.sc_clients.items() for key in getattr(sc_client, activation_attr).keys()]
+
+        for i in tqdm(range(0, len(keys), batch_size), desc='server_center_front (shared)'):
+            batch_keys = keys[i:i+batch_size]
+            # choosing activations and skips of all clients in the combined batch
+            activations = torch.Tensor(np.array([getattr(self.sc_clients[c_id], activation_attr)[key] for c_id, key in batch_keys])).to(self.device)
+            skips = [getattr(self.sc_clients[c_id], skip_attr)[key] for c_id, key in batch_keys]
+            skips = list(zip(*skips))
+            center_front.skips = [torch.Tensor(np.array(skips)).to(self.device) for skips in skips]
+            # forward center_front
+            with torch.no_grad():
+                middle_activations = center_front(activations)
+            local_middle_activations = list(middle_activations.cpu().numpy())
+            local_skips = [list(s.cpu().numpy()) for s in center_front.skips]
+            local_skips = list(zip(*local_skips))
+            # hand the outputs back to the owning client's mappings
+            for j, (c_id, key) in enumerate(batch_keys):
+                getattr(self.sc_clients[c_id], activation_attr)[key] = local_middle_activations[j]
+                getattr(self.sc_clients[c_id], skip_attr)[key] = local_skips[j]
+
+
     def populate_key_value_store(self,):
         """
         - resets key-value store for client and server
@@ -424,7 +491,7 @@ class IXITrainer:
             for c_id, client in self.clients.items():
                 if num_iters[c_id] != 0:
                     client.calculate_loss(mode='train')
-                    wandb.log({'train step loss': client.loss.item()})
+                    self.sink.log_step({'train step loss': client.loss})
 
             # backprop (back model) in client equivalent for client.backward_back()
             for c_id, client in self.clients.items():
@@ -455,9 +522,7 @@ class IXITrainer:
             for c_id, client in self.clients.items():
                 if num_iters[c_id] != 0:
                     dice=client.calculate_train_dice_kits()
-                    client.train_dice[-1] += dice 
-                    print("train dice per iteration: ", dice)
-                    wandb.log({f'train dice / iter: client {c_id}':dice.item()})
+                    self.sink.log_step({f'train dice / iter: client {c_id}':dice})
 
             # reduce num_iters per client by 1
             # training loop will only execute for a client if iters are left 
@@ -469,19 +534,19 @@ class IXITrainer:
         # calculate epoch metrics
         for c_id, client in self.clients.items():
             num_iters = len(client.activation_mappings.keys())
-            client.train_dice[-1] /= int(ceil(num_iters / client.train_batch_size))
+            client.train_dice[-1] = client.get_epoch_dice(mode='train')
             client.train_loss /= int(ceil(num_iters / client.train_batch_size))
             avg_loss += client.train_loss
             self.overall_dice['train'][-1] += client.train_dice[-1]
-            wandb.log({f'avg train dice {c_id}': client.train_dice[-1].item()})
-            wandb.log({f'avg train loss {c_id}': client.train_loss})
+            self.sink.log({f'avg train dice {c_id}': client.train_dice[-1]})
+            self.sink.log({f'avg train loss {c_id}': client.train_loss})
             client.train_loss = 0 # reset for next epoch
 
         # calculate epoch metrics across clients
         self.overall_dice['train'][-1] /= self.num_clients
         print("train dice: ", self.overall_dice['train'][-1])
-        wandb.log({'avg train dice all clients': self.overall_dice['train'][-1].item()})
-        wandb.log({'avg train loss all clients': avg_loss / self.num_clients})
+        self.sink.log({'avg train dice all clients': self.overall_dice['train'][-1]})
+        self.sink.log({'avg train loss all clients': avg_loss / self.num_clients})
 
         if not self.pooling_mode:
             # merge model weights (center and back)
@@ -505,9 +570,10 @@ class IXITrainer:
         max_iters = max(num_iters.values())
         self.overall_dice['test'].append(0)
 
-        for c_id, client in self.clients.items():
-            client.pred = []
-            client.y = []
+        # optionally keep this epoch's argmax predictions on disk (uint8)
+        if self.args.save_preds:
+            for c_id, client in self.clients.items():
+                client.pred_sink = PredictionSink(self.save_dir / 'predictions' / f'client_{c_id}_epoch{epoch}')
 
         # set keys
         for c_id, sc_client in self.sc_clients.items():
@@ -550,15 +616,13 @@ class IXITrainer:
             for c_id, client in self.clients.items():
                 if num_iters[c_id] != 0:
                     client.calculate_loss(mode='test')
-                    wandb.log({'test step loss': client.loss.item()})
+                    self.sink.log_step({'test step loss': client.loss})
 
             # test dice of every client in the current epoch in the current batch
             for c_id, client in self.clients.items():
                 if num_iters[c_id] != 0:
                     dice=client.calculate_test_dice_kits()
-                    client.test_dice[-1] += dice 
-                    print("test dice per iteration: ", dice)
-                    wandb.log({f'test dice / iter: client {c_id}':dice.item()})
+                    self.sink.log_step({f'test dice / iter: client {c_id}':dice})
 
             # reduce num_iters per client by 1
             # testing loop will only execute for a client if iters are left 
@@ -569,7 +633,10 @@ class IXITrainer:
         avg_loss = 0
         # calculate epoch metrics
         for c_id, client in self.clients.items():
-            client.test_dice[-1] /= len(client.test_DataLoader)
+            client.test_dice[-1] = client.get_epoch_dice(mode='test')
+            if client.pred_sink is not None:
+                client.pred_sink.close()
+                client.pred_sink = None
             client.test_loss /= len(client.test_DataLoader)
 
             # step ReduceLROnPlateau
@@ -580,22 +647,22 @@ class IXITrainer:
             # calculate remaining metrics
             avg_loss += client.test_loss
             self.overall_dice['test'][-1] += client.test_dice[-1]
-            wandb.log({f'avg test dice {c_id}': client.test_dice[-1].item()})
-            wandb.log({f'avg test loss {c_id}': client.test_loss})
+            self.sink.log({f'avg test dice {c_id}': client.test_dice[-1]})
+            self.sink.log({f'avg test loss {c_id}': client.test_loss})
             client.test_loss = 0 # reset for next epoch
 
         # calculate epoch metrics across clients
         self.overall_dice['test'][-1] /= self.num_clients
         print("test dice: ", self.overall_dice['test'][-1])
-        wandb.log({'avg test dice all clients': self.overall_dice['test'][-1].item()})
-        wandb.log({'avg test loss all clients': avg_loss / self.num_clients})
+        self.sink.log({'avg test dice all clients': self.overall_dice['test'][-1]})
+        self.sink.log({'avg test loss all clients': avg_loss / self.num_clients})
 
         # max dice score achieved on test dataset
         if(self.overall_dice['test'][-1]> self.max_dice['dice']):
             self.max_dice['dice']=self.overall_dice['test'][-1]
             self.max_dice['epoch']=epoch
             print(f"MAX test dice score: {self.max_dice['dice']} @ epoch {self.max_dice['epoch']}")
-            wandb.log({
+            self.sink.log({
                 'max test dice score':self.max_dice['dice'].item(),
                 'max_test_dice_epoch':self.max_dice['epoch']
             })
@@ -607,90 +674,82 @@ class IXITrainer:
 
     def save_models(self,):
         """
-        save client-side back and server-side center_back models to disk
+        save client-side back and server-side center_back models (and their optimizers) to disk
+            - host snapshots are written by a background thread (utils/checkpoint.py)
+            - frozen front & center_front are stored once, content-addressed
+            - center_back & back are also kept in memory for load_best_models
         """
         for c_id in self.client_ids:
             # client-side front model
-            front_state_dict = self.clients[c_id].front_model.state_dict()
-            torch.save(front_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_front.pth')
+            self.checkpoints.save(self.clients[c_id].front_model, self.save_dir / f'client_{c_id}_{self.args.model}_front.pth', frozen=True)
             # server-side center_front model
-            center_front_state_dict = self.sc_clients[c_id].center_front_model.state_dict()
-            torch.save(center_front_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_center_front.pth')
+            self.checkpoints.save(self.sc_clients[c_id].center_front_model, self.save_dir / f'client_{c_id}_{self.args.model}_center_front.pth', frozen=True)
             # server-side center_back model
-            center_back_state_dict = self.sc_clients[c_id].center_back_model.state_dict()
-            torch.save(center_back_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_center_back.pth')
+            center_back_state_dict = self.best_models.update(f'client_{c_id}_center_back', self.sc_clients[c_id].center_back_model)
+            self.checkpoints.save(center_back_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_center_back.pth', copy=False)
+            self.checkpoints.save(self.sc_clients[c_id].center_optimizer, self.save_dir / f'client_{c_id}_{self.args.model}_center_back_optim.pth')
             # client-side back model
-            back_state_dict = self.clients[c_id].back_model.state_dict()
-            torch.save(back_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_back.pth')
+            back_state_dict = self.best_models.update(f'client_{c_id}_back', self.clients[c_id].back_model)
+            self.checkpoints.save(back_state_dict, self.save_dir / f'client_{c_id}_{self.args.model}_back.pth', copy=False)
+            self.checkpoints.save(self.clients[c_id].back_optimizer, self.save_dir / f'client_{c_id}_{self.args.model}_back_optim.pth')
 
     def load_best_models(self,):
         """
         replaces the latest models with the best models on server and client-side
+            - best center_back/back weights are host snapshots taken in save_models,
+              loaded in place (no split reconstruction, no disk reads)
+            - front & center_front are frozen, the live ones are the best ones
         """
-
-        model = importlib.import_module(self.import_module)
-
         for c_id in self.client_ids:
+            if f'client_{c_id}_center_back' in self.best_models:
+                self.best_models.restore(f'client_{c_id}_center_back', self.sc_clients[c_id].center_back_model)
+            if f'client_{c_id}_back' in self.best_models:
+                self.best_models.restore(f'client_{c_id}_back', self.clients[c_id].back_model)
 
-            front = model.front(input_channels=1,pretrained=True).to(self.device)
-            front_sd = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_front.pth')
-            front.load_state_dict(front_sd)
-            center_front = model.center_front(pretrained=True,skips=[]).to(self.device)
-            center_front_sd = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_center_front.pth')
-            center_front.load_state_dict(center_front_sd)
-            center_back = model.center_back(pretrained=True,skips=[]).to(self.device)
-            center_back_sd = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_center_back.pth')
-            center_back.load_state_dict(center_back_sd)
-            back = model.back(pretrained=True,skips=[]).to(self.device)
-            back_sd = torch.load(self.save_dir / f'client_{c_id}_{self.args.model}_back.pth')
-            back.load_state_dict(back_sd)
-
-            self.clients[c_id].front_model = front
-            self.clients[c_id].back_model = back
-            self.sc_clients[c_id].center_front_model = center_front
-            self.sc_clients[c_id].center_back_model = center_back
+            self.clients[c_id].front_model.eval()
+            self.clients[c_id].back_model.eval()
+            self.sc_clients[c_id].center_front_model.eval()
+            self.sc_clients[c_id].center_back_model.eval()
 
 
     @torch.no_grad()
     def inference(self,):
         """
         run inference on the main test dataset
+            - sliding_window: full-resolution cases, tiled through the split models (utils/sliding_window.py)
+            - otherwise: the center-cropped test volumes
+            - dice is accumulated per batch / case on the device, no predictions are kept
         """
 
         print("RUNNING INFERENCE from the best models on test dataset")
 
         self.load_best_models()
+        inferer = SlidingWindowInferer(
+            patch_size=(96,96,96), # training crop size
+            overlap=self.args.sw_overlap,
+            batch_size=self.args.sw_batch_size
+        ) if self.args.sliding_window else None
 
         for c_id in self.client_ids:
+            models = (
+                self.clients[c_id].front_model,
+                self.sc_clients[c_id].center_front_model,
+                self.sc_clients[c_id].center_back_model,
+                self.clients[c_id].back_model
+            )
+            dice_metric = DiceAccumulator(num_classes=2, ignore_index=0, samplewise=False)
+            loader = self.clients[c_id].full_test_DataLoader if inferer else self.clients[c_id].main_test_DataLoader
 
-            trues = []
-            preds = []
-
-            for batch in self.clients[c_id].main_test_DataLoader:
+            for batch in tqdm(loader, desc=f'inference {c_id}'):
                 image, label = batch['image'].to(self.device), batch['label'].to(self.device)
+                preds = inferer(models, image) if inferer else split_forward(*models, image)
+                dice_metric.update(preds, label)
 
-                x1 = self.clients[c_id].front_model(image)
-                self.sc_clients[c_id].center_front_model.skips = self.clients[c_id].front_model.skips
-                x2 = self.sc_clients[c_id].center_front_model(x1)
-                self.sc_clients[c_id].center_back_model.skips = self.sc_clients[c_id].center_front_model.skips
-                x3 = self.sc_clients[c_id].center_back_model(x2)
-                self.clients[c_id].back_model.skips = self.sc_clients[c_id].center_back_model.skips
-                x4 = self.clients[c_id].back_model(x3)
-
-                trues.append(label.cpu())
-                preds.append(x4.cpu())
-
-            dice = torchmetrics.functional.dice(
-            preds=torch.vstack(preds),
-            target=torch.vstack(trues).long(),
-            zero_division=1e-8,
-            ignore_index=0, # ignore bg
-            num_classes=2
-            )
-
+            dice = dice_metric.compute()
             print(f'inference score {c_id}: {dice.item()}')
-            wandb.log({f'inference score {c_id}': dice.item()})
+            self.sink.log({f'inference score {c_id}': dice})
 
+        self.sink.flush()
 
     def clear_cache(self,):
         gc.collect()
@@ -733,7 +792,7 @@ class IXITrainer:
                     self.personalization_mode = True
                     self.personalize(epoch)
 
-            wandb.log({'epoch':epoch})
+            self.sink.log({'epoch':epoch})
 
             for c_id in self.client_ids:
                 self.clients[c_id].back_model.train()
@@ -752,12 +811,15 @@ class IXITrainer:
                 self.save_models()
 
             self.clear_cache()
+            self.sink.end_epoch()
 
         # final metrics
         print(f'\n\n\n{"::"*10}BEST METRICS{"::"*10}')
         print("Training Mean Dice Score: ", self.overall_dice['train'][self.max_dice['epoch']])
         print("Maximum Test Mean Dice Score: ", self.max_dice['dice'])
 
+        self.sink.flush()
+        self.checkpoints.wait()
 
 
     def __init__(self,args):
@@ -796,6 +858,17 @@ class IXITrainer:
             mode='online' if self.log_wandb else 'disabled'
         )
 
+        # buffered wandb logging, flushed from a background thread
+        self.sink = MetricsSink(
+            enabled=self.log_wandb,
+            flush_every=self.args.log_every,
+            granularity=self.args.log_granularity
+        )
+
+        # background checkpoint writer & in-memory best models used by save_models
+        self.checkpoints = CheckpointWriter()
+        self.best_models = ModelSnapshots()
+
         self.seed()
 
         self.ixi = IXIDataBuilder()
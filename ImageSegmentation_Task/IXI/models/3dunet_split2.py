@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from monai.networks.nets import UNet
 from monai.networks.layers import Norm
+from utils.model_factory import load_pretrained, trainable_copy
 
 """
 PARAMETER COUNTS
@@ -32,9 +33,7 @@ class front(nn.Module):
     def __init__(self,input_channels=1,pretrained=True,skips=[]):
         super().__init__()
 
-        full_model = get_full_model()
-        model_state_dict = torch.load('/media/imroze/A8DCE5B8DCE580C4/Shreyas/medical_split_learning/Datasets/IXI/models/pretrained/model.pt',map_location=torch.device('cpu'))
-        full_model.load_state_dict(model_state_dict)
+        full_model = load_pretrained(get_full_model, '/media/imroze/A8DCE5B8DCE580C4/Shreyas/medical_split_learning/Datasets/IXI/models/pretrained/model.pt')
         full_model = full_model.model
 
         self.res1 = full_model[0]
@@ -57,9 +56,7 @@ class center_front(nn.Module):
     def __init__(self,pretrained=True,skips=[]):
         super().__init__()
         
-        full_model = get_full_model()
-        model_state_dict = torch.load('/media/imroze/A8DCE5B8DCE580C4/Shreyas/medical_split_learning/Datasets/IXI/models/pretrained/model.pt',map_location=torch.device('cpu'))
-        full_model.load_state_dict(model_state_dict)
+        full_model = load_pretrained(get_full_model, '/media/imroze/A8DCE5B8DCE580C4/Shreyas/medical_split_learning/Datasets/IXI/models/pretrained/model.pt')
         full_model = full_model.model
         
         self.res3 = full_model[1].submodule[1].submodule[0]
@@ -81,14 +78,12 @@ class center_back(nn.Module):
     def __init__(self,pretrained=True,skips=[]):
         super().__init__()
         
-        full_model = get_full_model()
-        model_state_dict = torch.load('/media/imroze/A8DCE5B8DCE580C4/Shreyas/medical_split_learning/Datasets/IXI/models/pretrained/model.pt',map_location=torch.device('cpu'))
-        full_model.load_state_dict(model_state_dict)
+        full_model = load_pretrained(get_full_model, '/media/imroze/A8DCE5B8DCE580C4/Shreyas/medical_split_learning/Datasets/IXI/models/pretrained/model.pt', trainable=True)
         full_model = full_model.model
 
-        self.res5 = full_model[1].submodule[1].submodule[1].submodule[1].submodule
-        self.sc_seq = full_model[1].submodule[1].submodule[1].submodule[2]
-        self.sc_seq4 = full_model[1].submodule[1].submodule[2]
+        self.res5 = trainable_copy(full_model[1].submodule[1].submodule[1].submodule[1].submodule)
+        self.sc_seq = trainable_copy(full_model[1].submodule[1].submodule[1].submodule[2])
+        self.sc_seq4 = trainable_copy(full_model[1].submodule[1].submodule[2])
         self.skips = skips
 
     def freeze(self, epoch, pretrained):
@@ -113,13 +108,11 @@ class back(nn.Module):
     def __init__(self,pretrained=True,skips=[]):
         super().__init__()
         
-        full_model = get_full_model()
-        model_state_dict = torch.load('/media/imroze/A8DCE5B8DCE580C4/Shreyas/medical_split_learning/Datasets/IXI/models/pretrained/model.pt',map_location=torch.device('cpu'))
-        full_model.load_state_dict(model_state_dict)
+        full_model = load_pretrained(get_full_model, '/media/imroze/A8DCE5B8DCE580C4/Shreyas/medical_split_learning/Datasets/IXI/models/pretrained/model.pt', trainable=True)
         full_model = full_model.model
 
-        self.sc_seq3 = full_model[1].submodule[2]
-        self.sc_seq2 = full_model[2]
+        self.sc_seq3 = trainable_copy(full_model[1].submodule[2])
+        self.sc_seq2 = trainable_copy(full_model[2])
         self.skips = skips
         
     def forward(self, x):
@@ -1,3 +1,5 @@
+import os
+import random
 import numpy as np
 import pandas as pd
 from pathlib import Path
@@ -6,6 +8,109 @@ import torch
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
 import h5py
+from utils.partition import repartition_clients
+
+class H5Images:
+    """
+    fork-safe reader for an hdf5 image dataset:
+        - the file is opened lazily, once per process (DataLoader workers never
+          inherit the parent's handle)
+        - read(rows) pulls contiguous runs of rows with one slice each
+        - preload(rows) reads the given rows once into shared memory, later
+          reads are served from there for the whole run
+    """
+
+    def __init__(self,path,key='x',default_chunk_rows=256):
+        self.path = str(path)
+        self.key = key
+        self.default_chunk_rows = default_chunk_rows
+        self._chunk_rows = None
+        self.pid = None
+        self.file = None
+        self.x = None
+        self.preloaded_rows = None
+        self.preloaded = None
+
+    def _dataset(self,):
+        if self.pid != os.getpid():
+            self.file = h5py.File(self.path,'r')
+            self.x = self.file[self.key]
+            self.pid = os.getpid()
+        return self.x
+
+    @property
+    def chunk_rows(self,):
+        if self._chunk_rows is None:
+            chunks = self._dataset().chunks
+            self._chunk_rows = chunks[0] if chunks is not None else self.default_chunk_rows
+        return self._chunk_rows
+
+    def preload(self,rows):
+        rows = np.unique(np.asarray(rows,dtype=np.int64))
+        images = self._read_h5(rows)
+        # resolve the chunk layout before the handle is closed
+        self.chunk_rows
+        self.preloaded_rows = rows
+        self.preloaded = torch.from_numpy(images).share_memory_()
+        # the parent's handle is not needed anymore
+        self.close()
+
+    def _read_h5(self,rows):
+        """rows: sorted unique, every contiguous run is read with a single slice"""
+        x = self._dataset()
+        breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+        runs = np.split(rows,breaks)
+        return np.concatenate([x[run[0]:run[-1]+1] for run in runs])
+
+    def read(self,rows):
+        rows = np.asarray(rows,dtype=np.int64)
+        if self.preloaded is not None:
+            return self.preloaded.numpy()[np.searchsorted(self.preloaded_rows,rows)]
+        unique_rows, inverse = np.unique(rows,return_inverse=True)
+        return self._read_h5(unique_rows)[inverse]
+
+    def __getitem__(self,row):
+        return self.read([row])[0]
+
+    def close(self,):
+        if self.file is not None and self.pid == os.getpid():
+            self.file.close()
+        self.pid = self.file = self.x = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pid'] = state['file'] = state['x'] = None
+        return state
+
+
+class ChunkBatchSampler(torch.utils.data.Sampler):
+    """
+    batches of dataset positions whose hdf5 rows come from as few chunks as possible:
+    positions are grouped by chunk (row // chunk_rows), with shuffle the chunk order
+    and the order inside every chunk are shuffled each epoch, then the sequence is
+    cut into batches
+    """
+
+    def __init__(self,rows,chunk_rows,batch_size,shuffle=False):
+        self.rows = np.asarray(rows,dtype=np.int64)
+        self.chunk_rows = chunk_rows
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self,):
+        return (len(self.rows) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self,):
+        order = np.argsort(self.rows,kind='stable')
+        chunks = np.split(order,np.flatnonzero(np.diff(self.rows[order] // self.chunk_rows)) + 1)
+        if self.shuffle:
+            random.shuffle(chunks)
+            for chunk in chunks:
+                np.random.shuffle(chunk)
+        positions = np.concatenate(chunks) if len(chunks) else order
+        for start in range(0,len(positions),self.batch_size):
+            yield positions[start:start+self.batch_size].tolist()
+
 
 class PCamDataset:
     def __init__(self,cases,tfms,h5):
@@ -14,10 +119,13 @@ class PCamDataset:
         self.x = h5
     def __len__(self,):
         return len(self.cases)
-    def __getitem__(self,idx):
-        case = self.cases[idx]
-        im, label = case['image'], case['label']
-        im = self.x[idx]
+    def get_labels(self,):
+        """labels of all cases from the split csv, without loading any image"""
+        return np.array([case['label'] for case in self.cases])
+    def batch_sampler(self,batch_size,shuffle=False):
+        rows = [case['image'] for case in self.cases]
+        return ChunkBatchSampler(rows,self.x.chunk_rows,batch_size,shuffle=shuffle)
+    def _item(self,im,label):
         aug = self.tfms(image=im)
         im = aug['image']
         label = torch.tensor([label]).long()
@@ -25,19 +133,37 @@ class PCamDataset:
             'image': im,
             'label': label
         }
+    def __getitem__(self,idx):
+        case = self.cases[idx]
+        im, label = case['image'], case['label']
+        im = self.x[im]
+        return self._item(im,label)
+    def __getitems__(self,indices):
+        """whole batch with a single read (the DataLoader fetcher uses this when it exists)"""
+        cases = [self.cases[idx] for idx in indices]
+        ims = self.x.read([case['image'] for case in cases])
+        return [self._item(im,case['label']) for im, case in zip(ims,cases)]
 
         
 class PCamDataBuilder:
-    def __init__(self,):
+    def __init__(self,partition=None,num_clients=None,seed=42,preload=False,**partition_kwargs):
         self.train_csv_path = Path('./Datasets/PCam/splits_train_tiny.csv').resolve()
         self.valid_csv_path = Path('./Datasets/PCam/splits_test_tiny.csv').resolve()
         self.train_csv = pd.read_csv(self.train_csv_path)
         self.valid_csv = pd.read_csv(self.valid_csv_path)
+        if partition is not None:
+            # synthetic non-IID clients instead of the hospitals
+            self.train_csv = repartition_clients(self.train_csv, 'hospital', 'tumor_patch', partition, num_clients, seed=seed, **partition_kwargs)
+            self.valid_csv = repartition_clients(self.valid_csv, 'hospital', 'tumor_patch', partition, num_clients, seed=seed + 1, **partition_kwargs)
         self.full_data_size = len(self.train_csv) + len(self.valid_csv)
         self.data_dir = pcam_path
         self.img_size = 224
-        self.train_ims = h5py.File(str(self.data_dir/'training_split.h5'),'r')['x']
-        self.valid_ims = h5py.File(str(self.data_dir/'validation_split.h5'),'r')['x']
+        self.train_ims = H5Images(self.data_dir/'training_split.h5')
+        self.valid_ims = H5Images(self.data_dir/'validation_split.h5')
+        if preload:
+            # only the rows of the (tiny) splits, shared by all clients & workers
+            self.train_ims.preload(self.train_csv['idx'].to_numpy())
+            self.valid_ims.preload(self.valid_csv['idx'].to_numpy())
         
 
     def get_client_cases(self,client_id, pool=False):
@@ -14,8 +14,7 @@ import numpy as np
 from tqdm.auto import tqdm
 
 # loss and metrics
-from torchmetrics.functional.classification import f1_score
-from torchmetrics.functional.classification import binary_auroc
+from utils.metrics import BinaryAccumulator
 
 
 class Client(Thread):
@@ -69,10 +68,9 @@ class Client(Thread):
         self.train_f1 = []
         self.test_f1 = []
 
-        self.train_preds = []
-        self.train_targets = []
-        self.test_preds = []
-        self.test_targets = []
+        # on-device streaming metrics, reduced once per epoch in get_main_metric
+        self.train_metric = BinaryAccumulator()
+        self.test_metric = BinaryAccumulator()
 
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -80,35 +78,14 @@ class Client(Thread):
        
 
 
-    @torch.no_grad()
-    def auroc(self,preds,targets):
-        return binary_auroc(preds=preds,target=targets.long())
-    
-    @torch.no_grad()
-    def run_metric(self,preds,targets):
-        return f1_score(
-            preds=preds,
-            target=targets,
-            task='binary'
-        )
-    
     @torch.no_grad()
     def get_main_metric(self,mode='train'):
         """
         calculates main metric to use and then resets over epoch
         """
-        if mode=='train':
-            preds = torch.vstack(self.train_preds)
-            targets = torch.vstack(self.train_targets)
-            auroc = self.auroc(preds, targets)
-            self.train_targets = []
-            self.train_preds = []
-        elif mode=='test':
-            preds = torch.vstack(self.test_preds)
-            targets = torch.vstack(self.test_targets)
-            auroc = self.auroc(preds, targets)
-            self.test_preds = []
-            self.test_targets = []
+        metric = self.train_metric if mode=='train' else self.test_metric
+        auroc = metric.auroc()
+        metric.reset()
 
         return auroc
 
@@ -133,27 +110,18 @@ class Client(Thread):
         self.loss=self.loss_fn(self.outputs, self.targets)
 
         if mode=='train':
-            self.train_loss += self.loss.item()
+            self.train_loss += self.loss.detach()
         elif mode=='test':
-            self.test_loss += self.loss.item()
+            self.test_loss += self.loss.detach()
 
     @torch.no_grad()
     def calculate_train_metric(self):
-        preds = self.outputs
-        targets = self.targets
-        self.train_preds.append(preds.cpu())
-        self.train_targets.append(targets.cpu())
-        f1 = self.run_metric(preds.cpu(),targets.cpu())
-        return f1
+        # batch f1 stays on device, epoch metrics are read from the accumulator
+        return self.train_metric.update(self.outputs, self.targets)
     
     @torch.no_grad()
     def calculate_test_metric(self):
-        preds = self.outputs
-        targets = self.targets
-        self.test_preds.append(preds.cpu())
-        self.test_targets.append(targets.cpu())
-        f1 = self.run_metric(preds.cpu(),targets.cpu())
-        return f1
+        return self.test_metric.update(self.outputs, self.targets)
     
     
     
@@ -168,17 +136,16 @@ class Client(Thread):
         self.test_batch_size = test_batch_size
         
         # TORCH DATALOADERS
+        # chunk-aligned batches, every batch is read from the h5 file in contiguous runs
         self.train_DataLoader = torch.utils.data.DataLoader(
             self.train_dataset,
-            batch_size=self.train_batch_size,
-            shuffle=True,
+            batch_sampler=self.train_dataset.batch_sampler(self.train_batch_size, shuffle=True),
             num_workers=2,
             pin_memory=True
         )
         self.test_DataLoader = torch.utils.data.DataLoader(
             self.test_dataset,
-            batch_size=self.test_batch_size,
-            shuffle=False,
+            batch_sampler=self.test_dataset.batch_sampler(self.test_batch_size, shuffle=False),
             num_workers=2,
             pin_memory=True
         )
@@ -40,6 +40,8 @@ from utils.random_clients_generator import generate_random_clients
 from utils.connections import send_object
 from utils.argparser import parse_arguments
 from utils.merge import merge_weights
+from utils.logger import MetricsSink
+from utils.checkpoint import CheckpointWriter
 from ImageSegmentation_Task.PCam.databuilder import PCamDataBuilder
 from ImageSegmentation_Task.PCam.pcam_client import Client
 from ImageSegmentation_Task.PCam.pcam_server import ConnectedClient
@@ -72,7 +74,7 @@ class PCamTrainer:
         initialize PFSL clients: (id, class: Client)
         along with their individual data based on Flamby splits
         """
-        assert self.args.number_of_clients <= 2, 'max clients for pcam is 2'
+        assert self.args.partition is not None or self.args.number_of_clients <= 2, 'max clients for pcam is 2'
         self.num_clients = self.args.number_of_clients if not self.pooling_mode else 1
 
         self.clients = generate_random_clients(self.num_clients,Client)
@@ -386,7 +388,7 @@ class PCamTrainer:
             for c_id, client in self.clients.items():
                 if num_iters[c_id] != 0:
                     client.calculate_loss(mode='train')
-                    wandb.log({'train step loss': client.loss.item()})
+                    self.sink.log_step({'train step loss': client.loss})
 
             # backprop (back model) in client equivalent for client.backward_back()
             for c_id, client in self.clients.items():
@@ -416,8 +418,7 @@ class PCamTrainer:
                 if num_iters[c_id] != 0:
                     f1=client.calculate_train_metric()
                     client.train_f1[-1] += f1 
-                    print("train f1 per iteration: ", f1)
-                    wandb.log({f'train f1 / iter: client {c_id}':f1.item()})
+                    self.sink.log_step({f'train f1 / iter: client {c_id}':f1})
 
             # reduce num_iters per client by 1
             # training loop will only execute for a client if iters are left 
@@ -440,9 +441,9 @@ class PCamTrainer:
             self.overall_f1['train'][-1] += client.train_f1[-1]
             AUROC_client = client.get_main_metric(mode='train') 
             AUROCs.append(AUROC_client)
-            wandb.log({f'avg train f1 {c_id}': client.train_f1[-1].item()})
-            wandb.log({f'auroc train {c_id}':AUROC_client})
-            wandb.log({f'avg train loss {c_id}': client.train_loss})
+            self.sink.log({f'avg train f1 {c_id}': client.train_f1[-1]})
+            self.sink.log({f'auroc train {c_id}':AUROC_client})
+            self.sink.log({f'avg train loss {c_id}': client.train_loss})
             client.train_loss = 0 # reset for next epoch
 
 
@@ -450,9 +451,9 @@ class PCamTrainer:
         AUROC = np.array(AUROCs).mean()
         self.overall_f1['train'][-1] /= self.num_clients
         print("train f1: ", self.overall_f1['train'][-1])
-        wandb.log({'avg train f1 all clients': self.overall_f1['train'][-1].item()})
-        wandb.log({'avg train auroc all clients': AUROC})
-        wandb.log({'avg train loss all clients': avg_loss / self.num_clients})
+        self.sink.log({'avg train f1 all clients': self.overall_f1['train'][-1]})
+        self.sink.log({'avg train auroc all clients': AUROC})
+        self.sink.log({'avg train loss all clients': avg_loss / self.num_clients})
 
         if not self.pooling_mode:
             # merge model weights (center and back)
@@ -509,15 +510,14 @@ class PCamTrainer:
             for c_id, client in self.clients.items():
                 if num_iters[c_id] != 0:
                     client.calculate_loss(mode='test')
-                    wandb.log({'test step loss': client.loss.item()})
+                    self.sink.log_step({'test step loss': client.loss})
 
             # test f1 of every client in the current epoch in the current batch
             for c_id, client in self.clients.items():
                 if num_iters[c_id] != 0:
                     f1=client.calculate_test_metric()
                     client.test_f1[-1] += f1 
-                    print("test f1 per iteration: ", f1)
-                    wandb.log({f'test f1 / iter: client {c_id}':f1.item()})
+                    self.sink.log_step({f'test f1 / iter: client {c_id}':f1})
 
             # reduce num_iters per client by 1
             # testing loop will only execute for a client if iters are left 
@@ -538,25 +538,25 @@ class PCamTrainer:
             AUROC_client = client.get_main_metric(mode='test')
             AUROCs.append(AUROC_client)
             self.overall_f1['test'][-1] += client.test_f1[-1]
-            wandb.log({f'avg test f1 {c_id}': client.test_f1[-1].item()})
-            wandb.log({f'auroc test {c_id}':AUROC_client})
-            wandb.log({f'avg test loss {c_id}': client.test_loss})
+            self.sink.log({f'avg test f1 {c_id}': client.test_f1[-1]})
+            self.sink.log({f'auroc test {c_id}':AUROC_client})
+            self.sink.log({f'avg test loss {c_id}': client.test_loss})
             client.test_loss = 0 # reset for next epoch
 
         # calculate epoch metrics across clients
         AUROC = np.array(AUROCs).mean()
         self.overall_f1['test'][-1] /= self.num_clients
         print("test f1: ", self.overall_f1['test'][-1])
-        wandb.log({'avg test f1 all clients': self.overall_f1['test'][-1].item()})
-        wandb.log({'avg test auroc all clients': AUROC})
-        wandb.log({'avg test loss all clients': avg_loss / self.num_clients})
+        self.sink.log({'avg test f1 all clients': self.overall_f1['test'][-1]})
+        self.sink.log({'avg test auroc all clients': AUROC})
+        self.sink.log({'avg test loss all clients': avg_loss / self.num_clients})
 
         # max f1 score achieved on test dataset
         if(self.overall_f1['test'][-1]> self.max_f1['f1']):
             self.max_f1['f1']=self.overall_f1['test'][-1]
             self.max_f1['epoch']=epoch
             print(f"MAX test f1 score: {self.max_f1['f1']} @ epoch {self.max_f1['epoch']}")
-            wandb.log({
+            self.sink.log({
                 'max test f1 score':self.max_f1['f1'].item(),
                 'max_test_f1_epoch':self.max_f1['epoch']
             })
@@ -568,22 +568,21 @@ class PCamTrainer:
 
     def save_models(self,):
         """
-        save client-side back and server-side center_back models to disk
+        save client-side back and server-side center_back models (and their optimizers) to disk
+            - host snapshots are written by a background thread (utils/checkpoint.py)
+            - frozen front & center_front are stored once, content-addressed
         """
         for c_id in self.client_ids:
             # client-side front model
-            front_state_dict = self.clients[c_id].front_model.state_dict()
-            torch.save(front_state_dict, self.save_dir / f'client_{c_id}_front.pth')
+            self.checkpoints.save(self.clients[c_id].front_model, self.save_dir / f'client_{c_id}_front.pth', frozen=True)
             # server-side center_front model
-            center_front_state_dict = self.sc_clients[c_id].center_front_model.state_dict()
-            torch.save(center_front_state_dict, self.save_dir / f'client_{c_id}_center_front.pth')
+            self.checkpoints.save(self.sc_clients[c_id].center_front_model, self.save_dir / f'client_{c_id}_center_front.pth', frozen=True)
             # server-side center_back model
-            center_back_state_dict = self.sc_clients[c_id].center_front_model.state_dict()
-            torch.save(center_back_state_dict, self.save_dir / f'client_{c_id}_center_back.pth')
+            self.checkpoints.save(self.sc_clients[c_id].center_back_model, self.save_dir / f'client_{c_id}_center_back.pth')
+            self.checkpoints.save(self.sc_clients[c_id].center_optimizer, self.save_dir / f'client_{c_id}_center_back_optim.pth')
             # client-side back model
-            back_state_dict = self.clients[c_id].front_model.state_dict()
-            torch.save(back_state_dict, self.save_dir / f'client_{c_id}_back.pth')
-
+            self.checkpoints.save(self.clients[c_id].back_model, self.save_dir / f'client_{c_id}_back.pth')
+            self.checkpoints.save(self.clients[c_id].back_optimizer, self.save_dir / f'client_{c_id}_back_optim.pth')
 
     def clear_cache(self,):
         gc.collect()
@@ -626,7 +625,7 @@ class PCamTrainer:
                     self.personalization_mode = True
                     self.personalize(epoch)
 
-            wandb.log({'epoch':epoch})
+            self.sink.log({'epoch':epoch})
 
             for c_id in self.client_ids:
                 self.clients[c_id].back_model.train()
@@ -645,12 +644,16 @@ class PCamTrainer:
                 self.save_models()
 
             self.clear_cache()
+            self.sink.end_epoch()
 
         # final metrics
         print(f'\n\n\n{"::"*10}BEST METRICS{"::"*10}')
         print("Training Mean f1 Score: ", self.overall_f1['train'][self.max_f1['epoch']])
         print("Maximum Test Mean f1 Score: ", self.max_f1['f1'])
 
+        self.sink.flush()
+        self.checkpoints.wait()
+
         self.run.finish()
 
 
@@ -690,9 +693,26 @@ class PCamTrainer:
             mode='online' if self.log_wandb else 'disabled'
         )
 
+        # buffered wandb logging, flushed from a background thread
+        self.sink = MetricsSink(
+            enabled=self.log_wandb,
+            flush_every=self.args.log_every,
+            granularity=self.args.log_granularity
+        )
+
+        # background checkpoint writer used by save_models
+        self.checkpoints = CheckpointWriter()
+
         self.seed()
 
-        self.pcam = PCamDataBuilder()
+        self.pcam = PCamDataBuilder(
+            partition=self.args.partition,
+            num_clients=self.args.number_of_clients,
+            seed=self.args.seed,
+            preload=self.args.preload_h5,
+            alpha=self.args.partition_alpha,
+            shards_per_client=self.args.shards_per_client
+        )
 
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
@@ -19,6 +19,9 @@ from monai.data.dataset import Dataset, CacheDataset
 import numpy as np
 from config import kits19_path
 from sklearn.model_selection import train_test_split
+from utils.volume_cache import PersistentVolumeDataset, split_prefix
+from ImageSegmentation_Task.resample_volumes import ResampledVolumeDataset
+from utils.augment import BatchRandAffine3D
 
 class KITSDataBuilder:
     def __init__(self,):
@@ -26,6 +29,11 @@ class KITSDataBuilder:
         self.thresholded_sites = pd.read_csv(self.thresholded_sites_path)
         self.full_data_size = len(self.thresholded_sites)
         self.data_dir = kits19_path
+        self.voxel_spacing = (2.90,1.45,1.45)
+        # deterministic prefix (load -> spacing) of every case, see utils.volume_cache
+        self.cache_dir = Path('./data/volumes/kits19')
+        # chunked hdf5 written by ImageSegmentation_Task.resample_volumes
+        self.resampled_dir = Path('./data/resampled/kits19')
         
 
     def get_client_cases(self,client_id, pool=False):
@@ -46,6 +54,11 @@ class KITSDataBuilder:
             } for c in cases
         ]
     
+    def _resampled_paths(self,files):
+        cases = self.thresholded_sites['case_ids'].to_list()
+        path_of = {str(item['image']): self.resampled_dir/f'{c}.h5' for c, item in zip(cases, self._make_dict(cases))}
+        return [path_of[str(item['image'])] for item in files]
+
     def get_data_dict(self,client_id,pool):
         main_cases, test_cases = self.get_client_cases(client_id,pool)
 
@@ -58,10 +71,12 @@ class KITSDataBuilder:
 
     def get_data_transforms(
             self,
-            voxel_spacing=(2.90,1.45,1.45),
+            voxel_spacing=None,
             spatial_size=(96,96,96),
-            is_dynamic=False
+            is_dynamic=False,
+            device_affine=False
     ):
+        voxel_spacing = voxel_spacing or self.voxel_spacing
 
         train_transforms = Compose([
             LoadImaged(keys=["image", "label"]),
@@ -129,6 +144,10 @@ class KITSDataBuilder:
             mode='constant')
         ])
 
+        if device_affine:
+            # RandAffined runs batched on the training device instead, see get_batch_augmentation
+            train_transforms = Compose([t for t in train_transforms.transforms if not isinstance(t, RandAffined)])
+
         if is_dynamic:
             train_transforms = Compose([
                         LoadImaged(keys=["image", "label"]),
@@ -148,6 +167,15 @@ class KITSDataBuilder:
 
         return train_transforms, val_transforms
     
+    def get_batch_augmentation(self,):
+        """same parameter ranges as the RandAffined in get_data_transforms, for a whole batch on the device"""
+        return BatchRandAffine3D(
+            translate_range=(40, 40, 2),
+            rotate_range=(np.pi / 36, np.pi / 36, np.pi / 4),
+            scale_range=(0.15, 0.15, 0.15),
+            padding_mode="border",
+        )
+
     def get_dynamic_transforms(self,):
         return M.Compose([
             M.EnsureChannelFirst(channel_dim=0),
@@ -159,9 +187,27 @@ class KITSDataBuilder:
             )
         ])
     
-    def get_datasets(self,client_id,cache=False,cache_rate=1.0,pool=False,is_dynamic=False):
+    def get_datasets(self,client_id,cache=False,cache_rate=1.0,pool=False,is_dynamic=False,device_affine=False,resampled=False):
         train_files, valid_files, test_files = self.get_data_dict(client_id,pool)
-        train_tfms, val_tfms = self.get_data_transforms(is_dynamic=is_dynamic)
+        train_tfms, val_tfms = self.get_data_transforms(is_dynamic=is_dynamic,device_affine=device_affine)
+
+        if resampled:
+            # pre-resampled hdf5, the leading crop only reads the chunks it overlaps
+            prefix, train_tail = split_prefix(train_tfms, Spacingd)
+            _, val_tail = split_prefix(val_tfms, Spacingd)
+            train_ds = ResampledVolumeDataset(self._resampled_paths(train_files), prefix, train_tail)
+            val_ds = ResampledVolumeDataset(self._resampled_paths(valid_files), prefix, val_tail)
+            test_ds = ResampledVolumeDataset(self._resampled_paths(test_files), prefix, val_tail)
+            return train_ds, val_ds, test_ds
+
+        if cache:
+            # load -> spacing cached on disk once per case, crops / affine run online
+            prefix, train_tail = split_prefix(train_tfms, Spacingd)
+            _, val_tail = split_prefix(val_tfms, Spacingd)
+            train_ds = PersistentVolumeDataset(train_files, prefix, train_tail, self.cache_dir)
+            val_ds = PersistentVolumeDataset(valid_files, prefix, val_tail, self.cache_dir)
+            test_ds = PersistentVolumeDataset(test_files, prefix, val_tail, self.cache_dir)
+            return train_ds, val_ds, test_ds
         
         train_ds = Dataset(data=train_files, transform=train_tfms)
         val_ds = Dataset(data=valid_files, transform=val_tfms)
@@ -169,6 +215,21 @@ class KITSDataBuilder:
 
         return train_ds, val_ds, test_ds
 
+    def get_full_test_dataset(self,client_id,cache=False,pool=False,resampled=False):
+        """
+        test cases at full resolution (load -> spacing, no crop) for sliding-window inference
+        """
+        _, test_cases = self.get_client_cases(client_id,pool)
+        test_files = self._make_dict(test_cases)
+        _, val_tfms = self.get_data_transforms()
+        prefix, _ = split_prefix(val_tfms, Spacingd)
+
+        if resampled:
+            return ResampledVolumeDataset(self._resampled_paths(test_files), prefix, None)
+        if cache:
+            return PersistentVolumeDataset(test_files, prefix, None, self.cache_dir)
+        return Dataset(data=test_files, transform=prefix)
+
 
 
 
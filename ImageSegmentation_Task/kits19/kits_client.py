@@ -10,11 +10,11 @@ import pickle
 import queue
 import struct
 import numpy as np
-import torchmetrics
+from utils.metrics import DiceAccumulator
 
-# monai imports
-from monai.data import DataLoader
-from monai.losses import DiceLoss
+# data loading
+from utils.augment import AugmentedLoader
+from utils.loaders import make_loader
 
 
 
@@ -45,9 +45,11 @@ class Client(Thread):
         self.train_dataset = None
         self.test_dataset = None
         self.main_test_dataset = None
+        self.full_test_dataset = None
         self.train_DataLoader = None
         self.test_DataLoader = None
         self.main_test_DataLoader = None
+        self.full_test_DataLoader = None
         self.socket = None
         self.server_socket = None
         self.train_batch_size = None
@@ -72,25 +74,17 @@ class Client(Thread):
         self.back_scheduler = None
         self.train_dice = []
         self.test_dice = []
+        # on-device streaming dice, reduced once per epoch in get_epoch_dice
+        # (mean of the per-batch dice, as the epoch dice was computed before)
+        self.train_dice_metric = DiceAccumulator(num_classes=3, ignore_index=0, samplewise=True, batch_mean=True)
+        self.test_dice_metric = DiceAccumulator(num_classes=3, ignore_index=0, samplewise=True, batch_mean=True)
+        self.pred_sink = None
         self.front_epsilons = []
         self.front_best_alphas = []
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
        
 
 
-    @torch.no_grad()
-    def compute_dice(self,preds,targets):
-        dice = torchmetrics.functional.dice(
-            preds=preds,
-            target=targets.long(),
-            zero_division=1e-8,
-            mdmc_average='samplewise', # multi-dim multi-class
-            ignore_index=0, # ignore bg
-            num_classes=3
-        )
-        return dice
-
-
     def backward_back(self):
         self.loss.backward()
 
@@ -108,31 +102,39 @@ class Client(Thread):
     def calculate_loss(self, mode='train'):
         """
         loss function to calculate loss for kits
-        dice loss, 3 classes: 0: bg, 1:kidney, 2:tumor
+        dice (or nnUNet dice+ce) loss, 3 classes: 0: bg, 1:kidney, 2:tumor
+        self.criterion is a persistent SegmentationLoss set up by the trainer
         """
-        loss_fn=DiceLoss(to_onehot_y=True,softmax=True)
-        self.loss=loss_fn(self.outputs, self.targets)
+        self.loss=self.criterion(self.outputs, self.targets)
 
         if mode=='train':
-            self.train_loss += self.loss.item()
+            self.train_loss += self.loss.detach()
         elif mode=='test':
-            self.test_loss += self.loss.item()
+            self.test_loss += self.loss.detach()
 
     @torch.no_grad()
     def calculate_train_dice_kits(self):
-        preds = self.outputs
-        targets = self.targets
-        dice_coeff = self.compute_dice(preds.cpu(),targets.cpu())
-        return dice_coeff
+        # batch dice stays on device, the epoch dice is read from the accumulator
+        return self.train_dice_metric.update(self.outputs, self.targets)
     
     @torch.no_grad()
     def calculate_test_dice_kits(self):
         preds = self.outputs
         targets = self.targets
-        self.pred.extend(preds.cpu().detach().numpy().tolist())
-        self.y.extend(targets.cpu().detach().numpy().tolist())
-        dice_coeff = self.compute_dice(preds.cpu(),targets.cpu())
-        return dice_coeff
+        # optional uint8 argmax sink, see utils/predictions.py
+        if self.pred_sink is not None:
+            self.pred_sink.write(preds, targets)
+        return self.test_dice_metric.update(preds, targets)
+
+    @torch.no_grad()
+    def get_epoch_dice(self, mode='train'):
+        """
+        epoch dice from the accumulated counts, resets the accumulator
+        """
+        metric = self.train_dice_metric if mode=='train' else self.test_dice_metric
+        dice = metric.compute()
+        metric.reset()
+        return dice
 
 
 
@@ -141,21 +143,34 @@ class Client(Thread):
         print(f"[*] Client {self.id} connecting to {host}")
 
 
-    def create_DataLoader(self, train_batch_size, test_batch_size):
+    def create_DataLoader(self, train_batch_size, test_batch_size, train_augment=None, loader_kwargs=None):
+        """
+        train_augment: batched on-device augmentation (e.g. BatchRandAffine3D)
+        applied to every training batch after it is moved to the device
+        loader_kwargs: loader backend settings (utils.loaders.loader_kwargs)
+        """
         self.train_batch_size = train_batch_size
         self.test_batch_size = test_batch_size
         
-        # MONAI DATALOADERS
-        self.train_DataLoader = DataLoader(dataset=self.train_dataset,
-                                           batch_size=self.train_batch_size,
-                                           shuffle=True,
-                                           )
-        self.test_DataLoader = DataLoader(dataset=self.test_dataset,
-                                          batch_size=self.test_batch_size,
-                                          )
-        self.main_test_DataLoader = DataLoader(dataset=self.main_test_dataset,
-                                               batch_size=self.test_batch_size,
-                                              )
+        # MONAI DATALOADERS (or the thread pool backend), see utils.loaders
+        loader_kwargs = loader_kwargs or {}
+        self.train_DataLoader = make_loader(self.train_dataset,
+                                            batch_size=self.train_batch_size,
+                                            shuffle=True,
+                                            persistent=True,
+                                            **loader_kwargs)
+        self.test_DataLoader = make_loader(self.test_dataset,
+                                           batch_size=self.test_batch_size,
+                                           **loader_kwargs)
+        self.main_test_DataLoader = make_loader(self.main_test_dataset,
+                                                batch_size=self.test_batch_size,
+                                                **loader_kwargs)
+        # full-resolution volumes differ in shape, one case per batch
+        self.full_test_DataLoader = make_loader(self.full_test_dataset,
+                                                batch_size=1,
+                                                **loader_kwargs)
+        if train_augment is not None:
+            self.train_DataLoader = AugmentedLoader(self.train_DataLoader, train_augment, self.device)
 
     def disconnect_server(self) -> bool:
         if not is_socket_closed(self.socket):
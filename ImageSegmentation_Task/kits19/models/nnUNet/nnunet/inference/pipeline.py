@@ -0,0 +1,316 @@
+#    Copyright 2020 Division of Medical Image Computing, German Cancer Research Center (DKFZ), Heidelberg, Germany
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+import shutil
+from multiprocessing import Process, Queue, Pool
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from time import time
+from typing import Tuple
+
+import numpy as np
+import SimpleITK as sitk
+import torch
+from batchgenerators.augmentations.utils import resize_segmentation
+from batchgenerators.utilities.file_and_folder_operations import *
+from nnunet.inference.segmentation_export import save_segmentation_nifti_from_softmax
+from nnunet.postprocessing.connected_components import load_remove_save, load_postprocessing
+from nnunet.training.model_restore import load_model_and_checkpoint_files
+from nnunet.training.network_training.nnUNetTrainer import nnUNetTrainer
+from nnunet.utilities.one_hot_encoding import to_one_hot
+
+
+"""
+Pipelined inference: preprocessing -> prediction -> export
+
+    preprocessing workers --(preprocessed queue)--> prediction (this process) --(export queue)--> export workers
+
+Arrays never go through a pipe. They are written to shared memory blocks, only a small descriptor
+(block name, shape, dtype) and the properties dict are put on the queues. The consumer of a block unlinks it. This
+also removes the 2 GB pickle limit that required the temporary .npy files in predict_cases.
+
+Both queues are bounded (max_queued). A stage that runs ahead blocks on put, so at most
+max_queued + number of workers cases are alive per queue and memory stays bounded no matter how many cases are
+predicted. Every stage measures how long it was busy, the throughput of each stage is printed at the end.
+"""
+
+
+def _to_shared(array: np.ndarray) -> tuple:
+    array = np.ascontiguousarray(array)
+    shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    shm.close()
+    return shm.name, array.shape, array.dtype.str
+
+
+def _from_shared(descriptor: tuple) -> Tuple[np.ndarray, SharedMemory]:
+    """the array is a view of the block, call _release(shm) once it is no longer needed"""
+    name, shape, dtype = descriptor
+    shm = SharedMemory(name=name)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf), shm
+
+
+def _release(shm: SharedMemory):
+    shm.close()
+    shm.unlink()
+
+
+def _preprocess_worker(preprocess_fn, q_out: Queue, q_stats: Queue, list_of_lists, output_files, segs_from_prev_stage,
+                       classes, transpose_forward):
+    busy = 0.
+    done = 0
+    for l, output_file, seg_prev_file in zip(list_of_lists, output_files, segs_from_prev_stage):
+        try:
+            start = time()
+            d, _, dct = preprocess_fn(l)
+            if seg_prev_file is not None:
+                assert isfile(seg_prev_file) and seg_prev_file.endswith(".nii.gz"), "segs_from_prev_stage must " \
+                                                                                    "point to a segmentation file"
+                seg_prev = sitk.GetArrayFromImage(sitk.ReadImage(seg_prev_file))
+                img = sitk.GetArrayFromImage(sitk.ReadImage(l[0]))
+                assert all([i == j for i, j in zip(seg_prev.shape, img.shape)]), "image and segmentation from " \
+                                                                                 "previous stage don't have the same " \
+                                                                                 "pixel array shape! image: %s, " \
+                                                                                 "seg_prev: %s" % (l[0], seg_prev_file)
+                seg_prev = seg_prev.transpose(transpose_forward)
+                seg_reshaped = resize_segmentation(seg_prev, d.shape[1:], order=1)
+                seg_reshaped = to_one_hot(seg_reshaped, classes)
+                d = np.vstack((d, seg_reshaped)).astype(np.float32)
+            descriptor = _to_shared(d)
+            busy += time() - start
+            done += 1
+            # blocks while the prediction is max_queued cases behind
+            q_out.put((output_file, descriptor, dct))
+        except KeyboardInterrupt:
+            raise KeyboardInterrupt
+        except Exception as e:
+            print("error in", l)
+            print(e)
+    q_stats.put(("preprocessing", done, busy))
+    q_out.put("end")
+
+
+def _export_worker(q_in: Queue, q_stats: Queue):
+    busy = 0.
+    done = 0
+    while True:
+        item = q_in.get()
+        if item == "end":
+            break
+        descriptor, args = item
+        start = time()
+        softmax, shm = _from_shared(descriptor)
+        try:
+            save_segmentation_nifti_from_softmax(softmax, *args)
+            done += 1
+        except Exception as e:
+            print("error exporting", args[0])
+            print(e)
+        finally:
+            del softmax
+            _release(shm)
+        busy += time() - start
+    q_stats.put(("export", done, busy))
+
+
+def _print_stage_stats(stats: dict, wall_time: float):
+    print("stage           cases    busy [s]   cases/s (busy)   utilization")
+    for stage in ("preprocessing", "prediction", "export"):
+        done, busy, workers = stats[stage]
+        rate = done / busy if busy > 0 else float('nan')
+        utilization = busy / (wall_time * workers) if wall_time > 0 else float('nan')
+        print("%-15s %5d %11.1f %16.3f %13.0f%%" % (stage, done, busy, rate, 100 * utilization))
+    print("total: %d cases in %.1f s (%.3f cases/s)" % (stats["export"][0], wall_time,
+                                                       stats["export"][0] / max(wall_time, 1e-8)))
+
+
+def predict_cases_pipelined(model, list_of_lists, output_filenames, folds, save_npz, num_threads_preprocessing,
+                            num_threads_nifti_save, segs_from_prev_stage=None, do_tta=True, mixed_precision=True,
+                            overwrite_existing=False, all_in_gpu=False, step_size=0.5,
+                            checkpoint_name="model_final_checkpoint", segmentation_export_kwargs: dict = None,
+                            disable_postprocessing: bool = False, batch_tiles: bool = False,
+                            tile_memory_budget: float = 2., max_queued: int = 2):
+    """
+    Same arguments and results as predict_cases, but preprocessing, prediction and export run concurrently as a
+    pipeline of bounded stages (see module docstring).
+
+    :param num_threads_preprocessing: number of preprocessing worker processes
+    :param num_threads_nifti_save: number of export worker processes
+    :param max_queued: capacity of the preprocessed and the export queue (in cases)
+    :return: dict stage -> (cases, busy seconds, workers)
+    """
+    assert len(list_of_lists) == len(output_filenames)
+    if segs_from_prev_stage is not None: assert len(segs_from_prev_stage) == len(output_filenames)
+
+    cleaned_output_files = []
+    for o in output_filenames:
+        dr, f = os.path.split(o)
+        if len(dr) > 0:
+            maybe_mkdir_p(dr)
+        if not f.endswith(".nii.gz"):
+            f, _ = os.path.splitext(f)
+            f = f + ".nii.gz"
+        cleaned_output_files.append(join(dr, f))
+
+    if not overwrite_existing:
+        print("number of cases:", len(list_of_lists))
+        not_done_idx = [i for i, j in enumerate(cleaned_output_files) if (not isfile(j)) or (save_npz and not isfile(j[:-7] + '.npz'))]
+
+        cleaned_output_files = [cleaned_output_files[i] for i in not_done_idx]
+        list_of_lists = [list_of_lists[i] for i in not_done_idx]
+        if segs_from_prev_stage is not None:
+            segs_from_prev_stage = [segs_from_prev_stage[i] for i in not_done_idx]
+
+        print("number of cases that still need to be predicted:", len(cleaned_output_files))
+
+    if segs_from_prev_stage is None:
+        segs_from_prev_stage = [None] * len(list_of_lists)
+
+    print("emptying cuda cache")
+    torch.cuda.empty_cache()
+
+    print("loading parameters for folds,", folds)
+    trainer, params = load_model_and_checkpoint_files(model, folds, mixed_precision=mixed_precision,
+                                                      checkpoint_name=checkpoint_name)
+    assert isinstance(trainer, nnUNetTrainer)
+    trainer.network.batch_tiles = batch_tiles
+    trainer.network.tile_batch_memory_budget = tile_memory_budget * 1024 ** 3
+
+    if segmentation_export_kwargs is None:
+        if 'segmentation_export_params' in trainer.plans.keys():
+            force_separate_z = trainer.plans['segmentation_export_params']['force_separate_z']
+            interpolation_order = trainer.plans['segmentation_export_params']['interpolation_order']
+            interpolation_order_z = trainer.plans['segmentation_export_params']['interpolation_order_z']
+        else:
+            force_separate_z = None
+            interpolation_order = 1
+            interpolation_order_z = 0
+    else:
+        force_separate_z = segmentation_export_kwargs['force_separate_z']
+        interpolation_order = segmentation_export_kwargs['interpolation_order']
+        interpolation_order_z = segmentation_export_kwargs['interpolation_order_z']
+
+    region_class_order = getattr(trainer, 'regions_class_order', None)
+    transpose_forward = trainer.plans.get('transpose_forward')
+    transpose_backward = trainer.plans.get('transpose_backward')
+
+    # all processes share one resource tracker, so a block is unregistered by whichever process unlinks it
+    resource_tracker.ensure_running()
+
+    num_preprocessing = max(1, min(len(list_of_lists), num_threads_preprocessing))
+    num_export = max(1, num_threads_nifti_save)
+    q_preprocessed = Queue(max_queued)
+    q_export = Queue(max_queued)
+    q_stats = Queue()
+
+    print("starting pipeline: %d preprocessing workers, 1 prediction worker, %d export workers" %
+          (num_preprocessing, num_export))
+    wall_start = time()
+    classes = list(range(1, trainer.num_classes))
+    preprocessors = []
+    for i in range(num_preprocessing):
+        pr = Process(target=_preprocess_worker, args=(trainer.preprocess_patient, q_preprocessed, q_stats,
+                                                      list_of_lists[i::num_preprocessing],
+                                                      cleaned_output_files[i::num_preprocessing],
+                                                      segs_from_prev_stage[i::num_preprocessing],
+                                                      classes, trainer.plans['transpose_forward']))
+        pr.start()
+        preprocessors.append(pr)
+    exporters = []
+    for i in range(num_export):
+        pr = Process(target=_export_worker, args=(q_export, q_stats))
+        pr.start()
+        exporters.append(pr)
+
+    predicted = 0
+    prediction_busy = 0.
+    finished = False
+    try:
+        end_ctr = 0
+        while end_ctr != num_preprocessing:
+            item = q_preprocessed.get()
+            if item == "end":
+                end_ctr += 1
+                continue
+            output_filename, descriptor, dct = item
+
+            start = time()
+            d, shm = _from_shared(descriptor)
+            d = d.copy()
+            _release(shm)
+
+            print("predicting", output_filename)
+            softmax = None
+            for p in params:
+                trainer.load_checkpoint_ram(p, False)
+                pred = trainer.predict_preprocessed_data_return_seg_and_softmax(
+                    d, do_mirroring=do_tta, mirror_axes=trainer.data_aug_params['mirror_axes'],
+                    use_sliding_window=True, step_size=step_size, use_gaussian=True, all_in_gpu=all_in_gpu,
+                    mixed_precision=mixed_precision)[1]
+                softmax = pred if softmax is None else softmax + pred
+            if len(params) > 1:
+                softmax /= len(params)
+
+            if transpose_forward is not None:
+                softmax = softmax.transpose([0] + [i + 1 for i in transpose_backward])
+
+            npz_file = output_filename[:-7] + ".npz" if save_npz else None
+            export_args = (output_filename, dct, interpolation_order, region_class_order, None, None, npz_file, None,
+                           force_separate_z, interpolation_order_z)
+            descriptor = _to_shared(softmax)
+            del softmax, d
+            prediction_busy += time() - start
+            predicted += 1
+
+            # blocks while all export workers are busy and the export queue is full
+            q_export.put((descriptor, export_args))
+
+        for _ in exporters:
+            q_export.put("end")
+
+        stats = {"prediction": (predicted, prediction_busy, 1)}
+        for _ in range(num_preprocessing + num_export):
+            stage, done, busy = q_stats.get()
+            prev_done, prev_busy, workers = stats.get(stage, (0, 0., 0))
+            stats[stage] = (prev_done + done, prev_busy + busy, workers + 1)
+        finished = True
+    finally:
+        for p in preprocessors + exporters:
+            if p.is_alive() and not finished:
+                p.terminate()  # only happens if the prediction failed
+            p.join()
+        q_preprocessed.close()
+        q_export.close()
+
+    wall_time = time() - wall_start
+    print("inference done")
+    _print_stage_stats(stats, wall_time)
+
+    if not disable_postprocessing:
+        pp_file = join(model, "postprocessing.json")
+        if isfile(pp_file):
+            print("postprocessing...")
+            shutil.copy(pp_file, os.path.abspath(os.path.dirname(output_filenames[0])))
+            for_which_classes, min_valid_obj_size = load_postprocessing(pp_file)
+            with Pool(num_export) as pool:
+                pool.starmap(load_remove_save, zip(output_filenames, output_filenames,
+                                                   [for_which_classes] * len(output_filenames),
+                                                   [min_valid_obj_size] * len(output_filenames)))
+        else:
+            print("WARNING! Cannot run postprocessing because the postprocessing file is missing. Make sure to run "
+                  "consolidate_folds in the output folder of the model first!\nThe folder you need to run this in is "
+                  "%s" % model)
+
+    return stats
@@ -20,6 +20,7 @@ from typing import Tuple, Union, List
 import numpy as np
 from batchgenerators.augmentations.utils import resize_segmentation
 from nnunet.inference.segmentation_export import save_segmentation_nifti_from_softmax, save_segmentation_nifti
+from nnunet.inference.pipeline import predict_cases_pipelined
 from batchgenerators.utilities.file_and_folder_operations import *
 from multiprocessing import Process, Queue
 import torch
@@ -132,7 +133,8 @@ def predict_cases(model, list_of_lists, output_filenames, folds, save_npz, num_t
                   num_threads_nifti_save, segs_from_prev_stage=None, do_tta=True, mixed_precision=True,
                   overwrite_existing=False,
                   all_in_gpu=False, step_size=0.5, checkpoint_name="model_final_checkpoint",
-                  segmentation_export_kwargs: dict = None, disable_postprocessing: bool = False):
+                  segmentation_export_kwargs: dict = None, disable_postprocessing: bool = False,
+                  batch_tiles: bool = False, tile_memory_budget: float = 2.):
     """
     :param segmentation_export_kwargs:
     :param model: folder where the model is saved, must contain fold_x subfolders
@@ -147,6 +149,9 @@ def predict_cases(model, list_of_lists, output_filenames, folds, save_npz, num_t
     :param do_tta: default: True, can be set to False for a 8x speedup at the cost of a reduced segmentation quality
     :param overwrite_existing: default: True
     :param mixed_precision: if None then we take no action. If True/False we overwrite what the model has in its init
+    :param batch_tiles: predict several sliding window tiles and their mirrored variants in one forward pass
+    (see SegmentationNetwork.batch_tiles)
+    :param tile_memory_budget: memory (GB) one batched forward pass may use, determines the number of tiles per batch
     :return:
     """
     assert len(list_of_lists) == len(output_filenames)
@@ -183,6 +188,8 @@ def predict_cases(model, list_of_lists, output_filenames, folds, save_npz, num_t
     print("loading parameters for folds,", folds)
     trainer, params = load_model_and_checkpoint_files(model, folds, mixed_precision=mixed_precision,
                                                       checkpoint_name=checkpoint_name)
+    trainer.network.batch_tiles = batch_tiles
+    trainer.network.tile_batch_memory_budget = tile_memory_budget * 1024 ** 3
 
     if segmentation_export_kwargs is None:
         if 'segmentation_export_params' in trainer.plans.keys():
@@ -610,7 +617,8 @@ def predict_from_folder(model: str, input_folder: str, output_folder: str, folds
                         part_id: int, num_parts: int, tta: bool, mixed_precision: bool = True,
                         overwrite_existing: bool = True, mode: str = 'normal', overwrite_all_in_gpu: bool = None,
                         step_size: float = 0.5, checkpoint_name: str = "model_final_checkpoint",
-                        segmentation_export_kwargs: dict = None, disable_postprocessing: bool = False):
+                        segmentation_export_kwargs: dict = None, disable_postprocessing: bool = False,
+                        batch_tiles: bool = False, tile_memory_budget: float = 2.):
     """
         here we use the standard naming scheme to generate list_of_lists and output_files needed by predict_cases
 
@@ -664,7 +672,22 @@ def predict_from_folder(model: str, input_folder: str, output_folder: str, folds
                              all_in_gpu=all_in_gpu,
                              step_size=step_size, checkpoint_name=checkpoint_name,
                              segmentation_export_kwargs=segmentation_export_kwargs,
-                             disable_postprocessing=disable_postprocessing)
+                             disable_postprocessing=disable_postprocessing,
+                             batch_tiles=batch_tiles, tile_memory_budget=tile_memory_budget)
+    elif mode == "pipelined":
+        if overwrite_all_in_gpu is None:
+            all_in_gpu = False
+        else:
+            all_in_gpu = overwrite_all_in_gpu
+
+        return predict_cases_pipelined(model, list_of_lists[part_id::num_parts], output_files[part_id::num_parts],
+                                       folds, save_npz, num_threads_preprocessing, num_threads_nifti_save,
+                                       lowres_segmentations, tta, mixed_precision=mixed_precision,
+                                       overwrite_existing=overwrite_existing, all_in_gpu=all_in_gpu,
+                                       step_size=step_size, checkpoint_name=checkpoint_name,
+                                       segmentation_export_kwargs=segmentation_export_kwargs,
+                                       disable_postprocessing=disable_postprocessing,
+                                       batch_tiles=batch_tiles, tile_memory_budget=tile_memory_budget)
     elif mode == "fast":
         if overwrite_all_in_gpu is None:
             all_in_gpu = False
@@ -693,7 +716,7 @@ def predict_from_folder(model: str, input_folder: str, output_folder: str, folds
                                      step_size=step_size, checkpoint_name=checkpoint_name,
                                      disable_postprocessing=disable_postprocessing)
     else:
-        raise ValueError("unrecognized mode. Must be normal, fast or fastest")
+        raise ValueError("unrecognized mode. Must be normal, pipelined, fast or fastest")
 
 
 if __name__ == "__main__":
@@ -754,7 +777,9 @@ if __name__ == "__main__":
                                                                                           "(=existing segmentations "
                                                                                           "in output_folder will be "
                                                                                           "overwritten)")
-    parser.add_argument("--mode", type=str, default="normal", required=False)
+    parser.add_argument("--mode", type=str, default="normal", required=False,
+                        help="normal, pipelined (preprocessing, prediction and export run concurrently), fast or "
+                             "fastest")
     parser.add_argument("--all_in_gpu", type=str, default="None", required=False, help="can be None, False or True")
     parser.add_argument("--step_size", type=float, default=0.5, required=False, help="don't touch")
     # parser.add_argument("--interp_order", required=False, default=3, type=int,
@@ -767,6 +792,11 @@ if __name__ == "__main__":
                         help='Predictions are done with mixed precision by default. This improves speed and reduces '
                              'the required vram. If you want to disable mixed precision you can set this flag. Note '
                              'that this is not recommended (mixed precision is ~2x faster!)')
+    parser.add_argument('--batch_tiles', default=False, action='store_true', required=False,
+                        help='Predict several sliding window tiles and all their mirrored variants in one forward '
+                             'pass (modes normal and pipelined). Same result, considerably faster, especially on CPU')
+    parser.add_argument('--tile_memory_budget', type=float, default=2., required=False,
+                        help='Memory in GB a single batched forward pass may use with --batch_tiles. Default: 2')
 
     args = parser.parse_args()
     input_folder = args.input_folder
@@ -837,4 +867,5 @@ if __name__ == "__main__":
     predict_from_folder(model, input_folder, output_folder, folds, save_npz, num_threads_preprocessing,
                         num_threads_nifti_save, lowres_segmentations, part_id, num_parts, tta,
                         mixed_precision=not args.disable_mixed_precision,
-                        overwrite_existing=overwrite, mode=mode, overwrite_all_in_gpu=all_in_gpu, step_size=step_size)
+                        overwrite_existing=overwrite, mode=mode, overwrite_all_in_gpu=all_in_gpu, step_size=step_size,
+                        batch_tiles=args.batch_tiles, tile_memory_budget=args.tile_memory_budget)
@@ -70,6 +70,14 @@ class SegmentationNetwork(NeuralNetwork):
         self._gaussian_3d = self._patch_size_for_gaussian_3d = None
         self._gaussian_2d = self._patch_size_for_gaussian_2d = None
 
+        # Tile batching for 3D sliding window prediction. If True, several tiles and all their mirrored variants are
+        # stacked along the batch dimension and predicted in one forward pass instead of one tile and one mirror
+        # at a time. The number of tiles per forward is chosen such that the estimated memory of one forward pass
+        # stays below tile_batch_memory_budget (bytes). The results are the same as with the sequential prediction.
+        self.batch_tiles = False
+        self.tile_batch_memory_budget = 2 * 1024 ** 3
+        self._tile_bytes = self._patch_size_for_tile_bytes = None
+
     def predict_3D(self, x: np.ndarray, do_mirroring: bool, mirror_axes: Tuple[int, ...] = (0, 1, 2),
                    use_sliding_window: bool = False,
                    step_size: float = 0.5, patch_size: Tuple[int, ...] = None, regions_class_order: Tuple[int, ...] = None,
@@ -371,27 +379,33 @@ class SegmentationNetwork(NeuralNetwork):
             aggregated_results = np.zeros([self.num_classes] + list(data.shape[1:]), dtype=np.float32)
             aggregated_nb_of_predictions = np.zeros([self.num_classes] + list(data.shape[1:]), dtype=np.float32)
 
-        for x in steps[0]:
-            lb_x = x
-            ub_x = x + patch_size[0]
-            for y in steps[1]:
-                lb_y = y
-                ub_y = y + patch_size[1]
-                for z in steps[2]:
-                    lb_z = z
-                    ub_z = z + patch_size[2]
-
-                    predicted_patch = self._internal_maybe_mirror_and_pred_3D(
-                        data[None, :, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z], mirror_axes, do_mirroring,
-                        gaussian_importance_map)[0]
-
-                    if all_in_gpu:
-                        predicted_patch = predicted_patch.half()
-                    else:
-                        predicted_patch = predicted_patch.cpu().numpy()
-
-                    aggregated_results[:, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z] += predicted_patch
-                    aggregated_nb_of_predictions[:, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z] += add_for_nb_of_preds
+        if self.batch_tiles:
+            self._internal_predict_tiles_batched_3D(data, steps, patch_size, mirror_axes, do_mirroring,
+                                                    gaussian_importance_map, aggregated_results,
+                                                    aggregated_nb_of_predictions, add_for_nb_of_preds, all_in_gpu,
+                                                    verbose)
+        else:
+            for x in steps[0]:
+                lb_x = x
+                ub_x = x + patch_size[0]
+                for y in steps[1]:
+                    lb_y = y
+                    ub_y = y + patch_size[1]
+                    for z in steps[2]:
+                        lb_z = z
+                        ub_z = z + patch_size[2]
+
+                        predicted_patch = self._internal_maybe_mirror_and_pred_3D(
+                            data[None, :, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z], mirror_axes, do_mirroring,
+                            gaussian_importance_map)[0]
+
+                        if all_in_gpu:
+                            predicted_patch = predicted_patch.half()
+                        else:
+                            predicted_patch = predicted_patch.cpu().numpy()
+
+                        aggregated_results[:, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z] += predicted_patch
+                        aggregated_nb_of_predictions[:, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z] += add_for_nb_of_preds
 
         # we reverse the padding here (remeber that we padded the input to be at least as large as the patch size
         slicer = tuple(
@@ -426,6 +440,77 @@ class SegmentationNetwork(NeuralNetwork):
         if verbose: print("prediction done")
         return predicted_segmentation, aggregated_results
 
+    @staticmethod
+    def _get_mirror_flips_3D(mirror_axes: tuple, do_mirroring: bool) -> List[Tuple[int, ...]]:
+        """
+        flipped dimensions of all mirrored variants, in the order used by _internal_maybe_mirror_and_pred_3D
+        """
+        if not do_mirroring:
+            return [()]
+        flips = [(), (4,), (3,), (4, 3), (2,), (4, 2), (3, 2), (4, 3, 2)]
+        return [f for f in flips if all(d - 2 in mirror_axes for d in f)]
+
+    def _estimate_tile_bytes(self, patch_size: tuple, num_channels: int) -> int:
+        """
+        memory of one forward pass with batch size 1. Measured once on GPU, on CPU we assume ~64 float32 values per
+        voxel are alive at the same time (full resolution feature maps, skips and the softmax)
+        """
+        if self._tile_bytes is not None and tuple(patch_size) == self._patch_size_for_tile_bytes:
+            return self._tile_bytes
+
+        if torch.cuda.is_available():
+            probe = torch.zeros([1, num_channels] + list(patch_size), device=self.get_device())
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats(self.get_device())
+            before = torch.cuda.memory_allocated(self.get_device())
+            self.inference_apply_nonlin(self(probe))
+            torch.cuda.synchronize()
+            tile_bytes = torch.cuda.max_memory_allocated(self.get_device()) - before
+        else:
+            tile_bytes = int(np.prod(patch_size)) * 64 * 4
+
+        self._tile_bytes = max(int(tile_bytes), 1)
+        self._patch_size_for_tile_bytes = tuple(patch_size)
+        return self._tile_bytes
+
+    def _internal_predict_tiles_batched_3D(self, data: Union[np.ndarray, torch.tensor], steps: List[List[int]],
+                                           patch_size: tuple, mirror_axes: tuple, do_mirroring: bool,
+                                           gaussian_importance_map: Union[torch.tensor, None],
+                                           aggregated_results: Union[np.ndarray, torch.tensor],
+                                           aggregated_nb_of_predictions: Union[np.ndarray, torch.tensor],
+                                           add_for_nb_of_preds: Union[np.ndarray, torch.tensor], all_in_gpu: bool,
+                                           verbose: bool) -> None:
+        """
+        Tile batching variant of the sliding window loop in _internal_predict_3D_3Dconv_tiled. Gathers
+        tiles_per_forward tiles, predicts them together with all their mirrored variants in one forward pass and adds
+        the (gaussian weighted) results to aggregated_results / aggregated_nb_of_predictions in place.
+        """
+        num_variants = len(self._get_mirror_flips_3D(mirror_axes, do_mirroring))
+        tile_bytes = self._estimate_tile_bytes(patch_size, data.shape[0])
+        tiles_per_forward = max(1, int(self.tile_batch_memory_budget // (tile_bytes * num_variants)))
+
+        corners = [(x, y, z) for x in steps[0] for y in steps[1] for z in steps[2]]
+        if verbose: print("tiles per forward pass:", tiles_per_forward, "mirror variants:", num_variants)
+
+        for i in range(0, len(corners), tiles_per_forward):
+            slicers = [tuple([slice(None)] + [slice(c, c + p) for c, p in zip(corner, patch_size)])
+                       for corner in corners[i:i + tiles_per_forward]]
+            if all_in_gpu:
+                tiles = torch.stack([data[s] for s in slicers])
+            else:
+                tiles = np.stack([data[s] for s in slicers])
+
+            predicted_patches = self._internal_maybe_mirror_and_pred_3D_batched(tiles, mirror_axes, do_mirroring,
+                                                                                gaussian_importance_map)
+            if all_in_gpu:
+                predicted_patches = predicted_patches.half()
+            else:
+                predicted_patches = predicted_patches.cpu().numpy()
+
+            for predicted_patch, s in zip(predicted_patches, slicers):
+                aggregated_results[s] += predicted_patch
+                aggregated_nb_of_predictions[s] += add_for_nb_of_preds
+
     def _internal_predict_2D_2Dconv(self, x: np.ndarray, min_size: Tuple[int, int], do_mirroring: bool,
                                     mirror_axes: tuple = (0, 1, 2), regions_class_order: tuple = None,
                                     pad_border_mode: str = "constant", pad_kwargs: dict = None,
@@ -565,6 +650,39 @@ class SegmentationNetwork(NeuralNetwork):
 
         return result_torch
 
+    def _internal_maybe_mirror_and_pred_3D_batched(self, x: Union[np.ndarray, torch.tensor], mirror_axes: tuple,
+                                                   do_mirroring: bool = True,
+                                                   mult: np.ndarray or torch.tensor = None) -> torch.tensor:
+        """
+        Same as _internal_maybe_mirror_and_pred_3D for each of the b tiles in x, but all tiles and all their mirrored
+        variants are stacked along the batch dimension and go through the network in a single forward pass.
+        Returns (b, num_classes, x, y, z)
+        """
+        assert len(x.shape) == 5, 'x must be (b, c, x, y, z)'
+
+        x = maybe_to_torch(x)
+        if torch.cuda.is_available():
+            x = to_cuda(x, gpu_id=self.get_device())
+
+        flips = self._get_mirror_flips_3D(mirror_axes, do_mirroring)
+        num_tiles = x.shape[0]
+
+        pred = self.inference_apply_nonlin(self(torch.cat([torch.flip(x, f) if f else x for f in flips])))
+
+        result_torch = torch.zeros([num_tiles, self.num_classes] + list(x.shape[2:]), dtype=torch.float,
+                                   device=pred.device)
+        for i, f in enumerate(flips):
+            pred_here = pred[i * num_tiles:(i + 1) * num_tiles]
+            result_torch += 1 / len(flips) * (torch.flip(pred_here, f) if f else pred_here)
+
+        if mult is not None:
+            mult = maybe_to_torch(mult)
+            if torch.cuda.is_available():
+                mult = to_cuda(mult, gpu_id=self.get_device())
+            result_torch[:, :] *= mult
+
+        return result_torch
+
     def _internal_maybe_mirror_and_pred_2D(self, x: Union[np.ndarray, torch.tensor], mirror_axes: tuple,
                                            do_mirroring: bool = True,
                                            mult: np.ndarray or torch.tensor = None) -> torch.tensor:
@@ -3,6 +3,7 @@ import torch
 
 from Datasets.kits19.models.nnUNet.nnunet.network_architecture.generic_UNet import ConvDropoutNormNonlin, Generic_UNet
 from Datasets.kits19.models.nnUNet.nnunet.network_architecture.initialization import InitWeights_He
+from utils.model_factory import load_pretrained, trainable_copy
 
 """
 PARAMETER COUNT:
@@ -66,9 +67,7 @@ class front(nn.Module):
     def __init__(self,input_channels=1,pretrained=False):
         super().__init__()
         self.pretrained = pretrained
-        full_model = get_full_model()
-        model_state_dict = torch.load('/media/imroze/A8DCE5B8DCE580C4/Shreyas/medical_split_learning/Datasets/kits19/models/pretrained/best_new_model.pth')
-        full_model.load_state_dict(model_state_dict)
+        full_model = load_pretrained(get_full_model, '/media/imroze/A8DCE5B8DCE580C4/Shreyas/medical_split_learning/Datasets/kits19/models/pretrained/best_new_model.pth')
 
         # conv_blocks_context, convolutional pooling in full model must be True
         self.front_contexts = full_model.conv_blocks_context[:2] # 1, 2
@@ -87,11 +86,8 @@ class front(nn.Module):
 class center_front(nn.Module):
     def __init__(self,pretrained=False,skips=[]):
         super().__init__()
-        full_model = get_full_model()
         self.pretrained = pretrained
-        full_model = get_full_model()
-        model_state_dict = torch.load('/media/imroze/A8DCE5B8DCE580C4/Shreyas/medical_split_learning/Datasets/kits19/models/pretrained/best_new_model.pth')
-        full_model.load_state_dict(model_state_dict)
+        full_model = load_pretrained(get_full_model, '/media/imroze/A8DCE5B8DCE580C4/Shreyas/medical_split_learning/Datasets/kits19/models/pretrained/best_new_model.pth')
 
         # conv_blocks_context, convolutional pooling in full model must be True
         self.center_contexts = full_model.conv_blocks_context[2:-1] # 3,4,5
@@ -117,20 +113,17 @@ class center_front(nn.Module):
 class center_back(nn.Module):
     def __init__(self,pretrained=False,skips=[]):
         super().__init__()
-        full_model = get_full_model()
         self.pretrained = pretrained
-        full_model = get_full_model()
-        model_state_dict = torch.load('/media/imroze/A8DCE5B8DCE580C4/Shreyas/medical_split_learning/Datasets/kits19/models/pretrained/best_new_model.pth')
-        full_model.load_state_dict(model_state_dict)
+        full_model = load_pretrained(get_full_model, '/media/imroze/A8DCE5B8DCE580C4/Shreyas/medical_split_learning/Datasets/kits19/models/pretrained/best_new_model.pth', trainable=True)
 
         self.skips = []
         
-        self.final_context_layer = full_model.conv_blocks_context[-1] # 6
+        self.final_context_layer = trainable_copy(full_model.conv_blocks_context[-1]) # 6
 
         # tu & conv_blocks_localization
         # tu: ConvTranspose3D ModuleList
-        self.center_tu = full_model.tu[:3] # 1, 2, 3
-        self.center_localizations = full_model.conv_blocks_localization[:3] # 1, 2, 3
+        self.center_tu = trainable_copy(full_model.tu[:3]) # 1, 2, 3
+        self.center_localizations = trainable_copy(full_model.conv_blocks_localization[:3]) # 1, 2, 3
         
         
     def forward(self, x):
@@ -157,18 +150,16 @@ class back(nn.Module):
     def __init__(self,pretrained=False,skips=[]):
         super().__init__()
         self.pretrained=pretrained
-        full_model = get_full_model()
-        model_state_dict = torch.load('/media/imroze/A8DCE5B8DCE580C4/Shreyas/medical_split_learning/Datasets/kits19/models/pretrained/best_new_model.pth')
-        full_model.load_state_dict(model_state_dict)
+        full_model = load_pretrained(get_full_model, '/media/imroze/A8DCE5B8DCE580C4/Shreyas/medical_split_learning/Datasets/kits19/models/pretrained/best_new_model.pth', trainable=True)
 
         # tu & conv_blocks_localization
         # tu: ConvTranspose3D ModuleList
-        self.back_tu = full_model.tu[3:] # 4, 5
-        self.back_localizations = full_model.conv_blocks_localization[3:] # 4, 5
+        self.back_tu = trainable_copy(full_model.tu[3:]) # 4, 5
+        self.back_localizations = trainable_copy(full_model.conv_blocks_localization[3:]) # 4, 5
         self.skips = skips
         
         # final 32 -> num_class layer
-        self.final_seg_output = full_model.seg_outputs[-1]
+        self.final_seg_output = trainable_copy(full_model.seg_outputs[-1])
 
         
     def forward(self, x):
@@ -0,0 +1,147 @@
+import argparse
+import importlib
+import json
+import os
+from pathlib import Path
+
+import h5py
+import numpy as np
+import torch
+from joblib import Parallel, delayed
+from monai.transforms import Spacingd
+from tqdm import tqdm
+
+from utils.volume_cache import leading_crop, prefix_key, run_tail, split_prefix
+
+
+"""
+offline converter: KiTS19 / IXI-Tiny volumes -> pre-resampled, chunked hdf5
+
+every case of the dataset's splits.csv is run once through the deterministic
+prefix of the builder's transforms (load -> foreground crop -> orientation ->
+spacing at the builder's voxel spacing) and written to <out>/<case>.h5:
+    - image: float16 (1, D, H, W), label: uint8 (1, D, H, W)
+    - stored in lzf compressed chunk^3 blocks, a crop only decompresses the
+      blocks it overlaps (see read_region)
+    - the sizes / mtimes of the source files and the prefix hash (spacing and
+      the other transform settings) are kept in the file attributes, re-runs
+      skip the cases whose inputs did not change
+
+the builders read the files back with --resampled_volumes (ResampledVolumeDataset):
+the leading RandSpatialCropd / CenterSpatialCropd of the tail is done through
+read_region, the rest of the tail (resize, affine) runs online as usual
+
+usage: python -m ImageSegmentation_Task.resample_volumes --dataset kits19 --workers 8
+"""
+
+
+DATASETS = {
+    # dataset -> (builder, splits.csv column with the case names)
+    'kits19': ('ImageSegmentation_Task.kits19.databuilder:KITSDataBuilder', 'case_ids'),
+    'IXI': ('ImageSegmentation_Task.IXI.databuilder:IXIDataBuilder', 'filename'),
+}
+
+
+def _source_stamp(item, prefix):
+    stamp = {'prefix': prefix_key(prefix)}
+    for key, path in item.items():
+        stat = os.stat(path)
+        stamp[key] = [str(path), stat.st_size, stat.st_mtime_ns]
+    return json.dumps(stamp, sort_keys=True)
+
+
+def convert_case(prefix, item, out_path, stamp, chunk=32):
+    if out_path.exists():
+        with h5py.File(out_path, 'r') as f:
+            if f.attrs.get('source') == stamp:
+                return 'skipped'
+
+    out = prefix(dict(item))
+    arrays = {
+        'image': np.asarray(out['image'], dtype=np.float16),
+        'label': np.asarray(out['label'], dtype=np.uint8),
+    }
+    tmp_path = out_path.with_name(out_path.stem + '.tmp.h5')
+    with h5py.File(tmp_path, 'w') as f:
+        for key, array in arrays.items():
+            chunks = (1,) + tuple(min(chunk, s) for s in array.shape[1:])
+            f.create_dataset(key, data=array, chunks=chunks, compression='lzf')
+        f.attrs['source'] = stamp
+    os.replace(tmp_path, out_path)
+    return 'converted'
+
+
+def read_region(path, start, size, keys=('image', 'label')):
+    """(1, *size) region at start of a converted case, only the overlapping chunks are read"""
+    region = tuple(slice(s, s + n) for s, n in zip(start, size))
+    with h5py.File(path, 'r') as f:
+        return {key: f[key][(slice(None),) + region] for key in keys}
+
+
+class ResampledVolumeDataset(torch.utils.data.Dataset):
+    def __init__(self, paths, prefix, transform):
+        """
+        paths: converted <case>.h5 per sample, prefix: the builder's load -> spacing
+        prefix (must match the one the files were converted with)
+        """
+        missing = [str(p) for p in paths if not Path(p).exists()]
+        if missing:
+            raise FileNotFoundError(f"{len(missing)} cases are not converted (e.g. {missing[0]}), "
+                                    f"run python -m ImageSegmentation_Task.resample_volumes first")
+        self.paths = paths
+        self.key = prefix_key(prefix)
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        path = self.paths[idx]
+        with h5py.File(path, 'r') as f:
+            if json.loads(f.attrs['source'])['prefix'] != self.key:
+                raise ValueError(f"{path} was converted with a different transform prefix, re-run resample_volumes")
+            spatial_size = f['image'].shape[1:]
+
+        window, transforms = leading_crop(self.transform, spatial_size)
+        if window is None:
+            window = tuple(slice(0, n) for n in spatial_size)
+        region = read_region(path, [w.start for w in window], [w.stop - w.start for w in window])
+        return run_tail(region['image'], region['label'], transforms)
+
+
+def convert_dataset(dataset, out_dir, workers=8, chunk=32):
+    builder_path, case_column = DATASETS[dataset]
+    module_name, class_name = builder_path.split(':')
+    builder = getattr(importlib.import_module(module_name), class_name)()
+
+    # the validation pipeline's prefix is the same load -> spacing chain the training one uses
+    _, val_tfms = builder.get_data_transforms()
+    prefix, _ = split_prefix(val_tfms, Spacingd)
+
+    cases = builder.thresholded_sites[case_column].to_list()
+    items = builder._make_dict(cases)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+
+    jobs = [
+        delayed(convert_case)(prefix, item, out_dir / f'{case}.h5', _source_stamp(item, prefix), chunk)
+        for case, item in zip(cases, items)
+    ]
+    results = Parallel(n_jobs=workers)(tqdm(jobs, desc=f'resampling {dataset}'))
+    print(f"{dataset}: {results.count('converted')} converted, {results.count('skipped')} unchanged -> {out_dir}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pre-resample KiTS19 / IXI-Tiny volumes into chunked hdf5")
+    parser.add_argument("--dataset", type=str, required=True, choices=list(DATASETS))
+    parser.add_argument("--out", type=str, default=None, help="Output directory, default ./data/resampled/<dataset>")
+    parser.add_argument("--workers", type=int, default=8, help="Parallel worker processes")
+    parser.add_argument("--chunk", type=int, default=32, help="Edge length of the stored chunk^3 blocks")
+    args = parser.parse_args()
+
+    convert_dataset(
+        args.dataset,
+        args.out or f'./data/resampled/{args.dataset}',
+        workers=args.workers,
+        chunk=args.chunk
+    )
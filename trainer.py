@@ -1,78 +1,65 @@
-from ImageSegmentation_Task.kits19.kits_trainer import PfslKits
-from ImageSegmentation_Task.kits19.kits_nonkv_trainer import PfslKits as PfslKitsNonKV
-
-from ImageSegmentation_Task.IXI.ixi_trainer import IXITrainer
-from ImageSegmentation_Task.IXI.ixi_nonkv_trainer import IXITrainer as IXITrainerNonKV
-
-from ImageSegmentation_Task.ISIC2019.isic_trainer import ISICTrainer
-
-from ImageClassification_Task.ic_trainer import ICTrainer
-
-from ImageSegmentation_Task.PCam.pcam_trainer import PCamTrainer
-
-from ImageSegmentation_Task.COVID19.covid_trainer import CovidTrainer
-
+import importlib
+from pprint import pprint
 
 from utils.argparser import parse_arguments
-from pprint import pprint
+from utils.import_profile import ImportProfile
+
+
+"""
+dataset -> trainer registry: (key-value store trainer, non key-value store trainer)
+entries are "module:class" strings, only the selected trainer module is imported
+so a run (or --help) does not pay for the other datasets' dependencies
+"""
+TRAINERS = {
+    'kits19': (
+        'ImageSegmentation_Task.kits19.kits_trainer:PfslKits',
+        'ImageSegmentation_Task.kits19.kits_nonkv_trainer:PfslKits',
+    ),
+    'IXI': (
+        'ImageSegmentation_Task.IXI.ixi_trainer:IXITrainer',
+        'ImageSegmentation_Task.IXI.ixi_nonkv_trainer:IXITrainer',
+    ),
+    'ISIC2019': ('ImageSegmentation_Task.ISIC2019.isic_trainer:ISICTrainer', None),
+    'PCam': ('ImageSegmentation_Task.PCam.pcam_trainer:PCamTrainer', None),
+    'COVID19': ('ImageSegmentation_Task.COVID19.covid_trainer:CovidTrainer', None),
+    'CIFAR10': ('ImageClassification_Task.ic_trainer:ICTrainer', None),
+}
+
+# datasets that run inference on the main test dataset after fit()
+RUN_INFERENCE = {'kits19', 'IXI', 'ISIC2019'}
+
+
+def get_trainer(args, profile=None):
+    kv_trainer, nonkv_trainer = TRAINERS[args.dataset]
+    target = kv_trainer if args.use_key_value_store else nonkv_trainer
+    if target is None:
+        raise NotImplementedError
+
+    module_name, class_name = target.split(':')
+    if profile is None:
+        module = importlib.import_module(module_name)
+    else:
+        with profile.track():
+            module = importlib.import_module(module_name)
+    return getattr(module, class_name)
+
 
 if __name__ == '__main__':
     args = parse_arguments()
 
     pprint(vars(args))
 
-    if args.dataset == 'kits19':
-        if args.use_key_value_store:
-            trainer = PfslKits(args)
-        else:
-            trainer = PfslKitsNonKV(args)
+    if args.dataset not in TRAINERS:
+        print('invalid dataset -_-')
+        raise SystemExit
 
-        trainer.fit()
-        trainer.inference()
+    profile = ImportProfile() if args.profile_imports else None
+    Trainer = get_trainer(args, profile)
+    if profile is not None:
+        profile.report()
 
-    elif args.dataset == 'IXI':
-        if args.use_key_value_store:
-            trainer = IXITrainer(args)
-        else:
-            trainer = IXITrainerNonKV(args)
+    trainer = Trainer(args)
+    trainer.fit()
 
-        trainer.fit()
+    if args.dataset in RUN_INFERENCE and hasattr(trainer, 'inference'):
         trainer.inference()
-
-    elif args.dataset == 'ISIC2019':
-        if args.use_key_value_store:
-            trainer = ISICTrainer(args)
-        else:
-            raise NotImplementedError
-        
-        trainer.fit()
-        trainer.inference()
-
-    elif args.dataset == 'PCam':
-        if args.use_key_value_store:
-            trainer = PCamTrainer(args)
-        else:
-            raise NotImplementedError
-        
-        trainer.fit()
-
-    elif args.dataset == 'COVID19':
-        if args.use_key_value_store:
-            trainer = CovidTrainer(args)
-        else:
-            raise NotImplementedError
-        
-        trainer.fit()
-        
-    elif args.dataset == 'CIFAR10':
-        if args.use_key_value_store:
-            trainer = ICTrainer(args)
-        else:
-            raise NotImplementedError
-        
-        trainer.fit()
-        # print("HYBRID INFERENCE")
-        # trainer.inference_new()
-
-    else:
-        print('invalid dataset -_-')
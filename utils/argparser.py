@@ -163,6 +163,186 @@ def parse_arguments():
         help="USE SERVER ONLY FOR OFFLOADING, CURRENTLY ONLY IMPLEMENTED FOR IXI-TINY & KITS19",
     )
 
+    parser.add_argument(
+        "--log_every",
+        type=int,
+        default=50,
+        help="Flush buffered step metrics to wandb every N steps",
+    )
+
+    parser.add_argument(
+        "--log_granularity",
+        type=str,
+        default="step",
+        choices=["step", "epoch"],
+        help="Log every step scalar, or only their per-epoch mean",
+    )
+
+    parser.add_argument(
+        "--save_preds",
+        action="store_true",
+        default=False,
+        help="Write uint8 argmax validation predictions per client & epoch (KiTS19, IXI-Tiny)",
+    )
+
+    parser.add_argument(
+        "--seg_loss",
+        type=str,
+        default="dice",
+        choices=["dice", "dice_ce"],
+        help="Client-side segmentation loss: monai soft dice, or nnUNet dice + cross entropy (KiTS19, IXI-Tiny)",
+    )
+
+    parser.add_argument(
+        "--share_frozen",
+        action="store_true",
+        default=False,
+        help="All clients share one frozen front & center_front, key-value store is populated in combined batches (KiTS19, IXI-Tiny)",
+    )
+
+    parser.add_argument(
+        "--profile_imports",
+        action="store_true",
+        default=False,
+        help="Print an import-time profile (like python -X importtime) of the selected trainer",
+    )
+
+    parser.add_argument(
+        "--partition",
+        type=str,
+        default=None,
+        choices=["dirichlet", "shards", "quantity"],
+        help="Replace the natural clients by a synthetic non-IID partition of number_of_clients clients (ISIC2019, PCam, COVID19)",
+    )
+
+    parser.add_argument(
+        "--partition_alpha",
+        type=float,
+        default=0.5,
+        help="Dirichlet concentration for the dirichlet (label skew) and quantity (size skew) partitions",
+    )
+
+    parser.add_argument(
+        "--shards_per_client",
+        type=int,
+        default=2,
+        help="Label-sorted shards per client for the shards partition",
+    )
+
+    parser.add_argument(
+        "--cache_images",
+        action="store_true",
+        default=False,
+        help="Decode the images once into uint8 shards at the training resolution under ./data/shards (ISIC2019, COVID19)",
+    )
+
+    parser.add_argument(
+        "--preload_h5",
+        action="store_true",
+        default=False,
+        help="Read the split's rows from the h5 files once into shared memory for the whole run (PCam)",
+    )
+
+    parser.add_argument(
+        "--cache_volumes",
+        action="store_true",
+        default=False,
+        help="Cache the deterministic load -> spacing prefix of every case under ./data/volumes, only crops / affine run online (KiTS19, IXI-Tiny)",
+    )
+
+    parser.add_argument(
+        "--resampled_volumes",
+        action="store_true",
+        default=False,
+        help="Read the chunked hdf5 volumes written by ImageSegmentation_Task.resample_volumes from ./data/resampled, crops only read the overlapping chunks (KiTS19, IXI-Tiny)",
+    )
+
+    parser.add_argument(
+        "--device_affine",
+        action="store_true",
+        default=False,
+        help="Run the training RandAffined batched on the training device (affine_grid / grid_sample) instead of per sample in the DataLoader (KiTS19)",
+    )
+
+    parser.add_argument(
+        "--loader_backend",
+        type=str,
+        default="process",
+        choices=["process", "thread"],
+        help="3D loaders: persistent worker processes, or a thread pool in the training process (KiTS19, IXI-Tiny)",
+    )
+
+    parser.add_argument(
+        "--loader_workers",
+        type=int,
+        default=0,
+        help="Loader worker processes / threads per DataLoader, 0 loads in the training thread (KiTS19, IXI-Tiny)",
+    )
+
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=2,
+        help="Batches loaded ahead (per worker for the process backend) (KiTS19, IXI-Tiny)",
+    )
+
+    parser.add_argument(
+        "--pin_memory",
+        action="store_true",
+        default=False,
+        help="Hand out batches in pinned memory for faster host -> device copies (KiTS19, IXI-Tiny)",
+    )
+
+    parser.add_argument(
+        "--disc_rounds",
+        type=int,
+        default=60,
+        help="Maximum discriminator training rounds (CIFAR10 OOD routing)",
+    )
+
+    parser.add_argument(
+        "--disc_patience",
+        type=int,
+        default=5,
+        help="Stop discriminator training after this many rounds without a better validation reconstruction loss",
+    )
+
+    parser.add_argument(
+        "--ood_threshold",
+        type=str,
+        default="mean",
+        choices=["mean", "percentile", "roc"],
+        help="OOD threshold calibration on validation reconstruction errors: mean, percentile or per-client roc",
+    )
+
+    parser.add_argument(
+        "--ood_percentile",
+        type=float,
+        default=95,
+        help="Percentile of the validation reconstruction errors used by --ood_threshold percentile",
+    )
+
+    parser.add_argument(
+        "--sliding_window",
+        action="store_true",
+        default=False,
+        help="Run the final inference on full-resolution test volumes with sliding-window tiling (KiTS19, IXI-Tiny)",
+    )
+
+    parser.add_argument(
+        "--sw_overlap",
+        type=float,
+        default=0.5,
+        help="Minimum overlap of neighbouring sliding-window tiles, as a fraction of the patch",
+    )
+
+    parser.add_argument(
+        "--sw_batch_size",
+        type=int,
+        default=4,
+        help="Sliding-window tiles per forward pass",
+    )
+
 
     args = parser.parse_args()
     return args
@@ -0,0 +1,104 @@
+import torch
+import torch.nn.functional as F
+
+
+"""
+batched 3D random affine augmentation on the training device
+
+same parameters and sampling as monai RandAffined(prob=1.0, padding_mode='border'):
+    - per sample rotation angles ~ U(-rotate_range, rotate_range) (radians, about
+      spatial axes 0, 1, 2), scale factors 1 + U(-scale_range, scale_range),
+      translations ~ U(-translate_range, translate_range) in voxels
+    - the sampling matrix is composed like monai's AffineGrid, R @ T @ S around
+      the volume center, mapping output voxels to input voxels
+    - the whole batch is resampled with one affine_grid / grid_sample call per
+      tensor: bilinear for the image, nearest for the label
+"""
+
+
+def _rotation(angles):
+    """(B, 3) radians -> (B, 3, 3) Rx @ Ry @ Rz, as monai create_rotate"""
+    cos, sin = angles.cos(), angles.sin()
+    one, zero = torch.ones_like(cos[:, 0]), torch.zeros_like(cos[:, 0])
+    rx = torch.stack([
+        one, zero, zero,
+        zero, cos[:, 0], -sin[:, 0],
+        zero, sin[:, 0], cos[:, 0],
+    ], dim=1).view(-1, 3, 3)
+    ry = torch.stack([
+        cos[:, 1], zero, sin[:, 1],
+        zero, one, zero,
+        -sin[:, 1], zero, cos[:, 1],
+    ], dim=1).view(-1, 3, 3)
+    rz = torch.stack([
+        cos[:, 2], -sin[:, 2], zero,
+        sin[:, 2], cos[:, 2], zero,
+        zero, zero, one,
+    ], dim=1).view(-1, 3, 3)
+    return rx @ ry @ rz
+
+
+class BatchRandAffine3D:
+    def __init__(self, rotate_range=(0, 0, 0), scale_range=(0, 0, 0), translate_range=(0, 0, 0), padding_mode='border'):
+        self.rotate_range = rotate_range
+        self.scale_range = scale_range
+        self.translate_range = translate_range
+        self.padding_mode = padding_mode
+
+    def _uniform(self, ranges, batch_size, device):
+        ranges = torch.tensor(ranges, dtype=torch.float32, device=device)
+        return (torch.rand(batch_size, 3, device=device) * 2 - 1) * ranges
+
+    def sample(self, batch_size, spatial_shape, device):
+        """(B, 3, 4) affine_grid thetas in normalized (x, y, z) = (axis 2, 1, 0) coordinates"""
+        rotation = _rotation(self._uniform(self.rotate_range, batch_size, device))
+        scale = 1 + self._uniform(self.scale_range, batch_size, device)
+        translate = self._uniform(self.translate_range, batch_size, device)
+
+        # voxel space, centered: x_in = R @ (S @ x_out + t)
+        linear = rotation * scale.unsqueeze(1)
+        offset = (rotation @ translate.unsqueeze(-1)).squeeze(-1)
+
+        # normalized coordinates (align_corners=False): x_voxel = x_norm * size / 2
+        half = torch.tensor(spatial_shape, dtype=torch.float32, device=device) / 2
+        linear = linear * half.view(1, 1, 3) / half.view(1, 3, 1)
+        offset = offset / half.view(1, 3)
+
+        # grid_sample orders the coordinates last spatial axis first
+        flip = [2, 1, 0]
+        linear = linear[:, flip][:, :, flip]
+        offset = offset[:, flip]
+        return torch.cat([linear, offset.unsqueeze(-1)], dim=-1)
+
+    @torch.no_grad()
+    def __call__(self, image, label=None):
+        """image: (B, C, D, H, W) float, label: (B, C, D, H, W) or None, both on the same device"""
+        theta = self.sample(image.shape[0], tuple(image.shape[2:]), image.device)
+        grid = F.affine_grid(theta, list(image.shape), align_corners=False)
+        image = F.grid_sample(image, grid, mode='bilinear', padding_mode=self.padding_mode, align_corners=False)
+        if label is None:
+            return image
+        label = F.grid_sample(label.float(), grid, mode='nearest', padding_mode=self.padding_mode, align_corners=False)
+        return image, label
+
+
+class AugmentedLoader:
+    """
+    wraps a DataLoader of image / label volumes: every batch is moved to the
+    device and augmented there before it is handed out
+    """
+
+    def __init__(self, loader, augment, device):
+        self.loader = loader
+        self.augment = augment
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for batch in self.loader:
+            image = batch['image'].to(self.device, non_blocking=True)
+            label = batch['label'].to(self.device, non_blocking=True)
+            batch['image'], batch['label'] = self.augment(image, label)
+            yield batch
@@ -0,0 +1,155 @@
+import atexit
+import hashlib
+import os
+import queue
+import shutil
+import threading
+from pathlib import Path
+
+import torch
+
+
+"""
+asynchronous checkpoint writer
+
+save() snapshots the state dict (model, optimizer or plain dict) to host memory
+on the calling thread, so training can continue to update the weights right
+away, and a background thread writes it to disk:
+    - every file is written to a temporary name, fsynced and renamed into
+      place, a crash never leaves a torn checkpoint behind
+    - frozen=True segments (front / center_front) are stored once under
+      <dir>/frozen/<sha1>.pth and hard-linked to their usual file name, so
+      identical frozen weights are shared between clients and are never
+      rewritten on later improvements
+    - the queue is bounded, a slow disk blocks save() instead of piling up
+      host copies of the models
+
+ModelSnapshots keeps the best-so-far weights as host copies so inference can
+swap them into the live modules without rebuilding the splits or reading the
+checkpoints back from disk.
+"""
+
+
+def _to_host(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _to_host(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_host(v) for v in obj)
+    return obj
+
+
+def _digest(state):
+    sha = hashlib.sha1()
+    for k, v in state.items():
+        sha.update(str(k).encode())
+        if isinstance(v, torch.Tensor):
+            sha.update(str((v.dtype, tuple(v.shape))).encode())
+            sha.update(v.contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+        else:
+            sha.update(repr(v).encode())
+    return sha.hexdigest()
+
+
+def _atomic_save(state, path):
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _atomic_link(src, path):
+    tmp = path.with_name(path.name + '.tmp')
+    if tmp.exists():
+        tmp.unlink()
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, path)
+
+
+class CheckpointWriter:
+    def __init__(self, max_pending=8):
+        self.queue = queue.Queue(maxsize=max_pending)
+        # frozen segments already handed to the writer
+        self.frozen_paths = set()
+        self.worker = threading.Thread(target=self._drain, name='checkpoint-writer', daemon=True)
+        self.worker.start()
+        atexit.register(self.close)
+        self.closed = False
+
+    def _drain(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            state, path, frozen = job
+            try:
+                path.parent.mkdir(exist_ok=True, parents=True)
+                if frozen:
+                    blob = path.parent / 'frozen' / f'{_digest(state)}.pth'
+                    if not blob.exists():
+                        blob.parent.mkdir(exist_ok=True)
+                        _atomic_save(state, blob)
+                    _atomic_link(blob, path)
+                else:
+                    _atomic_save(state, path)
+            except Exception as e:
+                print(f'checkpoint writer: failed to write {path}: {e}')
+            self.queue.task_done()
+
+    def save(self, obj, path, frozen=False, copy=True):
+        """
+        obj: nn.Module / optimizer (anything with state_dict()) or a state dict
+        frozen: the weights never change during the run, written once per path
+        copy: set to False for host state dicts the caller will not modify
+              again (e.g. from ModelSnapshots.update)
+        """
+        path = Path(path)
+        if frozen and path in self.frozen_paths:
+            return
+        state = obj.state_dict() if hasattr(obj, 'state_dict') else obj
+        if copy:
+            state = _to_host(state)
+        if frozen:
+            self.frozen_paths.add(path)
+        self.queue.put((state, path, frozen))
+
+    def wait(self):
+        """blocks until every pending checkpoint is on disk"""
+        self.queue.join()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.worker.join()
+
+
+class ModelSnapshots:
+    def __init__(self):
+        self.states = {}
+
+    def update(self, name, obj):
+        """
+        takes a fresh host copy (copy-on-improve) and returns it, the previous
+        snapshot is released rather than overwritten in place so a pending
+        checkpoint write of it stays valid
+        """
+        state = _to_host(obj.state_dict() if hasattr(obj, 'state_dict') else obj)
+        self.states[name] = state
+        return state
+
+    def restore(self, name, module):
+        """loads the snapshot into the existing module (same parameters, optimizers stay attached)"""
+        module.load_state_dict(self.states[name])
+        return module
+
+    def __contains__(self, name):
+        return name in self.states
@@ -0,0 +1,102 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+
+"""
+decoded-image shard cache for the 2D jpeg datasets (ISIC2019, COVID19)
+
+every image is decoded once, converted to RGB and resized to the training
+resolution, then packed into a single fixed-size uint8 file:
+    - <root>/images_<size>.u8    (N, size, size, 3) raw uint8, read as a memmap
+    - <root>/images_<size>.json  image path -> row
+datasets read zero-copy rows from the memmap instead of reopening and decoding
+the jpeg every epoch, the albumentations pipelines still run on top of them.
+the memmap is opened lazily per process, so DataLoader workers never share a
+file handle with the parent.
+note: images are resized to size x size before the augmentations run, so
+scale / rotate / affine act on the squashed image, not on the original aspect
+ratio as in the uncached pipelines.
+
+both files are written to a temporary name and renamed into place, the index
+is removed before the data file is replaced and written last, so an
+interrupted build never leaves an index that points into other rows.
+"""
+
+
+def _decode(path, img_size):
+    with Image.open(path) as im:
+        return np.asarray(im.convert('RGB').resize((img_size, img_size), Image.BILINEAR), dtype=np.uint8)
+
+
+class ImageShardCache:
+    def __init__(self, root, img_size=224):
+        self.root = Path(root)
+        self.img_size = img_size
+        self.data_path = self.root / f'images_{img_size}.u8'
+        self.index_path = self.root / f'images_{img_size}.json'
+        self.index = None
+        self.images = None
+
+    def build(self, paths, num_workers=8):
+        """decodes and packs the images once, a cache that covers paths is reused as is"""
+        paths = [str(p) for p in paths]
+        index = self._load_index()
+        if index is not None and all(p in index for p in paths):
+            self.index = index
+            return self
+        paths = list(dict.fromkeys(paths))
+
+        self.root.mkdir(exist_ok=True, parents=True)
+        tmp_path = self.data_path.with_name(self.data_path.name + '.tmp')
+        shape = (len(paths), self.img_size, self.img_size, 3)
+        images = np.memmap(tmp_path, mode='w+', dtype=np.uint8, shape=shape)
+
+        # PIL releases the GIL while decoding / resizing
+        with ThreadPoolExecutor(num_workers) as pool:
+            for row, im in enumerate(pool.map(lambda p: _decode(p, self.img_size), paths)):
+                images[row] = im
+        images.flush()
+        del images
+        if self.index_path.exists():
+            os.remove(self.index_path)
+        os.replace(tmp_path, self.data_path)
+
+        self.index = {p: row for row, p in enumerate(paths)}
+        tmp_index = self.index_path.with_name(self.index_path.name + '.tmp')
+        with open(tmp_index, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_index, self.index_path)
+        return self
+
+    def _load_index(self):
+        """the stored index, None unless it exists and matches the size of the data file"""
+        if not (self.index_path.exists() and self.data_path.exists()):
+            return None
+        with open(self.index_path) as f:
+            index = json.load(f)
+        if os.path.getsize(self.data_path) != len(index) * self.img_size * self.img_size * 3:
+            return None
+        return index
+
+    def _open(self):
+        if self.index is None:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        self.images = np.memmap(self.data_path, mode='r', dtype=np.uint8,
+                                shape=(len(self.index), self.img_size, self.img_size, 3))
+
+    def __getitem__(self, path):
+        if self.images is None:
+            self._open()
+        return self.images[self.index[str(path)]]
+
+    def __getstate__(self):
+        # workers reopen the memmap themselves
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
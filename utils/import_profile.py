@@ -0,0 +1,75 @@
+import builtins
+import sys
+import time
+from contextlib import contextmanager
+
+
+"""
+import-time profiler, same idea as `python -X importtime`
+
+while active, every first-time import is timed:
+    - self: time spent in the module body itself
+    - cumulative: self + the modules it imported for the first time
+report() prints the slowest top-level entries, nested imports are indented
+"""
+
+
+class ImportProfile:
+    def __init__(self):
+        self.records = []   # (depth, name, self_s, cumulative_s) in import order
+        self._stack = []    # time spent in children of the frames being imported
+        self.total = 0.0
+
+    def _timed_import(self, original_import):
+        def _import(name, globals=None, locals=None, fromlist=(), level=0):
+            if level != 0 or name in sys.modules:
+                return original_import(name, globals, locals, fromlist, level)
+
+            depth = len(self._stack)
+            self._stack.append(0.0)
+            idx = len(self.records)
+            self.records.append(None)
+            start = time.perf_counter()
+            try:
+                return original_import(name, globals, locals, fromlist, level)
+            finally:
+                cumulative = time.perf_counter() - start
+                children = self._stack.pop()
+                # failed optional imports (ImportError) are not reported
+                if name in sys.modules:
+                    self.records[idx] = (depth, name, cumulative - children, cumulative)
+                if self._stack:
+                    self._stack[-1] += cumulative
+        return _import
+
+    @contextmanager
+    def track(self):
+        original_import = builtins.__import__
+        builtins.__import__ = self._timed_import(original_import)
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.total += time.perf_counter() - start
+            builtins.__import__ = original_import
+
+    def report(self, top=25, max_depth=2):
+        print(f'\n{"-"*25}\nimport time profile: {self.total:.2f}s total')
+        print(f'{"self [s]":>10} | {"cumulative [s]":>14} | imported module')
+        roots = sorted((r for r in self.records if r is not None and r[0] == 0), key=lambda r: -r[3])[:top]
+        for root in roots:
+            start = self.records.index(root)
+            for depth, name, self_s, cumulative_s in self._subtree(start, max_depth):
+                print(f'{self_s:10.3f} | {cumulative_s:14.3f} | {"  " * depth}{name}')
+        print(f'{"-"*25}\n')
+
+    def _subtree(self, start, max_depth):
+        root_depth = self.records[start][0]
+        yield self.records[start]
+        for record in self.records[start + 1:]:
+            if record is None:
+                continue
+            if record[0] <= root_depth:
+                break
+            if record[0] - root_depth <= max_depth:
+                yield record
@@ -0,0 +1,133 @@
+import copy
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from monai.data import DataLoader, list_data_collate
+
+
+"""
+configurable loader backends for the 3D (KiTS19 / IXI-Tiny) clients
+
+    - 'process': monai DataLoader with worker processes, prefetch_factor batches
+                  in flight per worker; worker batches reach the trainer through
+                  shared memory, pinned for the host -> device copy when pin_memory
+                  is set
+    - 'thread':   ThreadPoolLoader, samples are loaded by a thread pool inside the
+                  training process; NIfTI gzip decompression (zlib) and most numpy /
+                  torch resampling release the GIL, so this avoids pickling volumes
+                  between processes altogether. Every thread works on its own
+                  deep copy of the dataset transform (reseeded), the Rand*
+                  transforms keep their randomize state on the instance and a
+                  shared Compose could pair one sample's image with another
+                  sample's label parameters
+with persistent=True (the train loaders) the workers stay alive between epochs,
+the evaluation loaders start theirs per pass instead of holding them all run;
+with num_workers=0 both fall back to loading in the training thread (the old default)
+"""
+
+
+def loader_kwargs(args):
+    """loader backend settings from the parsed arguments"""
+    return {
+        'backend': args.loader_backend,
+        'num_workers': args.loader_workers,
+        'prefetch': args.prefetch,
+        'pin_memory': args.pin_memory,
+    }
+
+
+def _pin(batch):
+    if isinstance(batch, torch.Tensor):
+        return batch.pin_memory()
+    if isinstance(batch, dict):
+        return {k: _pin(v) for k, v in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_pin(v) for v in batch)
+    return batch
+
+
+class ThreadPoolLoader:
+    def __init__(self, dataset, batch_size=1, shuffle=False, num_workers=4, prefetch=2, pin_memory=False,
+                 persistent=False, collate_fn=list_data_collate):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.collate_fn = collate_fn
+        self.persistent = persistent
+        self.pool = None
+        self.local = threading.local()
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def _dataset(self):
+        """this thread's copy of the dataset, with its own (reseeded) transform"""
+        dataset = getattr(self.local, 'dataset', None)
+        if dataset is None:
+            dataset = copy.copy(self.dataset)
+            transform = getattr(self.dataset, 'transform', None)
+            if transform is not None:
+                dataset.transform = copy.deepcopy(transform)
+                if hasattr(dataset.transform, 'set_random_state'):
+                    dataset.transform.set_random_state(seed=random.randrange(2 ** 31))
+            self.local.dataset = dataset
+        return dataset
+
+    def _load(self, i):
+        return self._dataset()[i]
+
+    def __iter__(self):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.num_workers, thread_name_prefix='loader')
+            self.local = threading.local()
+        order = list(range(len(self.dataset)))
+        if self.shuffle:
+            random.shuffle(order)
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+
+        # up to prefetch batches of samples are loading while one is consumed
+        pending = deque()
+        try:
+            for indices in batches:
+                pending.append([self.pool.submit(self._load, i) for i in indices])
+                if len(pending) > self.prefetch:
+                    yield self._collate(pending.popleft())
+            while pending:
+                yield self._collate(pending.popleft())
+        finally:
+            if not self.persistent:
+                self.pool.shutdown(cancel_futures=True)
+                self.pool = None
+
+    def _collate(self, futures):
+        batch = self.collate_fn([f.result() for f in futures])
+        return _pin(batch) if self.pin_memory else batch
+
+
+def make_loader(dataset, batch_size, shuffle=False, backend='process', num_workers=0, prefetch=2, pin_memory=False,
+                persistent=False):
+    """
+    persistent: keep the workers alive between epochs (only worth it for the train loader)
+    """
+    if dataset is None:
+        return None
+    if backend == 'thread' and num_workers > 0:
+        return ThreadPoolLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                                prefetch=prefetch, pin_memory=pin_memory, persistent=persistent)
+    if num_workers == 0:
+        return DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle, pin_memory=pin_memory)
+    return DataLoader(
+        dataset=dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=num_workers,
+        prefetch_factor=prefetch,
+        persistent_workers=persistent,
+        pin_memory=pin_memory,
+    )
@@ -0,0 +1,123 @@
+import atexit
+import queue
+import threading
+from collections import deque
+
+import torch
+import wandb
+
+
+"""
+buffered metrics sink
+
+trainers hand scalars to the sink as they are (device tensors included), nothing
+is converted with .item() on the training thread:
+    - log_step(): per-iteration scalars, kept in a ring buffer and flushed in
+      batches every flush_every steps by a background thread
+        - granularity='step':  every step entry is sent to wandb
+        - granularity='epoch': step entries are summed on device and only the
+          per-epoch mean is sent at end_epoch()
+    - log(): epoch-level scalars / wandb objects, buffered and sent in order
+
+the background thread is the only place that syncs with the device and calls
+wandb.log, when logging is disabled no wandb calls are made at all.
+"""
+
+
+def _to_python(value):
+    if isinstance(value, torch.Tensor):
+        return value.detach().float().item() if value.numel() == 1 else value.detach().cpu()
+    return value
+
+
+class MetricsSink:
+    def __init__(self, enabled=True, flush_every=50, granularity='step', capacity=None, log_fn=None):
+        assert granularity in ('step', 'epoch'), f'unknown logging granularity: {granularity}'
+        self.enabled = enabled
+        self.flush_every = max(int(flush_every), 1)
+        self.granularity = granularity
+        self.log_fn = log_fn if log_fn is not None else wandb.log
+
+        # ring buffer of pending entries, sized so a full flush interval always fits
+        self.capacity = capacity or 4 * self.flush_every
+        self.buffer = deque(maxlen=self.capacity)
+        self.num_steps = 0
+
+        # per-epoch device-side sums for granularity='epoch'
+        self.epoch_sums = {}
+        self.epoch_counts = {}
+
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._drain, name='metrics-sink', daemon=True)
+        self.worker.start()
+        atexit.register(self.close)
+        self.closed = False
+
+    def _drain(self):
+        while True:
+            entries = self.queue.get()
+            if entries is None:
+                self.queue.task_done()
+                return
+            for entry in entries:
+                try:
+                    self.log_fn({k: _to_python(v) for k, v in entry.items()})
+                except Exception as e:
+                    print(f'metrics sink: failed to log {list(entry.keys())}: {e}')
+            self.queue.task_done()
+
+    def _detach(self, metrics):
+        return {k: v.detach() if isinstance(v, torch.Tensor) else v for k, v in metrics.items()}
+
+    def log_step(self, metrics):
+        """per-iteration scalars (device tensors or numbers)"""
+        if not self.enabled:
+            return
+        metrics = self._detach(metrics)
+
+        if self.granularity == 'epoch':
+            for k, v in metrics.items():
+                self.epoch_sums[k] = self.epoch_sums.get(k, 0) + v
+                self.epoch_counts[k] = self.epoch_counts.get(k, 0) + 1
+            return
+
+        self.buffer.append(metrics)
+        self.num_steps += 1
+        if self.num_steps % self.flush_every == 0 or len(self.buffer) >= self.capacity:
+            self.flush(block=False)
+
+    def log(self, metrics):
+        """epoch-level scalars and wandb objects, always logged"""
+        if not self.enabled:
+            return
+        self.buffer.append(self._detach(metrics))
+        if len(self.buffer) >= self.capacity:
+            self.flush(block=False)
+
+    def end_epoch(self):
+        """pushes the per-epoch mean of the step scalars when granularity='epoch'"""
+        if not self.enabled:
+            return
+        if self.epoch_sums:
+            self.buffer.append({
+                f'{k} (epoch mean)': self.epoch_sums[k] / self.epoch_counts[k] for k in self.epoch_sums
+            })
+            self.epoch_sums = {}
+            self.epoch_counts = {}
+        self.flush(block=False)
+
+    def flush(self, block=True):
+        if self.buffer:
+            self.queue.put(list(self.buffer))
+            self.buffer.clear()
+        if block:
+            self.queue.join()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.end_epoch()
+        self.flush(block=True)
+        self.queue.put(None)
+        self.worker.join()
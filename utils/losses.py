@@ -0,0 +1,72 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from monai.losses import DiceLoss
+
+
+"""
+persistent segmentation losses for the client-side back models
+
+built once per client and reused every step:
+    - the one-hot target is scattered on the device into a buffer that is kept
+      between calls (only reallocated when the batch shape changes)
+    - 'dice':    monai DiceLoss(softmax=True) on the cached one-hot target, same
+                 value as DiceLoss(to_onehot_y=True, softmax=True)
+    - 'dice_ce': soft dice + cross entropy fused on a single log_softmax, same
+                 value as nnUNet's DC_and_CE_loss with the nnUNetTrainerV2
+                 settings ({'batch_dice': False, 'smooth': 1e-5, 'do_bg': False}, {})
+"""
+
+
+class OneHot:
+    """label map (B, 1, *spatial) -> one-hot (B, C, *spatial) in a reused device buffer"""
+
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.buffer = None
+
+    @torch.no_grad()
+    def __call__(self, targets, dtype=torch.float32):
+        shape = (targets.shape[0], self.num_classes, *targets.shape[2:])
+        if (self.buffer is None or self.buffer.shape != shape
+                or self.buffer.device != targets.device or self.buffer.dtype != dtype):
+            self.buffer = torch.empty(shape, dtype=dtype, device=targets.device)
+        self.buffer.zero_()
+        self.buffer.scatter_(1, targets.long(), 1)
+        return self.buffer
+
+
+class SegmentationLoss(nn.Module):
+    def __init__(self, num_classes, loss='dice', smooth=1e-5, weight_ce=1, weight_dice=1):
+        super(SegmentationLoss, self).__init__()
+        assert loss in ('dice', 'dice_ce'), f'unknown segmentation loss: {loss}'
+        self.loss = loss
+        self.one_hot = OneHot(num_classes)
+        self.smooth = smooth
+        self.weight_ce = weight_ce
+        self.weight_dice = weight_dice
+        if loss == 'dice':
+            self.dice = DiceLoss(to_onehot_y=False, softmax=True)
+
+    def forward(self, outputs, targets):
+        y_onehot = self.one_hot(targets, dtype=outputs.dtype)
+        if self.loss == 'dice':
+            return self.dice(outputs, y_onehot)
+        return self._dice_ce(outputs, y_onehot)
+
+    def _dice_ce(self, outputs, y_onehot):
+        log_probs = F.log_softmax(outputs, dim=1)
+        probs = log_probs.exp()
+        axes = tuple(range(2, outputs.dim()))
+
+        # cross entropy from the one-hot target, no second softmax
+        ce_loss = -(y_onehot * log_probs).sum(dim=1).mean()
+
+        # per-sample soft dice without background
+        tp = (probs * y_onehot).sum(dim=axes)
+        fp = probs.sum(dim=axes) - tp
+        fn = y_onehot.sum(dim=axes) - tp
+        dc = (2 * tp + self.smooth) / (2 * tp + fp + fn + self.smooth + 1e-8)
+        dc_loss = -dc[:, 1:].mean()
+
+        return self.weight_ce * ce_loss + self.weight_dice * dc_loss
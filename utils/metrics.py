@@ -0,0 +1,226 @@
+import torch
+
+
+"""
+streaming metric accumulators
+
+every update() works on the device of the predictions and returns the batch
+value as a 0-dim tensor on that device (no host sync), the epoch value is
+computed once from the accumulated counts in compute() / the metric helpers.
+state is allocated lazily on the first update so the accumulators can be
+created before the client device is known.
+"""
+
+
+def _safe_div(num, den, zero_division=0.0):
+    out = num / den.clamp_min(1e-12)
+    return torch.where(den > 0, out, torch.full_like(out, zero_division))
+
+
+class DiceAccumulator:
+    """
+    dice for multi-class segmentation logits (B, C, *spatial) vs labels (B, 1, *spatial)
+    mirrors torchmetrics.functional.dice(average='micro', ignore_index=...) with
+        - samplewise=True: mdmc_average='samplewise' (mean of per-sample dice)
+        - samplewise=False: mdmc_average='global' (dice of the summed counts)
+    batch_mean=True: compute() is the mean of the per-batch dice, the epoch dice
+    the clients reported before the accumulators (comparable with earlier runs)
+    """
+
+    def __init__(self, num_classes, ignore_index=0, samplewise=True, zero_division=1e-8, batch_mean=False):
+        self.num_classes = num_classes
+        self.ignore_index = ignore_index
+        self.samplewise = samplewise
+        self.zero_division = zero_division
+        self.batch_mean = batch_mean
+        self.reset()
+
+    def reset(self):
+        self.tp = None
+        self.fp = None
+        self.fn = None
+        self.dice_sum = None
+        self.batch_dice_sum = None
+        self.num_samples = 0
+        self.num_batches = 0
+
+    def _allocate(self, device):
+        zeros = lambda: torch.zeros(self.num_classes, dtype=torch.long, device=device)
+        self.tp, self.fp, self.fn = zeros(), zeros(), zeros()
+        self.dice_sum = torch.zeros((), dtype=torch.float64, device=device)
+        self.batch_dice_sum = torch.zeros((), dtype=torch.float64, device=device)
+
+    def _class_mask(self, device):
+        mask = torch.ones(self.num_classes, dtype=torch.bool, device=device)
+        if self.ignore_index is not None:
+            mask[self.ignore_index] = False
+        return mask
+
+    @torch.no_grad()
+    def stat_scores(self, preds, targets):
+        """per-sample, per-class tp/fp/fn: each (B, C)"""
+        if preds.is_floating_point():
+            preds = preds.argmax(dim=1)
+        preds = preds.reshape(preds.shape[0], -1).long()
+        targets = targets.reshape(targets.shape[0], -1).long()
+        B, C = preds.shape[0], self.num_classes
+
+        # one bincount over (sample, target, pred) gives a confusion matrix per sample
+        offsets = torch.arange(B, device=preds.device).unsqueeze(1) * C * C
+        conf = torch.bincount((offsets + targets * C + preds).reshape(-1), minlength=B * C * C)
+        conf = conf.view(B, C, C)
+
+        tp = conf.diagonal(dim1=1, dim2=2)
+        fp = conf.sum(dim=1) - tp
+        fn = conf.sum(dim=2) - tp
+        return tp, fp, fn
+
+    def _dice(self, tp, fp, fn, mask):
+        tp, fp, fn = tp[..., mask].sum(-1), fp[..., mask].sum(-1), fn[..., mask].sum(-1)
+        return _safe_div(2 * tp.double(), (2 * tp + fp + fn).double(), self.zero_division)
+
+    @torch.no_grad()
+    def update(self, preds, targets):
+        tp, fp, fn = self.stat_scores(preds, targets)
+        if self.tp is None:
+            self._allocate(tp.device)
+        mask = self._class_mask(tp.device)
+
+        self.tp += tp.sum(0)
+        self.fp += fp.sum(0)
+        self.fn += fn.sum(0)
+
+        self.num_samples += tp.shape[0]
+        self.num_batches += 1
+        if self.samplewise:
+            sample_dice = self._dice(tp, fp, fn, mask)
+            self.dice_sum += sample_dice.sum()
+            batch_dice = sample_dice.mean()
+        else:
+            batch_dice = self._dice(tp.sum(0), fp.sum(0), fn.sum(0), mask)
+        self.batch_dice_sum += batch_dice
+        return batch_dice.float()
+
+    @torch.no_grad()
+    def compute(self):
+        if self.tp is None:
+            return torch.tensor(0.0)
+        if self.batch_mean:
+            return (self.batch_dice_sum / self.num_batches).float()
+        if self.samplewise:
+            return (self.dice_sum / max(self.num_samples, 1)).float()
+        return self._dice(self.tp, self.fp, self.fn, self._class_mask(self.tp.device)).float()
+
+
+class ConfusionAccumulator:
+    """
+    multiclass confusion matrix built from logits (B, C) and labels (B,) / (B, 1)
+    rows: targets, columns: predictions
+    """
+
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.reset()
+
+    def reset(self):
+        self.confusion = None
+
+    @torch.no_grad()
+    def update(self, preds, targets):
+        """accumulates the batch and returns the batch micro f1 (== accuracy for multiclass)"""
+        if preds.is_floating_point():
+            preds = preds.argmax(dim=1)
+        preds = preds.reshape(-1).long()
+        targets = targets.reshape(-1).long()
+        C = self.num_classes
+
+        batch = torch.bincount(targets * C + preds, minlength=C * C).view(C, C)
+        if self.confusion is None:
+            self.confusion = torch.zeros_like(batch)
+        self.confusion += batch
+
+        return (preds == targets).float().mean()
+
+    @torch.no_grad()
+    def accuracy(self):
+        if self.confusion is None:
+            return 0.0
+        return (self.confusion.diagonal().sum() / self.confusion.sum().clamp_min(1)).item()
+
+    @torch.no_grad()
+    def balanced_accuracy(self):
+        """mean recall over the classes present in the targets (as sklearn.metrics.balanced_accuracy_score)"""
+        if self.confusion is None:
+            return 0.0
+        support = self.confusion.sum(dim=1)
+        recall = self.confusion.diagonal() / support.clamp_min(1)
+        return recall[support > 0].double().mean().item()
+
+    @torch.no_grad()
+    def f1_macro(self):
+        """macro f1 over the classes seen in either targets or predictions (as torchmetrics)"""
+        if self.confusion is None:
+            return 0.0
+        tp = self.confusion.diagonal()
+        fp = self.confusion.sum(dim=0) - tp
+        fn = self.confusion.sum(dim=1) - tp
+        f1 = _safe_div(2 * tp.double(), (2 * tp + fp + fn).double())
+        seen = (tp + fp + fn) > 0
+        return f1[seen].mean().item() if seen.any() else 0.0
+
+
+class BinaryAccumulator:
+    """
+    binary classification from logits (B, 1) vs labels (B, 1)
+    scores are binned into a fixed histogram so the epoch AUROC does not need
+    every prediction of the epoch (same approximation as torchmetrics' thresholds=num_bins)
+    """
+
+    def __init__(self, num_bins=1000):
+        self.num_bins = num_bins
+        self.reset()
+
+    def reset(self):
+        self.histogram = None
+        self.tp = self.fp = self.fn = None
+
+    @torch.no_grad()
+    def update(self, preds, targets):
+        """accumulates the batch and returns the batch f1 at threshold 0.5"""
+        logits = preds.reshape(-1).float()
+        targets = targets.reshape(-1).long()
+
+        bins = (torch.sigmoid(logits) * self.num_bins).long().clamp_(0, self.num_bins - 1)
+        batch = torch.bincount(targets * self.num_bins + bins, minlength=2 * self.num_bins)
+        hard = (logits > 0).long()
+        tp = (hard * targets).sum()
+        fp = (hard * (1 - targets)).sum()
+        fn = ((1 - hard) * targets).sum()
+
+        if self.histogram is None:
+            self.histogram = torch.zeros_like(batch)
+            self.tp, self.fp, self.fn = torch.zeros_like(tp), torch.zeros_like(fp), torch.zeros_like(fn)
+        self.histogram += batch
+        self.tp += tp
+        self.fp += fp
+        self.fn += fn
+
+        return _safe_div(2 * tp.float(), (2 * tp + fp + fn).float())
+
+    @torch.no_grad()
+    def f1(self):
+        if self.tp is None:
+            return 0.0
+        return _safe_div(2 * self.tp.float(), (2 * self.tp + self.fp + self.fn).float()).item()
+
+    @torch.no_grad()
+    def auroc(self):
+        if self.histogram is None:
+            return 0.0
+        neg, pos = self.histogram.view(2, self.num_bins).double()
+        # sweep the threshold from the highest bin down
+        tps = torch.cat([pos.new_zeros(1), pos.flip(0).cumsum(0)])
+        fps = torch.cat([neg.new_zeros(1), neg.flip(0).cumsum(0)])
+        if tps[-1] == 0 or fps[-1] == 0:
+            return 0.0
+        return torch.trapz(tps / tps[-1], fps / fps[-1]).item()
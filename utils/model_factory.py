@@ -0,0 +1,52 @@
+import copy
+
+import torch
+
+
+"""
+single-load factory for the pretrained split models
+
+every split class (front / center_front / center_back / back) used to build the
+full network and torch.load the pretrained checkpoint on its own, i.e. ~5 loads
+per client. load_pretrained() builds and loads the full network once per process,
+memoized by (builder, checkpoint path):
+    - frozen splits (front, center_front) slice a shared instance directly, the
+      frozen weights are held once for all clients (and moved to the device in
+      place by the trainers)
+    - trainable splits (center_back, back) get the pristine copy, which never
+      leaves the cpu and is never modified, and trainable_copy() only the
+      submodules they keep; the rest of the network is not copied and no device
+      tensor is ever cloned
+"""
+
+
+_pristine_models = {}
+_shared_models = {}
+
+
+def load_pretrained(builder, path, trainable=False):
+    """
+    trainable=False: the shared instance, for the frozen splits
+    trainable=True: the pristine cpu instance, only to be sliced into trainable_copy
+    """
+    key = (builder.__module__, builder.__qualname__, str(path))
+    if key not in _pristine_models:
+        full_model = builder()
+        full_model.load_state_dict(torch.load(path, map_location=torch.device('cpu')))
+        _pristine_models[key] = full_model
+        _shared_models[key] = copy.deepcopy(full_model)
+
+    return _pristine_models[key] if trainable else _shared_models[key]
+
+
+def trainable_copy(module):
+    """deep copy of one submodule of the pristine model, all parameters trainable"""
+    module = copy.deepcopy(module)
+    for p in module.parameters():
+        p.requires_grad = True
+    return module
+
+
+def clear_pretrained_cache():
+    _pristine_models.clear()
+    _shared_models.clear()
@@ -0,0 +1,168 @@
+from pathlib import Path
+
+import numpy as np
+
+
+"""
+vectorized non-IID client partitioning on label arrays
+
+every strategy turns a label array into per (client, class) sample counts, or
+directly into one owner per sample, and never touches the samples themselves:
+    - sampling without replacement is done by permuting each class once and
+      handing out consecutive slices, no set differences or per client loops
+      over the dataset, so 10k clients cost the same as 10
+    - the result is a Partition, a flat index array + per client offsets (CSR),
+      client i owns indices[offsets[i]:offsets[i+1]]
+
+strategies:
+    - dirichlet: label skew, per class client proportions ~ Dir(alpha), or with
+                 samples_per_client, per client class proportions ~ Dir(alpha)
+                 and a fixed client size (the CIFAR-10 setting)
+    - shards:    sort by label, cut into num_clients * shards_per_client shards
+                 and give every client shards_per_client random shards
+    - quantity:  quantity skew, client sizes ~ Dir(alpha), labels stay IID
+"""
+
+
+class Partition:
+    def __init__(self, indices, offsets):
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_owners(cls, samples, owners, num_clients):
+        """samples[k] goes to client owners[k], a client keeps the order its samples are listed in"""
+        samples = np.asarray(samples, dtype=np.int64)
+        owners = np.asarray(owners, dtype=np.int64)
+        order = np.argsort(owners, kind='stable')
+        sizes = np.bincount(owners, minlength=num_clients)
+        return cls(samples[order], np.concatenate([[0], np.cumsum(sizes)]))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, client_id):
+        return self.indices[self.offsets[client_id]:self.offsets[client_id + 1]]
+
+    @property
+    def sizes(self):
+        return np.diff(self.offsets)
+
+    def owners(self, num_samples):
+        """client id per sample, -1 for samples no client got"""
+        owners = np.full(num_samples, -1, dtype=np.int64)
+        owners[self.indices] = np.repeat(np.arange(len(self)), self.sizes)
+        return owners
+
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = path.with_name(path.stem + '.tmp.npz')
+        np.savez(tmp_path, indices=self.indices, offsets=self.offsets)
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path):
+        cached = np.load(path)
+        return cls(cached['indices'], cached['offsets'])
+
+
+def take_by_class(labels, counts, rng, num_classes=None):
+    """
+    sampling without replacement for many clients at once
+    counts: (num_clients, num_classes) requested samples, clients are served in
+    order from one permutation of every class, and are capped at what is left
+    """
+    labels = np.asarray(labels)
+    counts = np.asarray(counts, dtype=np.int64)
+    num_clients = counts.shape[0]
+    num_classes = num_classes or counts.shape[1]
+
+    samples, owners = [], []
+    for j in range(num_classes):
+        class_indices = rng.permutation(np.flatnonzero(labels == j))
+        ends = np.minimum(np.cumsum(counts[:, j]), len(class_indices))
+        taken = np.diff(np.concatenate([[0], ends]))
+        samples.append(class_indices[:ends[-1]])
+        owners.append(np.repeat(np.arange(num_clients), taken))
+    return Partition.from_owners(np.concatenate(samples), np.concatenate(owners), num_clients)
+
+
+def _split_counts(total, proportions):
+    """integer split of total following proportions (rows sum to 1), largest remainders first"""
+    raw = proportions * total
+    counts = np.floor(raw).astype(np.int64)
+    missing = total - counts.sum()
+    if missing > 0:
+        counts[np.argsort(counts - raw)[:missing]] += 1
+    return counts
+
+
+def dirichlet_partition(labels, num_clients, alpha=0.5, seed=42, samples_per_client=None):
+    labels = np.asarray(labels)
+    rng = np.random.RandomState(seed)
+    num_classes = int(labels.max()) + 1
+
+    if samples_per_client is not None:
+        dist = rng.dirichlet(np.ones(num_classes) * alpha, size=num_clients)
+        counts = np.round(dist * samples_per_client).astype(np.int64)
+    else:
+        class_sizes = np.bincount(labels, minlength=num_classes)
+        dist = rng.dirichlet(np.ones(num_clients) * alpha, size=num_classes)
+        counts = np.stack([_split_counts(n, p) for n, p in zip(class_sizes, dist)], axis=1)
+    return take_by_class(labels, counts, rng, num_classes)
+
+
+def shard_partition(labels, num_clients, shards_per_client=2, seed=42):
+    labels = np.asarray(labels)
+    rng = np.random.RandomState(seed)
+    num_shards = num_clients * shards_per_client
+    assert num_shards <= len(labels), f'{num_shards} shards for {len(labels)} samples'
+
+    # shuffle within each label, then sort by label (stable keeps the shuffle)
+    shuffled = rng.permutation(len(labels))
+    samples = shuffled[np.argsort(labels[shuffled], kind='stable')]
+    shard_sizes = np.full(num_shards, len(labels) // num_shards)
+    shard_sizes[:len(labels) % num_shards] += 1
+    shard_owners = rng.permutation(num_shards) // shards_per_client
+    return Partition.from_owners(samples, np.repeat(shard_owners, shard_sizes), num_clients)
+
+
+def quantity_partition(labels, num_clients, alpha=0.5, seed=42):
+    num_samples = len(labels)
+    rng = np.random.RandomState(seed)
+    sizes = _split_counts(num_samples, rng.dirichlet(np.ones(num_clients) * alpha))
+    return Partition.from_owners(rng.permutation(num_samples), np.repeat(np.arange(num_clients), sizes), num_clients)
+
+
+PARTITIONERS = {
+    'dirichlet': dirichlet_partition,
+    'shards': shard_partition,
+    'quantity': quantity_partition,
+}
+
+
+def partition_labels(strategy, labels, num_clients, seed=42, alpha=0.5, shards_per_client=2):
+    assert strategy in PARTITIONERS, f'unknown partition strategy: {strategy}'
+    if strategy == 'shards':
+        return shard_partition(labels, num_clients, shards_per_client=shards_per_client, seed=seed)
+    return PARTITIONERS[strategy](labels, num_clients, alpha=alpha, seed=seed)
+
+
+def repartition_clients(df, client_column, label_column, strategy, num_clients, group_column=None, seed=42, **kwargs):
+    """
+    replaces the natural client column of a split csv (center / hospital / client)
+    with a synthetic non-IID partition of its rows, every group (e.g. train / test
+    fold) is partitioned separately so each client gets a share of every group
+    rows no client got are dropped
+    """
+    df = df.copy()
+    owners = np.full(len(df), -1, dtype=np.int64)
+    groups = [np.arange(len(df))] if group_column is None else \
+        [np.flatnonzero((df[group_column] == g).to_numpy()) for g in df[group_column].unique()]
+    for k, rows in enumerate(groups):
+        labels = df[label_column].to_numpy()[rows].astype(np.int64)
+        partition = partition_labels(strategy, labels, num_clients, seed=seed + k, **kwargs)
+        owners[rows] = partition.owners(len(rows))
+    df[client_column] = owners
+    return df[owners >= 0].reset_index(drop=True)
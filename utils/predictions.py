@@ -0,0 +1,68 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import torch
+
+
+"""
+compact on-disk sink for segmentation predictions
+
+predictions are reduced to uint8 argmax volumes on the device and appended,
+batch by batch, to raw uint8 files next to the matching uint8 labels, so host
+memory stays bounded by one batch no matter how large the validation split is.
+the files are plain C-ordered arrays and are read back with load_predictions()
+as read-only np.memmap of shape (num_samples, *spatial).
+"""
+
+
+class PredictionSink:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.pred_file = open(self.path.with_suffix('.pred.u8'), 'wb')
+        self.label_file = open(self.path.with_suffix('.label.u8'), 'wb')
+        self.spatial_shape = None
+        self.num_samples = 0
+
+    @torch.no_grad()
+    def write(self, preds, targets):
+        """
+        preds: logits (B, C, *spatial) or labels, targets: labels (B, 1, *spatial)
+        """
+        if preds.is_floating_point():
+            preds = preds.argmax(dim=1)
+        preds = preds.to(torch.uint8).reshape(preds.shape[0], *targets.shape[2:])
+        targets = targets.to(torch.uint8).reshape(preds.shape)
+
+        if self.spatial_shape is None:
+            self.spatial_shape = tuple(preds.shape[1:])
+        assert tuple(preds.shape[1:]) == self.spatial_shape, \
+            f'prediction shape {tuple(preds.shape[1:])} != {self.spatial_shape}'
+
+        self.pred_file.write(preds.cpu().numpy().tobytes())
+        self.label_file.write(targets.cpu().numpy().tobytes())
+        self.num_samples += preds.shape[0]
+
+    def close(self):
+        if self.pred_file.closed:
+            return
+        self.pred_file.close()
+        self.label_file.close()
+        with open(self.path.with_suffix('.json'), 'w') as f:
+            json.dump({'num_samples': self.num_samples, 'spatial_shape': self.spatial_shape}, f)
+
+
+def load_predictions(path):
+    """
+    returns (preds, labels) as read-only uint8 memmaps written by a PredictionSink
+    """
+    path = Path(path)
+    with open(path.with_suffix('.json')) as f:
+        meta = json.load(f)
+    if meta['num_samples'] == 0:
+        return np.zeros((0,), dtype=np.uint8), np.zeros((0,), dtype=np.uint8)
+    shape = (meta['num_samples'], *meta['spatial_shape'])
+    preds = np.memmap(path.with_suffix('.pred.u8'), dtype=np.uint8, mode='r', shape=shape)
+    labels = np.memmap(path.with_suffix('.label.u8'), dtype=np.uint8, mode='r', shape=shape)
+    return preds, labels
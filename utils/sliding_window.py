@@ -0,0 +1,107 @@
+import itertools
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+"""
+sliding-window inference on full-resolution volumes through the split models
+
+follows nnUNet's SegmentationNetwork._internal_predict_3D_3Dconv_tiled:
+    - tile starts are evenly spaced so neighbouring tiles overlap by at least
+      `overlap` of the patch (_compute_steps_for_sliding_window)
+    - every tile's softmax is weighted with a gaussian importance map (sigma =
+      patch / 8, normalized to 1 at the center) so tile borders count less
+    - predictions and weights are summed into preallocated full-volume buffers
+      on the device, the result is their ratio
+tiles are batched, each batch runs front -> center_front -> center_back -> back
+with the unet skips handed on exactly like in training (split_forward).
+volumes smaller than the patch are zero padded (as ResizeWithPadOrCropd) and
+cropped back afterwards.
+"""
+
+
+def gaussian_importance_map(patch_size, sigma_scale=1. / 8, device=None):
+    g = None
+    for axis, size in enumerate(patch_size):
+        coords = torch.arange(size, dtype=torch.float32) - size // 2
+        g1 = torch.exp(-0.5 * (coords / (size * sigma_scale)) ** 2)
+        shape = [1] * len(patch_size)
+        shape[axis] = size
+        g = g1.view(shape) if g is None else g * g1.view(shape)
+    g = g / g.max()
+    # no zero weights, every voxel of a tile contributes
+    g = g.clamp_min(g[g > 0].min())
+    return g.to(device)
+
+
+def tile_starts(image_size, patch_size, step_size=0.5):
+    """per axis tile start offsets, at most step_size * patch apart"""
+    steps = []
+    for dim, patch in zip(image_size, patch_size):
+        num_steps = int(np.ceil((dim - patch) / (patch * step_size))) + 1
+        actual_step = (dim - patch) / (num_steps - 1) if num_steps > 1 else 0
+        steps.append([int(np.round(actual_step * i)) for i in range(num_steps)])
+    return steps
+
+
+def split_forward(front, center_front, center_back, back, x):
+    """one forward through the four split parts, skips are shared like in training"""
+    x1 = front(x)
+    center_front.skips = front.skips
+    x2 = center_front(x1)
+    center_back.skips = center_front.skips
+    x3 = center_back(x2)
+    back.skips = center_back.skips
+    return back(x3)
+
+
+class SlidingWindowInferer:
+    def __init__(self, patch_size=(96, 96, 96), overlap=0.5, batch_size=4, sigma_scale=1. / 8):
+        self.patch_size = tuple(patch_size)
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.sigma_scale = sigma_scale
+        self._gaussian = {}
+
+    def importance(self, device):
+        if device not in self._gaussian:
+            self._gaussian[device] = gaussian_importance_map(self.patch_size, self.sigma_scale, device)
+        return self._gaussian[device]
+
+    @torch.no_grad()
+    def __call__(self, models, image):
+        """
+        models: (front, center_front, center_back, back), image: (1, C, *spatial)
+        returns (1, num_classes, *spatial) softmax probabilities
+        """
+        spatial = tuple(image.shape[2:])
+        pad = [max(p - s, 0) for s, p in zip(spatial, self.patch_size)]
+        padding = []
+        for p in reversed(pad):
+            padding += [p // 2, p - p // 2]
+        image = F.pad(image, padding)
+        padded = tuple(image.shape[2:])
+
+        gaussian = self.importance(image.device)
+        corners = list(itertools.product(*tile_starts(padded, self.patch_size, 1 - self.overlap)))
+        probabilities = None
+        weights = torch.zeros(padded, device=image.device)
+
+        for i in range(0, len(corners), self.batch_size):
+            regions = [
+                tuple(slice(c, c + p) for c, p in zip(corner, self.patch_size))
+                for corner in corners[i:i + self.batch_size]
+            ]
+            tiles = torch.cat([image[(slice(None), slice(None)) + region] for region in regions])
+            out = torch.softmax(split_forward(*models, tiles), dim=1)
+            if probabilities is None:
+                probabilities = torch.zeros((out.shape[1],) + padded, device=image.device)
+            for tile_out, region in zip(out, regions):
+                probabilities[(slice(None),) + region] += tile_out * gaussian
+                weights[region] += gaussian
+
+        probabilities /= weights
+        crop = tuple(slice(p // 2, p // 2 + s) for p, s in zip(pad, spatial))
+        return probabilities[(slice(None),) + crop].unsqueeze(0)
@@ -0,0 +1,141 @@
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+from monai.transforms import CenterSpatialCropd, RandSpatialCropd
+
+
+"""
+persistent cache of the deterministic transform prefix for the 3D datasets
+
+LoadImaged (gzip NIfTI decode), Orientationd, Spacingd and CropForegroundd give
+the same result for a case every time, only the crop / affine tail is random:
+    - the prefix runs once per case, the result is stored as
+      <cache_dir>/<case hash>_image.npy (float16) and _label.npy (uint8)
+    - later accesses np.load the arrays with mmap_mode='r' and only run the
+      tail transforms online; when the tail starts with a fixed-size
+      RandSpatialCropd / CenterSpatialCropd the crop window is taken on the
+      memmap (same window choice, drawn from the transform's own random
+      state), so only the cropped region is read and cast to float32
+    - files are written to a temporary name and renamed into place, so
+      concurrent DataLoader workers never read a partial case
+the case hash covers the image / label paths and prefix_key(prefix), a hash of
+the class and configuration of every cached transform (voxel spacing, crop
+source, axcodes, ...), so editing the prefix never reuses stale volumes.
+"""
+
+
+def _describe(obj, depth=3):
+    """address-free description of a transform's configuration"""
+    if isinstance(obj, (str, int, float, bool, type(None))):
+        return repr(obj)
+    if isinstance(obj, (list, tuple)):
+        return '[' + ','.join(_describe(o, depth) for o in obj) + ']'
+    if isinstance(obj, dict):
+        items = sorted(obj.items(), key=lambda kv: str(kv[0]))
+        return '{' + ','.join(f'{k}:{_describe(v, depth)}' for k, v in items) + '}'
+    if isinstance(obj, np.ndarray):
+        return repr(obj.tolist())
+    name = f'{type(obj).__module__}.{type(obj).__qualname__}'
+    if depth == 0 or not hasattr(obj, '__dict__'):
+        return name
+    # R: the transform's random state, not part of its configuration
+    return name + _describe({k: v for k, v in vars(obj).items() if k != 'R'}, depth - 1)
+
+
+def prefix_key(prefix):
+    """hash of the classes and settings of the transforms in the prefix Compose"""
+    description = '|'.join(_describe(t) for t in prefix.transforms)
+    return hashlib.sha1(description.encode()).hexdigest()[:16]
+
+
+def split_prefix(compose, last_cached):
+    """
+    compose -> (prefix, tail) Composes, the prefix ends with the last transform
+    of type last_cached (e.g. Spacingd)
+    """
+    transforms = list(compose.transforms)
+    end = max(i for i, t in enumerate(transforms) if isinstance(t, last_cached)) + 1
+    return type(compose)(transforms[:end]), type(compose)(transforms[end:])
+
+
+def leading_crop(transform, spatial_size):
+    """
+    (spatial slices, remaining transforms): the window of the tail's first
+    transform if it is a fixed-size RandSpatialCropd / CenterSpatialCropd, else
+    (None, all transforms)
+    """
+    transforms = list(transform.transforms) if transform is not None else []
+    crop = transforms[0] if transforms else None
+    if not isinstance(crop, (RandSpatialCropd, CenterSpatialCropd)):
+        return None, transforms
+    cropper = crop.cropper
+    if getattr(cropper, 'random_size', False):
+        return None, transforms
+    roi = cropper.roi_size
+    roi = roi if isinstance(roi, (list, tuple)) else [roi] * len(spatial_size)
+    # roi <= 0 keeps the whole axis, a roi larger than the volume is clipped to it
+    size = [d if r is None or r <= 0 else min(r, d) for d, r in zip(spatial_size, roi)]
+    if isinstance(crop, RandSpatialCropd) and cropper.random_center:
+        starts = [crop.R.randint(0, d - s + 1) for d, s in zip(spatial_size, size)]
+    else:
+        starts = [max(d // 2 - s // 2, 0) for d, s in zip(spatial_size, size)]
+    return tuple(slice(a, a + s) for a, s in zip(starts, size)), transforms[1:]
+
+
+def run_tail(image, label, transforms):
+    """float32 sample from the (cropped) float16 image / uint8 label, then the remaining transforms"""
+    item = {
+        'image': torch.from_numpy(np.asarray(image).astype(np.float32)),
+        'label': torch.from_numpy(np.asarray(label).astype(np.float32)),
+    }
+    # applied one by one, a new Compose would reseed them
+    for t in transforms:
+        item = t(item)
+    return item
+
+
+class PersistentVolumeDataset(torch.utils.data.Dataset):
+    def __init__(self, data, prefix, transform, cache_dir, key=''):
+        self.data = data
+        self.prefix = prefix
+        self.transform = transform
+        self.cache_dir = Path(cache_dir)
+        # key: anything the prefix does not capture, the prefix itself is always part of it
+        self.key = f'{prefix_key(prefix)}|{key}'
+
+    def __len__(self):
+        return len(self.data)
+
+    def _paths(self, item):
+        name = hashlib.sha1(f"{self.key}|{item['image']}|{item['label']}".encode()).hexdigest()[:20]
+        return self.cache_dir / f'{name}_image.npy', self.cache_dir / f'{name}_label.npy'
+
+    @staticmethod
+    def _save(array, path):
+        tmp = path.with_name(f'{path.stem}.{os.getpid()}.tmp.npy')
+        np.save(tmp, array)
+        os.replace(tmp, path)
+
+    def cache_case(self, item):
+        image_path, label_path = self._paths(item)
+        if image_path.exists() and label_path.exists():
+            return image_path, label_path
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+        out = self.prefix(dict(item))
+        self._save(np.asarray(out['image'], dtype=np.float16), image_path)
+        self._save(np.asarray(out['label'], dtype=np.uint8), label_path)
+        return image_path, label_path
+
+    def __getitem__(self, idx):
+        image_path, label_path = self.cache_case(self.data[idx])
+        image = np.load(image_path, mmap_mode='r')
+        label = np.load(label_path, mmap_mode='r')
+
+        window, transforms = leading_crop(self.transform, image.shape[1:])
+        if window is not None:
+            # crop on the memmap, only the window is read from disk
+            image, label = image[(slice(None),) + window], label[(slice(None),) + window]
+        return run_tail(image, label, transforms)